@@ -0,0 +1,260 @@
+import asyncio
+import itertools
+import math
+import time
+from typing import Optional, Dict, Any, AsyncIterator, List
+
+from .config import settings
+
+
+class _Bucket:
+    """Token bucket that may run into debt: a grant larger than the burst is allowed once tokens are positive."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self) -> float:
+        """Seconds until the bucket is positive again (0 if it already is)."""
+        return 0.0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def full_at(self) -> float:
+        """Monotonic time at which the bucket will have refilled to its burst."""
+        return self.updated + (self.burst - self.tokens) / self.rate
+
+
+class PacedStream:
+    """One relayed body under the scheduler, with its byte count and recent rate."""
+
+    __slots__ = ("id", "client", "label", "started", "bytes", "finish_tag", "rate", "_window_start", "_window_bytes")
+
+    def __init__(self, stream_id: int, client: str, label: str) -> None:
+        self.id = stream_id
+        self.client = client
+        self.label = label
+        self.started = time.monotonic()
+        self.bytes = 0
+        # Virtual time at which this stream's last grant finishes
+        self.finish_tag = 0.0
+        self.rate = 0.0
+        self._window_start = self.started
+        self._window_bytes = 0
+
+    def sent(self, nbytes: int, now: float) -> None:
+        self.bytes += nbytes
+        self._window_bytes += nbytes
+        if now - self._window_start >= 1.0:
+            self.rate = self._window_bytes / (now - self._window_start)
+            self._window_start, self._window_bytes = now, 0
+
+
+class _Request:
+    __slots__ = ("stream", "nbytes", "start_tag", "future")
+
+    def __init__(self, stream: PacedStream, nbytes: int, start_tag: float, future: "asyncio.Future[None]") -> None:
+        self.stream = stream
+        self.nbytes = nbytes
+        self.start_tag = start_tag
+        self.future = future
+
+
+class BandwidthScheduler:
+    """Shares download egress between streams by start-time fair queuing.
+
+    Every chunk a stream wants to send is a request for that many bytes. A
+    request is tagged with the virtual time at which the stream's previous
+    grant finishes (or the current virtual time, for a stream that was
+    idle), and the waiting request with the smallest tag is granted next.
+    Each stream thus gets a share of the link in proportion to its weight.
+    Idle streams do not bank credit, and capacity left unused by one stream
+    goes to the others at once. With ``per_client`` fairness a stream's
+    weight is 1/n for a client with n active streams, so opening more
+    connections does not buy a client a larger share.
+
+    Grants are paced by a global token bucket of ``rate`` bytes per second
+    and a bucket of ``client_rate`` per client. A stream whose client bucket
+    is empty is passed over, and its turn goes to streams that can send.
+    A rate of 0 means unlimited; with both 0, streams are only counted.
+    A client's bucket outlives its last stream until it has refilled, so
+    reconnecting does not hand a client a fresh burst.
+    """
+
+    def __init__(self, rate: float, client_rate: float, burst: int, per_client: bool = True) -> None:
+        self.rate = rate
+        self.client_rate = client_rate
+        self.burst = burst
+        self.per_client = per_client
+        self._global = _Bucket(rate, burst) if rate > 0 else None
+        self._clients: Dict[str, _Bucket] = {}
+        # Clients with no open stream whose bucket is still refilling, and when it will be full
+        self._idle: Dict[str, float] = {}
+        self._streams: Dict[int, PacedStream] = {}
+        self._client_streams: Dict[str, int] = {}
+        self._waiting: Dict[int, _Request] = {}
+        self._ids = itertools.count(1)
+        self._virtual_time = 0.0
+        self._dispatcher: Optional["asyncio.Task[None]"] = None
+        self._arrival: Optional[asyncio.Event] = None
+        self.grants = 0
+        self.bytes = 0
+        self.throttled_seconds = 0.0
+
+    @property
+    def limited(self) -> bool:
+        return self.rate > 0 or self.client_rate > 0
+
+    def open(self, client: str, label: str = "") -> PacedStream:
+        stream = PacedStream(next(self._ids), client, label)
+        self._streams[stream.id] = stream
+        self._client_streams[client] = self._client_streams.get(client, 0) + 1
+        self._idle.pop(client, None)
+        self._forget_refilled(time.monotonic())
+        if self.client_rate > 0 and client not in self._clients:
+            self._clients[client] = _Bucket(self.client_rate, self.burst)
+        return stream
+
+    def close(self, stream: PacedStream) -> None:
+        self._streams.pop(stream.id, None)
+        request = self._waiting.pop(stream.id, None)
+        if request is not None and not request.future.done():
+            request.future.cancel()
+        left = self._client_streams.get(stream.client, 1) - 1
+        if left:
+            self._client_streams[stream.client] = left
+        else:
+            self._client_streams.pop(stream.client, None)
+            now = time.monotonic()
+            bucket = self._clients.get(stream.client)
+            if bucket is not None:
+                bucket.refill(now)
+                self._idle[stream.client] = bucket.full_at()
+            self._forget_refilled(now)
+
+    def _forget_refilled(self, now: float) -> None:
+        """Drop the buckets of idle clients that are full again; a new one would be identical."""
+        for client in [client for client, full_at in self._idle.items() if full_at <= now]:
+            del self._idle[client]
+            self._clients.pop(client, None)
+
+    def _weight(self, stream: PacedStream) -> float:
+        return 1.0 / self._client_streams.get(stream.client, 1) if self.per_client else 1.0
+
+    async def acquire(self, stream: PacedStream, nbytes: int) -> None:
+        """Wait until ``stream`` may send ``nbytes`` more bytes."""
+        if not self.limited:
+            stream.sent(nbytes, time.monotonic())
+            self.bytes += nbytes
+            return
+        start_tag = max(self._virtual_time, stream.finish_tag)
+        stream.finish_tag = start_tag + nbytes / self._weight(stream)
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiting[stream.id] = _Request(stream, nbytes, start_tag, future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._arrival = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._arrival.set()
+        waited = time.monotonic()
+        try:
+            await future
+        finally:
+            self._waiting.pop(stream.id, None)
+            self.throttled_seconds += time.monotonic() - waited
+
+    async def _dispatch(self) -> None:
+        while self._waiting:
+            now = time.monotonic()
+            if self._global is not None:
+                self._global.refill(now)
+                if self._global.tokens <= 0:
+                    await asyncio.sleep(self._global.ready_in())
+                    continue
+            chosen: Optional[_Request] = None
+            wait = math.inf
+            for request in self._waiting.values():
+                bucket = self._clients.get(request.stream.client)
+                if bucket is not None:
+                    bucket.refill(now)
+                    if bucket.tokens <= 0:
+                        wait = min(wait, bucket.ready_in())
+                        continue
+                if chosen is None or request.start_tag < chosen.start_tag:
+                    chosen = request
+            if chosen is None:
+                # Every waiting stream is held by its client limit; a new arrival may be able to send sooner
+                self._arrival.clear()
+                try:
+                    await asyncio.wait_for(self._arrival.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            del self._waiting[chosen.stream.id]
+            if chosen.future.done():
+                continue
+            self._virtual_time = max(self._virtual_time, chosen.start_tag)
+            if self._global is not None:
+                self._global.tokens -= chosen.nbytes
+            bucket = self._clients.get(chosen.stream.client)
+            if bucket is not None:
+                bucket.tokens -= chosen.nbytes
+            chosen.stream.sent(chosen.nbytes, now)
+            self.grants += 1
+            self.bytes += chosen.nbytes
+            chosen.future.set_result(None)
+
+    async def pace(self, body: AsyncIterator[bytes], client: str, label: str = "") -> AsyncIterator[bytes]:
+        """Relay ``body`` as one stream, waiting for the scheduler before each chunk."""
+        stream = self.open(client, label)
+        try:
+            async for chunk in body:
+                await self.acquire(stream, len(chunk))
+                yield chunk
+        finally:
+            self.close(stream)
+
+    def streams(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "id": stream.id,
+                "client": stream.client,
+                "label": stream.label,
+                "bytes": stream.bytes,
+                "rate_bytes_per_second": round(stream.rate or stream.bytes / max(now - stream.started, 1e-3)),
+                "weight": round(self._weight(stream), 3),
+                "seconds": round(now - stream.started, 1),
+            }
+            for stream in self._streams.values()
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        streams = self.streams()
+        return {
+            "limit_bytes_per_second": self.rate,
+            "client_limit_bytes_per_second": self.client_rate,
+            "active_streams": len(streams),
+            "refilling_clients": len(self._idle),
+            "waiting": len(self._waiting),
+            "rate_bytes_per_second": sum(s["rate_bytes_per_second"] for s in streams),
+            "bytes": self.bytes,
+            "grants": self.grants,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "streams": streams,
+        }
+
+
+bandwidth = BandwidthScheduler(
+    rate=settings.bandwidth_limit,
+    client_rate=settings.bandwidth_client_limit,
+    burst=settings.bandwidth_burst,
+    per_client=settings.bandwidth_fair_per_client,
+)
+
+__all__ = ["BandwidthScheduler", "PacedStream", "bandwidth"]
@@ -0,0 +1,67 @@
+import asyncio
+from typing import Dict, List, AsyncIterator
+
+from .cache import ResolveCache, CacheKey
+from .config import settings
+from .limits import KeyedSemaphore, Overloaded, host_of
+from .logger import logger
+from .models import ResolveRequest, BatchResolveResult
+from .resolver import resolve_terabox
+
+
+# Shared by all batches so concurrent jobs cannot multiply the per-host load
+batch_host_limits = KeyedSemaphore(settings.batch_per_host_concurrency)
+
+
+async def resolve_batch(items: List[ResolveRequest], concurrency: int) -> AsyncIterator[BatchResolveResult]:
+    """Resolve items concurrently and yield one result per item as soon as it is ready.
+
+    Items with the same share URL and cookie are resolved once; every index
+    that referenced them gets its own result line.
+    """
+    groups: Dict[CacheKey, List[int]] = {}
+    for index, item in enumerate(items):
+        groups.setdefault(ResolveCache.key_for(item), []).append(index)
+
+    todo: "asyncio.Queue[List[int]]" = asyncio.Queue()
+    for indexes in groups.values():
+        todo.put_nowait(indexes)
+    results: "asyncio.Queue[BatchResolveResult]" = asyncio.Queue()
+
+    async def worker() -> None:
+        while True:
+            try:
+                indexes = todo.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            item = items[indexes[0]]
+            async with batch_host_limits.acquire(host_of(str(item.url))):
+                result = await _resolve_one(item)
+            for index in indexes:
+                await results.put(result.model_copy(update={"index": index}))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, len(groups)))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def _resolve_one(item: ResolveRequest) -> BatchResolveResult:
+    url = str(item.url)
+    try:
+        result = await resolve_terabox(item)
+        return BatchResolveResult(index=0, url=url, ok=True, result=result)
+    except Overloaded as e:
+        return BatchResolveResult(index=0, url=url, ok=False, status_code=503, detail=str(e))
+    except ValueError as ve:
+        logger.warning(f"Batch resolve error for {url}: {ve}")
+        return BatchResolveResult(index=0, url=url, ok=False, status_code=400, detail=str(ve))
+    except Exception:
+        logger.exception(f"Unexpected batch resolve error for {url}")
+        return BatchResolveResult(index=0, url=url, ok=False, status_code=500, detail="Failed to resolve link")
+
+
+__all__ = ["resolve_batch", "batch_host_limits"]
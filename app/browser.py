@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
+
+from .config import settings
+from .logger import logger
+
+try:
+    from playwright.async_api import async_playwright
+
+    PLAYWRIGHT_AVAILABLE = True
+except ImportError:
+    PLAYWRIGHT_AVAILABLE = False
+
+
+# Resource types aborted in pooled pages; download links never come from them
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+ContextKey = Tuple[str, str]
+
+
+class _PooledContext:
+    __slots__ = ("context", "uses")
+
+    def __init__(self, context: Any) -> None:
+        self.context = context
+        self.uses = 0
+
+
+class BrowserPool:
+    """A long-lived headless browser with reusable contexts and a cap on open pages.
+
+    Contexts are keyed by user agent and cookie, so a context is only ever
+    reused for the same identity, and are closed after a number of uses.
+    """
+
+    def __init__(self, max_pages: int, context_max_uses: int, max_idle_contexts: int) -> None:
+        self.context_max_uses = context_max_uses
+        self.max_idle_contexts = max_idle_contexts
+        self._pages = asyncio.Semaphore(max_pages)
+        self._max_pages = max_pages
+        self._launch_lock = asyncio.Lock()
+        self._playwright: Any = None
+        self._browser: Any = None
+        self._idle: Dict[ContextKey, List[_PooledContext]] = {}
+        self.launches = 0
+        self.contexts_created = 0
+        self.contexts_reused = 0
+        self.contexts_recycled = 0
+        self.active_pages = 0
+
+    @property
+    def available(self) -> bool:
+        return PLAYWRIGHT_AVAILABLE
+
+    async def _ensure_browser(self) -> Any:
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
+        async with self._launch_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return self._browser
+            await self._shutdown()
+            self._playwright = await async_playwright().start()
+            # Try with Chromium first, fall back to Firefox if needed
+            for browser_type in [self._playwright.chromium, self._playwright.firefox]:
+                try:
+                    self._browser = await browser_type.launch(
+                        headless=True,
+                        args=['--no-sandbox', '--disable-setuid-sandbox'],
+                    )
+                    self.launches += 1
+                    logger.info(f"Launched pooled {browser_type.name} browser")
+                    return self._browser
+                except Exception as e:
+                    logger.warning(f"Failed to launch {browser_type.name}: {e}")
+            raise RuntimeError("Failed to launch any browser")
+
+    async def start(self) -> None:
+        """Launch the browser ahead of the first resolve that needs it."""
+        try:
+            await self._ensure_browser()
+        except Exception as e:
+            logger.warning(f"Browser pre-warm failed: {e}")
+
+    async def _new_context(self, user_agent: str, cookie: Optional[str]) -> _PooledContext:
+        browser = await self._ensure_browser()
+        context = await browser.new_context(
+            user_agent=user_agent,
+            viewport={'width': 1920, 'height': 1080},
+            extra_http_headers={
+                "Accept-Language": "en-US,en;q=0.9",
+                "Accept-Encoding": "gzip, deflate, br",
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+                "Referer": "https://www.terabox.com/",
+                "DNT": "1",
+                "Connection": "keep-alive",
+                "Upgrade-Insecure-Requests": "1",
+                **({"Cookie": cookie} if cookie else {})
+            },
+            java_script_enabled=True,
+            bypass_csp=True,
+            ignore_https_errors=True,
+        )
+        self.contexts_created += 1
+        return _PooledContext(context)
+
+    def _checkout(self, key: ContextKey) -> Optional[_PooledContext]:
+        idle = self._idle.get(key)
+        while idle:
+            pooled = idle.pop()
+            if self._browser is not None and self._browser.is_connected():
+                self.contexts_reused += 1
+                return pooled
+        return None
+
+    async def _checkin(self, key: ContextKey, pooled: _PooledContext, healthy: bool) -> None:
+        pooled.uses += 1
+        idle_count = sum(len(v) for v in self._idle.values())
+        if healthy and pooled.uses < self.context_max_uses and idle_count < self.max_idle_contexts:
+            self._idle.setdefault(key, []).append(pooled)
+            return
+        self.contexts_recycled += 1
+        try:
+            await pooled.context.close()
+        except Exception:
+            pass
+
+    @asynccontextmanager
+    async def page(self, user_agent: str, cookie: Optional[str] = None) -> AsyncIterator[Any]:
+        """Check out a fresh page in a pooled context.
+
+        The page loads everything; callers install their own request routing
+        (the resolver's ``handle_route`` aborts images, fonts and media).
+        """
+        key = (user_agent, hashlib.sha256((cookie or "").encode()).hexdigest()[:16])
+        async with self._pages:
+            pooled = self._checkout(key) or await self._new_context(user_agent, cookie)
+            healthy = False
+            page = None
+            self.active_pages += 1
+            try:
+                page = await pooled.context.new_page()
+                yield page
+                healthy = True
+            finally:
+                self.active_pages -= 1
+                if page is not None:
+                    try:
+                        await page.close()
+                    except Exception:
+                        healthy = False
+                await self._checkin(key, pooled, healthy)
+
+    async def _shutdown(self) -> None:
+        for contexts in self._idle.values():
+            for pooled in contexts:
+                try:
+                    await pooled.context.close()
+                except Exception:
+                    pass
+        self._idle.clear()
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception:
+                pass
+            self._browser = None
+        if self._playwright is not None:
+            try:
+                await self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+
+    async def close(self) -> None:
+        async with self._launch_lock:
+            await self._shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "running": self._browser is not None and self._browser.is_connected(),
+            "max_pages": self._max_pages,
+            "active_pages": self.active_pages,
+            "idle_contexts": sum(len(v) for v in self._idle.values()),
+            "launches": self.launches,
+            "contexts_created": self.contexts_created,
+            "contexts_reused": self.contexts_reused,
+            "contexts_recycled": self.contexts_recycled,
+        }
+
+
+browser_pool = BrowserPool(
+    max_pages=settings.browser_max_pages,
+    context_max_uses=settings.browser_context_max_uses,
+    max_idle_contexts=settings.browser_max_idle_contexts,
+)
+
+__all__ = ["BrowserPool", "browser_pool", "BLOCKED_RESOURCE_TYPES", "PLAYWRIGHT_AVAILABLE"]
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable
+from urllib.parse import urlsplit, parse_qs, parse_qsl, urlencode
+
+from .config import settings
+from .models import ResolveRequest, ResolvedFile
+
+
+CacheKey = Tuple[str, str]
+
+DURATION_RE = re.compile(r"^(\d+)([smhd]?)$", re.IGNORECASE)
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+# Query parameters that change every time the same file is resolved
+VOLATILE_PARAMS = frozenset(
+    ("sign", "expires", "x-expires", "time", "timestamp", "dstime", "dp-logid", "dp-callid", "r")
+)
+
+
+def dlink_expiry(url: str) -> Optional[float]:
+    """Best-effort absolute expiry (epoch seconds) of a signed download URL.
+
+    TeraBox/Baidu dlinks carry either an absolute ``expires=<epoch>`` or a
+    relative ``expires=8h`` anchored at ``time``/``timestamp``/``dstime``.
+    """
+    query = parse_qs(urlsplit(url).query)
+    expires = (query.get("expires") or query.get("x-expires") or [None])[0]
+    if not expires:
+        return None
+    match = DURATION_RE.match(expires.strip())
+    if not match:
+        return None
+    value, unit = int(match.group(1)), match.group(2).lower()
+    if not unit and value > 1_000_000_000:
+        return float(value)
+    issued = (query.get("time") or query.get("timestamp") or query.get("dstime") or [None])[0]
+    base = float(issued) if issued and issued.isdigit() else time.time()
+    return base + value * DURATION_UNITS[unit]
+
+
+def link_identity(url: str) -> str:
+    """Path and stable query parameters of a signed link: equal for every link to the same file.
+
+    Different files can share a path (``/rest/2.0/pcs/file?method=download&fid=1``),
+    so only the per-resolve signature parameters are dropped.
+    """
+    parts = urlsplit(url)
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    return f"{parts.path}?{urlencode(sorted((k, v) for k, v in params if k.lower() not in VOLATILE_PARAMS))}"
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value: ResolvedFile, expires_at: float) -> None:
+        self.value = value
+        self.expires_at = expires_at
+
+
+class ResolveCache:
+    """Bounded TTL + LRU cache of resolve results with single-flight de-duplication.
+
+    Entries are keyed by share URL and a hash of the cookie. Concurrent misses
+    for the same key share one upstream resolve instead of each starting one.
+    """
+
+    def __init__(self, max_entries: int, default_ttl: float, expiry_margin: float) -> None:
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.expiry_margin = expiry_margin
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._inflight: Dict[CacheKey, "asyncio.Task[ResolvedFile]"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key_for(req: ResolveRequest) -> CacheKey:
+        cookie_hash = hashlib.sha256((req.cookie or "").encode()).hexdigest()[:16]
+        return str(req.url), cookie_hash
+
+    def ttl_for(self, value: ResolvedFile) -> float:
+        ttl = self.default_ttl
+        expiry = dlink_expiry(str(value.direct_url))
+        if expiry is not None:
+            ttl = min(ttl, expiry - self.expiry_margin - time.time())
+        return ttl
+
+    def get(self, key: CacheKey) -> Optional[ResolvedFile]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key: CacheKey, value: ResolvedFile) -> None:
+        ttl = self.ttl_for(value)
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self._entries[key] = _Entry(value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: CacheKey) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def get_or_resolve(
+        self,
+        req: ResolveRequest,
+        resolver: Callable[[ResolveRequest], Awaitable[ResolvedFile]],
+    ) -> ResolvedFile:
+        key = self.key_for(req)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(resolver(req))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        # Shielded so a disconnecting caller does not cancel the shared resolve
+        return await asyncio.shield(task)
+
+    def _finish(self, key: CacheKey, task: "asyncio.Task[ResolvedFile]") -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.put(key, task.result())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "in_flight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+        }
+
+
+class LinkOrigins:
+    """Bounded LRU of the share URL each resolved direct link came from.
+
+    Kept well past the resolve cache's TTL so a download of an expired link
+    can still be resolved again from its share page. Links listed from a
+    folder share are marked as such, since resolving the share again only
+    yields its first file.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, bool]]" = OrderedDict()
+
+    def remember(self, direct_url: str, share_url: str, listed: bool = False) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[direct_url] = (share_url, listed)
+        self._entries.move_to_end(direct_url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, direct_url: str) -> Optional[str]:
+        entry = self._entries.get(direct_url)
+        return entry[0] if entry is not None else None
+
+    def listed(self, direct_url: str) -> bool:
+        """Whether ``direct_url`` is one file of a folder share."""
+        entry = self._entries.get(direct_url)
+        return entry is not None and entry[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+resolve_cache = ResolveCache(
+    max_entries=settings.resolve_cache_size,
+    default_ttl=settings.resolve_cache_ttl,
+    expiry_margin=settings.resolve_cache_expiry_margin,
+)
+
+link_origins = LinkOrigins(settings.link_origins_size)
+
+__all__ = ["ResolveCache", "LinkOrigins", "resolve_cache", "link_origins", "dlink_expiry", "link_identity"]
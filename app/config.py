@@ -0,0 +1,167 @@
+import os
+
+from pydantic import BaseModel, Field
+
+
+# Every field can be overridden with an environment variable named
+# TB_<FIELD_NAME_UPPERCASE>, e.g. TB_POOL_MAX_CONNECTIONS=200
+ENV_PREFIX = "TB_"
+
+
+class Settings(BaseModel):
+    # Shared upstream HTTP client pools
+    pool_max_connections: int = Field(100, ge=1, description="Max open connections per client pool")
+    pool_max_keepalive: int = Field(20, ge=0, description="Max idle keep-alive connections per client pool")
+    pool_keepalive_expiry: float = Field(30.0, ge=0, description="Seconds an idle connection is kept alive")
+    page_timeout_seconds: float = Field(25.0, gt=0, description="Default timeout for share page fetches")
+    cdn_timeout_seconds: float = Field(60.0, gt=0, description="Default timeout for CDN requests")
+
+    # In-process cache of resolve results
+    resolve_cache_size: int = Field(1024, ge=0, description="Max cached resolve results (0 disables caching)")
+    resolve_cache_ttl: float = Field(600.0, ge=0, description="Max seconds a resolve result is reused")
+    resolve_cache_expiry_margin: float = Field(
+        120.0, ge=0, description="Seconds before a signed dlink expires at which its cache entry is dropped"
+    )
+    resolve_hedge_delay: float = Field(
+        1.5, ge=0, description="Seconds before a hedged alternate resolve strategy starts (0 runs them in parallel)"
+    )
+
+    # Admission control and load shedding
+    client_rate: float = Field(10.0, ge=0, description="Requests per second allowed per client IP (0 disables)")
+    client_burst: float = Field(40.0, ge=1, description="Burst size of each client's token bucket")
+    trust_forwarded_for: bool = Field(
+        False, description="Identify clients by the last X-Forwarded-For hop (enable only behind one reverse proxy)"
+    )
+    resolve_host_concurrency: int = Field(16, ge=1, description="Max concurrent uncached resolves per share host")
+    download_host_concurrency: int = Field(32, ge=1, description="Max concurrent /download streams per CDN host")
+    admission_max_waiting: int = Field(256, ge=0, description="Max requests queued per budget before shedding with 503")
+    admission_wait_timeout: float = Field(10.0, ge=0, description="Max seconds a queued request waits for a slot")
+
+    # POST /resolve/batch
+    batch_max_items: int = Field(1000, ge=1, description="Max share links accepted in one batch")
+    batch_concurrency: int = Field(8, ge=1, description="Default concurrent resolves per batch")
+    batch_max_concurrency: int = Field(32, ge=1, description="Upper bound for a batch's requested concurrency")
+    batch_per_host_concurrency: int = Field(8, ge=1, description="Max concurrent batch resolves per share host")
+
+    # POST /resolve/files
+    folder_page_size: int = Field(100, ge=1, description="Default and max files returned per folder listing page")
+    folder_probe_concurrency: int = Field(8, ge=1, description="Default concurrent metadata probes per listing")
+    folder_max_probe_concurrency: int = Field(32, ge=1, description="Upper bound for a listing's probe concurrency")
+    folder_probe_host_concurrency: int = Field(
+        16, ge=1, description="Max concurrent listing probes per CDN host, across all listings"
+    )
+
+    # POST /download/zip
+    zip_max_files: int = Field(1000, ge=1, description="Max files in one /download/zip archive")
+    zip_prefetch: int = Field(
+        2, ge=0, description="Upstream requests opened ahead of the archive entry currently streaming"
+    )
+
+    # File metadata cache (HEAD /download, conditional requests)
+    file_meta_cache_size: int = Field(4096, ge=0, description="Max cached file metadata entries (0 disables)")
+    file_meta_ttl: float = Field(60.0, ge=0, description="Seconds file metadata is served without revalidation")
+    file_meta_stale: float = Field(
+        600.0, ge=0, description="Further seconds stale metadata is served while it is revalidated in the background"
+    )
+
+    # Range requests on /download
+    range_max_parts: int = Field(16, ge=1, description="Max ranges in one Range header; more are answered with 416")
+
+    # Egress shaping for /download and /download/zip bodies
+    bandwidth_limit: float = Field(0.0, ge=0, description="Total download egress in bytes per second (0 = unlimited)")
+    bandwidth_client_limit: float = Field(
+        0.0, ge=0, description="Download egress per client in bytes per second (0 = unlimited)"
+    )
+    bandwidth_burst: int = Field(1024 * 1024, ge=64 * 1024, description="Bytes a stream may send at once before pacing")
+    bandwidth_fair_per_client: bool = Field(
+        True, description="Share bandwidth equally between clients rather than between streams"
+    )
+
+    # Resuming broken or expired /download streams
+    download_resume_attempts: int = Field(
+        3, ge=0, description="Times one /download stream is reopened at its current offset after a break (0 disables)"
+    )
+    link_origins_size: int = Field(
+        16384, ge=0, description="Max resolved direct links remembered with their share URL for re-resolving"
+    )
+
+    # Segmented (multi-connection) upstream fetching for /download?accelerate=true
+    segment_size: int = Field(4 * 1024 * 1024, ge=64 * 1024, description="Bytes per upstream range request")
+    segment_initial_connections: int = Field(2, ge=1, description="Parallel range requests a download starts with")
+    segment_max_connections: int = Field(8, ge=1, description="Max parallel range requests per download")
+    segment_memory_limit: int = Field(
+        64 * 1024 * 1024, ge=64 * 1024, description="Max bytes buffered for reordering per download"
+    )
+    segment_retries: int = Field(2, ge=0, description="Retries for a failed segment before the download aborts")
+
+    # /download byte relay
+    relay_raw: bool = Field(True, description="Relay upstream bytes undecoded, keeping their Content-Encoding")
+    relay_read_size: int = Field(256 * 1024, ge=4096, description="Max bytes per upstream socket read on CDN connections (HTTP/1.1)")
+    relay_chunk_size: int = Field(256 * 1024, ge=1024, description="Max bytes per chunk handed to the server")
+    relay_flush_interval: float = Field(
+        0.05, ge=0, description="Max seconds small upstream reads are held back to be coalesced"
+    )
+
+    # On-disk chunk cache for /download
+    download_cache_dir: str = Field("", description="Directory for cached download chunks (empty disables the cache)")
+    download_cache_max_bytes: int = Field(
+        10 * 1024 * 1024 * 1024, ge=0, description="Max bytes of cached chunks before LRU eviction"
+    )
+    download_cache_chunk_size: int = Field(
+        4 * 1024 * 1024, ge=64 * 1024, description="Bytes per cached chunk (changing it orphans existing chunks)"
+    )
+
+    # Background fetch jobs (POST /jobs)
+    job_dir: str = Field("", description="Directory for job state and fetched files (empty disables the job API)")
+    job_workers: int = Field(2, ge=1, description="Jobs fetched at once")
+    job_max_queued: int = Field(100, ge=1, description="Max jobs waiting for a worker before submissions are shed")
+    job_checkpoint_bytes: int = Field(
+        16 * 1024 * 1024, ge=64 * 1024, description="Bytes fetched between durable checkpoints of a job"
+    )
+    job_retries: int = Field(
+        5, ge=0, description="Failed attempts in a row (without progress) before a job is given up"
+    )
+    job_retention: float = Field(86400.0, ge=0, description="Seconds finished jobs and their files are kept")
+    job_event_interval: float = Field(0.5, ge=0, description="Min seconds between progress events of one job")
+
+    # Logging
+    log_level: str = Field("INFO", description="Minimum level written to the log")
+    log_json: bool = Field(False, description="Write one JSON object per log line instead of colored text")
+    log_enqueue: bool = Field(True, description="Write log lines from a background thread instead of the event loop")
+    log_queue_size: int = Field(
+        10000, ge=1, description="Max log lines waiting for the writer thread; further lines are dropped"
+    )
+    log_access: bool = Field(True, description="Log one access line per HTTP request with its duration and stage timings")
+    log_noisy_rate: float = Field(
+        5.0, ge=0, description="Max per-attempt messages logged per second for each message kind (0 logs all)"
+    )
+
+    # Instrumentation
+    profile_sample_rate: float = Field(
+        0.0, ge=0, le=1, description="Fraction of requests profiled with cProfile (0 disables profiling)"
+    )
+    profile_dir: str = Field("profiles", description="Directory for sampled request profiles (.prof files)")
+
+    # Headless browser fallback (Playwright)
+    browser_enabled: bool = Field(True, description="Allow the browser fallback for requests with use_browser")
+    browser_prewarm: bool = Field(False, description="Launch the browser at startup instead of on first use")
+    browser_max_pages: int = Field(2, ge=1, description="Max concurrently open browser pages")
+    browser_max_waiting: int = Field(4, ge=0, description="Max resolves queued for a browser page before shedding")
+    browser_context_max_uses: int = Field(20, ge=1, description="Resolves served by a browser context before it is recycled")
+    browser_max_idle_contexts: int = Field(4, ge=0, description="Max idle browser contexts kept for reuse")
+    browser_selector_timeout: float = Field(5.0, gt=0, description="Seconds to wait for any download button to appear")
+    browser_click_wait: float = Field(3.0, ge=0, description="Seconds to wait for a download request after a click")
+
+
+def load_settings() -> Settings:
+    overrides = {}
+    for name in Settings.model_fields:
+        value = os.environ.get(f"{ENV_PREFIX}{name.upper()}")
+        if value is not None:
+            overrides[name] = value
+    return Settings(**overrides)
+
+
+settings = load_settings()
+
+__all__ = ["Settings", "load_settings", "settings"]
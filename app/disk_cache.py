@@ -0,0 +1,469 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import re
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, NamedTuple
+from urllib.parse import urlsplit
+
+import aiofiles
+import httpx
+
+from .cache import link_identity
+from .config import settings
+from .file_meta import file_metadata
+from .logger import logger
+from .ranges import single_range
+
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+)", re.IGNORECASE)
+
+# Cached chunks are relayed as memoryview slices of at most this size
+READ_SLICE = 1024 * 1024
+
+
+def url_key(url: str, cookie: Optional[str] = None) -> str:
+    """Identity of the file behind a signed link: host and :func:`link_identity`, plus the cookie.
+
+    The cookie hash keeps files fetched with one account from being served
+    to another.
+    """
+    cookie_hash = hashlib.sha256((cookie or "").encode()).hexdigest()[:16]
+    return f"{(urlsplit(url).hostname or '').lower()}{link_identity(url)}#{cookie_hash}"
+
+
+class FileMeta:
+    __slots__ = ("key", "url_key", "size", "validator", "content_type", "filename", "etag", "last_modified")
+
+    def __init__(
+        self,
+        url_key: str,
+        size: int,
+        validator: str,
+        content_type: Optional[str],
+        filename: Optional[str],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        self.url_key = url_key
+        self.size = size
+        self.validator = validator
+        self.content_type = content_type
+        self.filename = filename
+        # Replayed on cached responses, so clients can keep using If-Range and conditional requests
+        self.etag = etag
+        self.last_modified = last_modified
+        # Content address: a changed file (new size or ETag) never reuses old chunks
+        self.key = hashlib.sha256(f"{url_key}\n{size}\n{validator}".encode()).hexdigest()[:32]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url_key": self.url_key,
+            "size": self.size,
+            "validator": self.validator,
+            "content_type": self.content_type,
+            "filename": self.filename,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+        }
+
+    def validator_headers(self) -> Dict[str, str]:
+        etag, last_modified = self.etag, self.last_modified
+        if not (etag or last_modified):
+            # Written by an older version, which kept only the validator the key is based on
+            if self.validator.startswith(('"', "W/")):
+                etag = self.validator
+            else:
+                last_modified = self.validator
+        return {k: v for k, v in (("ETag", etag), ("Last-Modified", last_modified)) if v}
+
+
+class CachedRead(NamedTuple):
+    meta: FileMeta
+    start: int
+    end: int
+    body: AsyncIterator[bytes]
+    upstream: Optional[httpx.Response]
+
+    async def aclose(self) -> None:
+        # The first gap's upstream response is opened before streaming starts
+        if self.upstream is not None:
+            await self.upstream.aclose()
+
+
+class ChunkCache:
+    """Content-addressed on-disk cache of fixed-size file chunks for /download.
+
+    Files are identified by their URL without query string plus size and
+    ETag (or Last-Modified). Chunks fill from upstream as downloads pass
+    through, are served from memory-mapped files, and are evicted LRU once the
+    cache holds more than ``max_bytes``. Ranges that are only partly cached are
+    stitched together with chunk-aligned upstream fetches.
+    """
+
+    def __init__(self, directory: str, chunk_size: int, max_bytes: int) -> None:
+        self.directory = Path(directory) if directory else None
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self._files: Dict[str, FileMeta] = {}
+        self._chunks: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes_from_disk = 0
+        self.bytes_from_upstream = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None and self.max_bytes > 0
+
+    async def start(self) -> None:
+        """Index chunks left on disk by a previous run."""
+        if self.enabled:
+            await asyncio.to_thread(self._scan)
+
+    def _scan(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        found: List[Tuple[float, str, int, int]] = []
+        for file_dir in self.directory.iterdir():
+            try:
+                meta = FileMeta(**json.loads((file_dir / "meta.json").read_text()))
+            except (OSError, ValueError, TypeError):
+                continue
+            if meta.key != file_dir.name:
+                continue
+            self._files[meta.url_key] = meta
+            for path in file_dir.iterdir():
+                if path.suffix == ".tmp":
+                    path.unlink(missing_ok=True)
+                elif path.suffix == ".chunk" and path.stem.isdigit():
+                    st = path.stat()
+                    found.append((st.st_mtime, meta.key, int(path.stem), st.st_size))
+        for _, key, index, size in sorted(found):
+            self._chunks[(key, index)] = size
+            self.total_bytes += size
+        self._evict()
+        logger.info(f"Download cache: {len(self._chunks)} chunks, {self.total_bytes} bytes in {self.directory}")
+
+    def _chunk_path(self, meta: FileMeta, index: int) -> Path:
+        return self.directory / meta.key / f"{index}.chunk"
+
+    def _chunk_length(self, meta: FileMeta, index: int) -> int:
+        return min(self.chunk_size, meta.size - index * self.chunk_size)
+
+    def lookup(self, url: str, cookie: Optional[str]) -> Optional[FileMeta]:
+        return self._files.get(url_key(url, cookie)) if self.enabled else None
+
+    def describe(self, url: str, cookie: Optional[str], resp: httpx.Response) -> Optional[FileMeta]:
+        """Cache identity of an upstream response, or None if it cannot be cached safely."""
+        if not self.enabled or resp.headers.get("content-encoding", "identity").lower() != "identity":
+            return None
+        validator = resp.headers.get("etag") or resp.headers.get("last-modified")
+        if not validator:
+            return None
+        if resp.status_code == 206:
+            match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+            if not match:
+                return None
+            size = int(match.group(3))
+        elif resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+            size = int(resp.headers["content-length"])
+        else:
+            return None
+        if not size:
+            return None
+        from .resolver import _filename_from_headers
+
+        meta = FileMeta(
+            url_key(url, cookie),
+            size,
+            validator,
+            resp.headers.get("content-type"),
+            _filename_from_headers(resp.headers),
+            resp.headers.get("etag"),
+            resp.headers.get("last-modified"),
+        )
+        known = self._files.get(meta.url_key)
+        if known is not None and known.key == meta.key:
+            return known
+        if known is not None:
+            self.invalidate(known)
+        self._files[meta.url_key] = meta
+        self.misses += 1
+        return meta
+
+    def invalidate(self, meta: FileMeta) -> None:
+        """Forget a file whose upstream content changed."""
+        self.invalidations += 1
+        if self._files.get(meta.url_key) is meta:
+            del self._files[meta.url_key]
+        for key in [k for k in self._chunks if k[0] == meta.key]:
+            self._drop(key)
+
+    def _drop(self, key: Tuple[str, int]) -> None:
+        self.total_bytes -= self._chunks.pop(key)
+        try:
+            os.unlink(self.directory / key[0] / f"{key[1]}.chunk")
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self._chunks:
+            self._drop(next(iter(self._chunks)))
+            self.evictions += 1
+
+    async def _store(self, meta: FileMeta, index: int, data: bytes) -> None:
+        file_dir = self.directory / meta.key
+        # Write under a unique name and rename, so readers never see a partial chunk
+        tmp = file_dir / f"{index}.{uuid.uuid4().hex}.tmp"
+        try:
+            if not file_dir.exists():
+                file_dir.mkdir(parents=True, exist_ok=True)
+                async with aiofiles.open(file_dir / "meta.json", "w") as f:
+                    await f.write(json.dumps(meta.to_dict()))
+            async with aiofiles.open(tmp, "wb") as f:
+                await f.write(data)
+            os.replace(tmp, self._chunk_path(meta, index))
+        except BaseException as e:
+            # Also on cancellation (the client went away mid-write): never leave the partial file behind
+            tmp.unlink(missing_ok=True)
+            if not isinstance(e, Exception):
+                raise
+            logger.warning(f"Could not store chunk {index} of {meta.key}: {e}")
+            return
+        key = (meta.key, index)
+        if key in self._chunks:
+            self.total_bytes -= self._chunks.pop(key)
+        self._chunks[key] = len(data)
+        self.total_bytes += len(data)
+        self.stores += 1
+        self._evict()
+
+    def _map(self, meta: FileMeta, index: int) -> Optional[mmap.mmap]:
+        key = (meta.key, index)
+        if key not in self._chunks:
+            return None
+        try:
+            with open(self._chunk_path(meta, index), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._drop(key)
+            return None
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        self._chunks.move_to_end(key)
+        return mapped
+
+    def wrap(
+        self, url: str, cookie: Optional[str], resp: httpx.Response, body: AsyncIterator[bytes]
+    ) -> AsyncIterator[bytes]:
+        """Store the chunks an ordinary proxied download passes through, if it is cacheable."""
+        meta = self.describe(url, cookie, resp)
+        if meta is None:
+            return body
+        match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+        pos = int(match.group(1)) if resp.status_code == 206 and match else 0
+        return self.tee(meta, body, pos, pos, meta.size - 1)
+
+    async def tee(self, meta: FileMeta, body: AsyncIterator[bytes], pos: int, start: int, end: int) -> AsyncIterator[bytes]:
+        """Relay the ``start``-``end`` part of an upstream body that begins at offset ``pos``.
+
+        Every whole chunk the body passes through is stored on the way,
+        before the bytes that complete it are relayed: a client closes the
+        connection as soon as it has them, which would cancel a later store.
+        """
+        index = -(-pos // self.chunk_size)
+        buffer = bytearray() if pos == index * self.chunk_size else None
+        async for data in body:
+            chunk_start = pos
+            pos += len(data)
+            self.bytes_from_upstream += len(data)
+            if buffer is not None:
+                buffer += data
+            elif pos > index * self.chunk_size:
+                # Skip up to the first chunk boundary inside the body
+                buffer = bytearray(data[index * self.chunk_size - chunk_start :])
+            while buffer and index * self.chunk_size < meta.size and len(buffer) >= self._chunk_length(meta, index):
+                length = self._chunk_length(meta, index)
+                if (meta.key, index) not in self._chunks:
+                    await self._store(meta, index, bytes(buffer[:length]))
+                del buffer[:length]
+                index += 1
+            if chunk_start <= end and pos > start:
+                yield data[max(0, start - chunk_start) : end - chunk_start + 1]
+
+    async def _open_run(
+        self, meta: FileMeta, client: httpx.AsyncClient, url: str, headers: Dict[str, str], first: int, last: int
+    ) -> Optional[httpx.Response]:
+        """Start a streamed upstream fetch of chunks ``first``..``last``; None if it cannot be used."""
+        span = f"bytes={first * self.chunk_size}-{min((last + 1) * self.chunk_size, meta.size) - 1}"
+        try:
+            resp = await client.send(client.build_request("GET", url, headers={**headers, "Range": span}), stream=True)
+        except httpx.HTTPError as e:
+            logger.warning(f"Upstream fetch for cached file {meta.key} failed: {e}")
+            return None
+        if resp.status_code != 206:
+            await resp.aclose()
+            return None
+        match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+        validator = resp.headers.get("etag") or resp.headers.get("last-modified")
+        if not match or int(match.group(3)) != meta.size or (validator and validator != meta.validator):
+            logger.info(f"Upstream content of {meta.url_key} changed; dropping cached chunks")
+            self.invalidate(meta)
+            await resp.aclose()
+            return None
+        return resp
+
+    def _runs(self, meta: FileMeta, first: int, last: int) -> List[Tuple[bool, int, int]]:
+        # Consecutive chunks grouped into (cached, first, last) runs
+        runs: List[Tuple[bool, int, int]] = []
+        for index in range(first, last + 1):
+            cached = (meta.key, index) in self._chunks
+            if runs and runs[-1][0] == cached:
+                runs[-1] = (cached, runs[-1][1], index)
+            else:
+                runs.append((cached, index, index))
+        return runs
+
+    async def _revalidate(self, meta: FileMeta, url: str, cookie: Optional[str], headers: Dict[str, str]) -> bool:
+        """Whether the link still serves the cached file, checked against (cached) upstream metadata.
+
+        A link the CDN rejects, or whose signature has expired, never gets
+        cached bytes, and a file with another size or validator is dropped.
+        """
+        probe = {k: v for k, v in headers.items() if k.lower() not in ("range", "if-range")}
+        probe["Accept-Encoding"] = "identity"
+        info, _ = await file_metadata.get(url, cookie, probe)
+        if info is None:
+            return False
+        if info.size != meta.size or (info.etag or info.last_modified) != meta.validator:
+            logger.info(f"Upstream content of {meta.url_key} changed; dropping cached chunks")
+            self.invalidate(meta)
+            return False
+        return True
+
+    async def open(
+        self,
+        url: str,
+        cookie: Optional[str],
+        client: httpx.AsyncClient,
+        headers: Dict[str, str],
+        range_header: Optional[str],
+    ) -> Optional[CachedRead]:
+        """Serve a download of a known file from cached chunks plus upstream fetches for the gaps.
+
+        Returns None when the file is unknown, the range is not a single
+        satisfiable range, or upstream no longer serves the cached file at
+        this link; the caller then proxies the request as usual.
+        """
+        meta = self.lookup(url, cookie)
+        if meta is None:
+            return None
+        span = single_range(range_header, meta.size)
+        if span is None:
+            return None
+        start, end = span
+        runs = self._runs(meta, start // self.chunk_size, end // self.chunk_size)
+        first_fetch = None
+        gaps = [run for run in runs if not run[0]]
+        if gaps:
+            # Open the first upstream fetch before answering, so link errors still surface as a status
+            first_fetch = await self._open_run(meta, client, url, headers, gaps[0][1], gaps[0][2])
+            if first_fetch is None:
+                return None
+            self.partial_hits += 1
+        elif await self._revalidate(meta, url, cookie, headers):
+            self.hits += 1
+        else:
+            return None
+        body = self._stream(meta, client, url, headers, runs, start, end, first_fetch)
+        return CachedRead(meta, start, end, body, first_fetch)
+
+    async def _stream(
+        self,
+        meta: FileMeta,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        runs: List[Tuple[bool, int, int]],
+        start: int,
+        end: int,
+        first_fetch: Optional[httpx.Response],
+    ) -> AsyncIterator[bytes]:
+        pending = first_fetch
+        try:
+            for cached, first, last in runs:
+                if not cached:
+                    resp, pending = pending, None
+                    async for data in self._fetch(meta, client, url, headers, first, last, start, end, resp):
+                        yield data
+                    continue
+                for index in range(first, last + 1):
+                    mapped = self._map(meta, index)
+                    if mapped is None:
+                        # Evicted since the plan was made: fetch just this chunk
+                        async for data in self._fetch(meta, client, url, headers, index, index, start, end, None):
+                            yield data
+                        continue
+                    base = index * self.chunk_size
+                    lo, hi = max(start - base, 0), min(end - base + 1, self._chunk_length(meta, index))
+                    view = memoryview(mapped)
+                    for offset in range(lo, hi, READ_SLICE):
+                        piece = view[offset : min(offset + READ_SLICE, hi)]
+                        self.bytes_from_disk += len(piece)
+                        yield piece
+        finally:
+            if pending is not None:
+                await pending.aclose()
+
+    async def _fetch(
+        self,
+        meta: FileMeta,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        first: int,
+        last: int,
+        start: int,
+        end: int,
+        resp: Optional[httpx.Response],
+    ) -> AsyncIterator[bytes]:
+        if resp is None:
+            resp = await self._open_run(meta, client, url, headers, first, last)
+            if resp is None:
+                raise ValueError(f"upstream no longer serves cached file {meta.url_key}")
+        try:
+            async for data in self.tee(meta, resp.aiter_bytes(), first * self.chunk_size, start, end):
+                yield data
+        finally:
+            await resp.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "files": len(self._files),
+            "chunks": len(self._chunks),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "bytes_from_disk": self.bytes_from_disk,
+            "bytes_from_upstream": self.bytes_from_upstream,
+        }
+
+
+download_cache = ChunkCache(settings.download_cache_dir, settings.download_cache_chunk_size, settings.download_cache_max_bytes)
+
+__all__ = ["ChunkCache", "FileMeta", "CachedRead", "download_cache"]
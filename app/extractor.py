@@ -0,0 +1,278 @@
+import json
+import re
+from typing import Optional, Any, Iterator, NamedTuple, Tuple, List, Dict
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+
+    DOM_PARSER = "lxml"
+except ImportError:
+    DOM_PARSER = "html.parser"
+
+
+# Substrings that mark a URL as a likely download link
+URL_KEYWORDS = ("download", "d.terabox", "baidupcs", "terabox.com/s/")
+# JSON values and DOM attributes do not accept bare share links
+STRICT_URL_KEYWORDS = ("download", "d.terabox", "baidupcs")
+
+
+class PagePattern(NamedTuple):
+    # Literal that every match contains; the pattern is skipped when it is absent
+    marker: str
+    # Compiled against the lowercased page: literal-prefixed, case-sensitive
+    # patterns are several times faster than re.IGNORECASE in CPython's engine
+    lowered: "re.Pattern[str]"
+    # Fallback for pages whose lowercased form changes length (offsets would drift)
+    folded: "re.Pattern[str]"
+    description: str
+
+
+def _page_pattern(marker: str, pattern: str, description: str) -> PagePattern:
+    return PagePattern(marker, re.compile(pattern), re.compile(pattern, re.IGNORECASE), description)
+
+
+# Page-wide patterns in priority order: any match of an earlier pattern wins
+# over every match of a later one, regardless of position in the page
+PAGE_PATTERNS = [
+    _page_pattern("/file/", r'(https?://[^\s"\']+?/file/[^\s"\']+)', "Direct file pattern"),
+    _page_pattern("/share/link", r'(https?://[^\s"\']+?/share/link[^\s"\']+)', "Share link pattern"),
+    _page_pattern('"dlink"', r'"dlink"\s*:\s*"([^"]+)"', "DLink in JSON"),
+    _page_pattern("downloadurl", r'downloadurl\s*[=:]\s*["\']([^"\']+)["\']', "downloadUrl in JS"),
+]
+
+SCRIPT_RE = re.compile(r"<script[^>]*>([\s\S]*?)</script>")
+QUOTED_URL_RE = re.compile(r'["\'](https?://[^"\'\s]+)["\']')
+WINDOW_DATA_RE = re.compile(r"\s*window\.data\s*=\s*(?=[{\[])")
+# Pre-check before building a DOM (run on the lowercased page): a tag can only
+# match if some src/href value starts with http and contains a keyword
+DOM_HINT_RE = re.compile(
+    r'(?:src|href)\s*=\s*(?:"http[^"]*?|\'http[^\']*?|http[^\s>]*?)(?:download|d\.terabox|baidupcs)'
+)
+DOM_TAGS = ["iframe", "embed", "source", "a"]
+
+# Keys of a file entry in embedded share state (window.data file_list, __NEXT_DATA__ files)
+FILE_LINK_KEYS = ("dlink", "downloadUrl", "download_url", "down_url")
+FILE_NAME_KEYS = ("server_filename", "filename", "name")
+FILE_SIZE_KEYS = ("size", "file_size")
+
+
+class LinkMatch(NamedTuple):
+    url: str
+    source: str
+
+
+class SharedFile(NamedTuple):
+    url: str
+    filename: Optional[str]
+    size: Optional[int]
+    path: Optional[str]
+
+
+def _has_keyword(url: str, keywords: Tuple[str, ...]) -> bool:
+    lowered = url.lower()
+    return any(x in lowered for x in keywords)
+
+
+def _iter_json_urls(node: Any, path: str = "", in_url_key: bool = False) -> Iterator[Tuple[str, str]]:
+    """Yield (path, value) for string leaves whose dotted key path mentions 'url', in document order."""
+    if isinstance(node, dict):
+        for k, v in node.items():
+            yield from _iter_json_urls(v, f"{path}{k}.", in_url_key or "url" in str(k).lower())
+    elif isinstance(node, list):
+        for i, v in enumerate(node):
+            yield from _iter_json_urls(v, f"{path}{i}.", in_url_key)
+    elif in_url_key and isinstance(node, str):
+        yield path[:-1], node
+
+
+def _first(entry: Dict[str, Any], keys: Tuple[str, ...], kind: type) -> Any:
+    for key in keys:
+        value = entry.get(key)
+        if isinstance(value, kind) and not isinstance(value, bool):
+            return value
+    return None
+
+
+def _iter_file_entries(node: Any) -> Iterator[Dict[str, Any]]:
+    """Yield dicts that carry a download link, in document order, without descending into them."""
+    if isinstance(node, dict):
+        link = _first(node, FILE_LINK_KEYS, str)
+        if link and link.startswith("http"):
+            yield node
+            return
+        for v in node.values():
+            yield from _iter_file_entries(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from _iter_file_entries(v)
+
+
+class PageScanner:
+    """Scans a share page chunk by chunk as it arrives, for a decisive link match.
+
+    Only the first page pattern can decide before the whole page is known:
+    later patterns and the script and DOM scans apply only when no earlier
+    pattern matches anywhere in the page. A match is accepted once the
+    character after it has arrived, so a URL split across chunks is never
+    cut short. Matches cannot contain whitespace or quotes, so each chunk is
+    scanned together with the text after the last such delimiter seen before
+    it. Returns the same link that :meth:`LinkExtractor.extract` would find
+    on the full page, or ``None`` until the page is complete.
+    """
+
+    def __init__(self) -> None:
+        self._parts: List[str] = []
+        # Unscanned tail (lowercased and original) starting at the last delimiter
+        self._lowered = ""
+        self._tail = ""
+        self._aligned = True
+        self.chars = 0
+
+    def feed(self, chunk: str) -> Optional[LinkMatch]:
+        self._parts.append(chunk)
+        self.chars += len(chunk)
+        if not self._aligned:
+            return None
+        lowered = chunk.lower()
+        if len(lowered) != len(chunk):
+            # Offsets would drift; leave this page to the full scan
+            self._aligned = False
+            return None
+        lowered = self._lowered + lowered
+        tail = self._tail + chunk
+        pattern = PAGE_PATTERNS[0]
+        if pattern.marker in lowered:
+            for match in pattern.lowered.finditer(lowered):
+                start, end = match.span(1)
+                if end == len(lowered):
+                    # The URL may continue in the next chunk
+                    break
+                if any(x in lowered[start:end] for x in URL_KEYWORDS):
+                    return LinkMatch(tail[start:end], pattern.description)
+        cut = max(lowered.rfind(c) for c in ' \n\r\t"\'')
+        self._lowered, self._tail = lowered[max(cut, 0):], tail[max(cut, 0):]
+        return None
+
+    @property
+    def html(self) -> str:
+        """Everything fed so far."""
+        return "".join(self._parts)
+
+
+class LinkExtractor:
+    """Finds the direct download URL embedded in a TeraBox share page.
+
+    Stages run cheapest first and mirror the original resolver's priority:
+    page-wide patterns over a single lowercased copy of the page, then
+    per-script quoted URLs and embedded JSON state (``__NEXT_DATA__``,
+    ``window.data``), then a DOM scan of iframe/embed/source/a tags that only
+    runs when some src/href attribute could match.
+    """
+
+    def extract(self, html: str) -> Optional[LinkMatch]:
+        lowered = html.lower()
+        return self.scan_page(html, lowered) or self.scan_scripts(html) or self.scan_dom(html, lowered)
+
+    def scan_page(self, html: str, lowered: Optional[str] = None) -> Optional[LinkMatch]:
+        if lowered is None:
+            lowered = html.lower()
+        aligned = len(lowered) == len(html)
+        for pattern in PAGE_PATTERNS:
+            if pattern.marker not in lowered:
+                continue
+            matches = pattern.lowered.finditer(lowered) if aligned else pattern.folded.finditer(html)
+            for match in matches:
+                start, end = match.span(1)
+                candidate = lowered[start:end] if aligned else match.group(1).lower()
+                if any(x in candidate for x in URL_KEYWORDS):
+                    return LinkMatch(html[start:end] if aligned else match.group(1), pattern.description)
+        return None
+
+    def scan_scripts(self, html: str) -> Optional[LinkMatch]:
+        for script in SCRIPT_RE.finditer(html):
+            body = script.group(1)
+            stripped = body.strip()
+            if not stripped:
+                continue
+
+            for match in QUOTED_URL_RE.finditer(body):
+                url = match.group(1)
+                if _has_keyword(url, URL_KEYWORDS):
+                    return LinkMatch(url, "URL in script")
+
+            data = self._script_json(body, stripped)
+            if data is None:
+                continue
+            for key, value in _iter_json_urls(data):
+                if "http" in value and _has_keyword(value, STRICT_URL_KEYWORDS):
+                    return LinkMatch(value, f"JSON data at {key}")
+        return None
+
+    @staticmethod
+    def _script_json(body: str, stripped: str) -> Any:
+        try:
+            if stripped[0] in "{[":
+                return json.loads(stripped)
+            state = WINDOW_DATA_RE.match(body)
+            if state:
+                return json.JSONDecoder().raw_decode(body, state.end())[0]
+        except ValueError:
+            pass
+        return None
+
+    def file_list(self, html: str) -> List[SharedFile]:
+        """Every file listed in the page's embedded state, in page order and de-duplicated by URL.
+
+        Folder shares embed one entry per file (``window.data.file_list``,
+        ``__NEXT_DATA__`` ``files``); folders themselves carry no link and are
+        skipped.
+        """
+        files: List[SharedFile] = []
+        seen = set()
+        for script in SCRIPT_RE.finditer(html):
+            body = script.group(1)
+            if "dlink" not in body and "ownload" not in body:
+                continue
+            stripped = body.strip()
+            data = self._script_json(body, stripped) if stripped else None
+            if data is None:
+                continue
+            for entry in _iter_file_entries(data):
+                url = _first(entry, FILE_LINK_KEYS, str)
+                if url in seen or entry.get("isdir") in (1, "1", True):
+                    continue
+                seen.add(url)
+                size = _first(entry, FILE_SIZE_KEYS, int)
+                if size is None and str(entry.get("size", "")).isdigit():
+                    size = int(entry["size"])
+                files.append(SharedFile(url, _first(entry, FILE_NAME_KEYS, str), size, _first(entry, ("path",), str)))
+        return files
+
+    def scan_dom(self, html: str, lowered: Optional[str] = None) -> Optional[LinkMatch]:
+        if not DOM_HINT_RE.search(lowered if lowered is not None else html.lower()):
+            return None
+        soup = BeautifulSoup(html, DOM_PARSER, parse_only=SoupStrainer(DOM_TAGS))
+        for tag in soup.find_all(DOM_TAGS):
+            url = tag.get("src") or tag.get("href")
+            if not url or not isinstance(url, str):
+                continue
+            if url.startswith("http") and _has_keyword(url, STRICT_URL_KEYWORDS):
+                return LinkMatch(url, f"{tag.name} tag")
+        return None
+
+
+link_extractor = LinkExtractor()
+
+__all__ = [
+    "LinkExtractor",
+    "LinkMatch",
+    "PageScanner",
+    "SharedFile",
+    "PagePattern",
+    "PAGE_PATTERNS",
+    "link_extractor",
+    "URL_KEYWORDS",
+    "STRICT_URL_KEYWORDS",
+]
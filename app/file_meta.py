@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Tuple, Mapping, Set
+
+import httpx
+
+from .cache import dlink_expiry
+from .config import settings
+from .http_clients import get_cdn_client
+from .logger import logger
+
+
+MetaKey = Tuple[str, str]
+
+CONTENT_RANGE_TOTAL_RE = re.compile(r"^bytes\s+(?:\d+-\d+|\*)/(\d+)$")
+# Upstream headers kept per file and replayed on HEAD responses
+KEPT_HEADERS = ("content-type", "etag", "last-modified", "accept-ranges", "content-disposition")
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+class FileInfo:
+    """What the CDN reported about one file: full size plus the headers in KEPT_HEADERS."""
+
+    __slots__ = ("size", "headers", "fetched_at", "expires_at")
+
+    def __init__(self, size: int, headers: Dict[str, str], expires_at: Optional[float]) -> None:
+        self.size = size
+        self.headers = headers
+        self.fetched_at = time.monotonic()
+        # Wall-clock expiry of the signed link, if it carries one
+        self.expires_at = expires_at
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.headers.get("etag")
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.headers.get("last-modified")
+
+    @property
+    def filename(self) -> Optional[str]:
+        from .resolver import _filename_from_headers
+
+        return _filename_from_headers(httpx.Headers(self.headers))
+
+    def not_modified(self, request_headers: Mapping[str, str]) -> bool:
+        """Whether a conditional GET/HEAD can be answered with 304 (RFC 7232 section 6)."""
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            if not self.etag:
+                return False
+            if if_none_match.strip() == "*":
+                return True
+            # Weak comparison
+            return _opaque(self.etag) in {_opaque(tag) for tag in if_none_match.split(",")}
+        since = _http_date(request_headers.get("if-modified-since"))
+        modified = _http_date(self.last_modified)
+        return since is not None and modified is not None and modified <= since
+
+    def if_range_matches(self, value: str) -> bool:
+        """Whether an ``If-Range`` validator still names this representation (strong comparison)."""
+        value = value.strip()
+        if value.startswith('"') or value.startswith("W/"):
+            return bool(self.etag) and not self.etag.startswith("W/") and value == self.etag
+        return bool(self.last_modified) and value == self.last_modified
+
+    def validator_headers(self) -> Dict[str, str]:
+        return {k: v for k, v in (("ETag", self.etag), ("Last-Modified", self.last_modified)) if v}
+
+
+def describe(resp: httpx.Response) -> Optional[FileInfo]:
+    """FileInfo from a successful upstream response, or None if it does not reveal the size."""
+    if resp.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    if resp.status_code == 206:
+        match = CONTENT_RANGE_TOTAL_RE.match(resp.headers.get("content-range", ""))
+        if not match:
+            return None
+        size = int(match.group(1))
+    elif resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+        size = int(resp.headers["content-length"])
+    else:
+        return None
+    headers = {name: resp.headers[name] for name in KEPT_HEADERS if name in resp.headers}
+    if resp.status_code == 206:
+        headers.setdefault("accept-ranges", "bytes")
+    return FileInfo(size, headers, dlink_expiry(str(resp.url)))
+
+
+class MetadataCache:
+    """Bounded LRU of file metadata keyed by direct URL and cookie, with stale-while-revalidate.
+
+    Filled by resolve probes and /download responses, and used to answer
+    HEAD and conditional requests without contacting the CDN. Entries are
+    fresh for ``ttl`` seconds. For ``stale`` seconds after that they are
+    still served while one background request revalidates them. Nothing is
+    served past the signed link's own expiry.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, stale: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale = stale
+        self._entries: "OrderedDict[MetaKey, FileInfo]" = OrderedDict()
+        self._inflight: Dict[MetaKey, "asyncio.Task[Tuple[Optional[FileInfo], Optional[int]]]"] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.probe_failures = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def key_for(url: str, cookie: Optional[str]) -> MetaKey:
+        cookie_hash = hashlib.sha256((cookie or "").encode()).hexdigest()[:16]
+        return url, cookie_hash
+
+    def store(self, url: str, cookie: Optional[str], resp: httpx.Response) -> Optional[FileInfo]:
+        info = describe(resp)
+        if info is not None and self.max_entries > 0:
+            key = self.key_for(url, cookie)
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return info
+
+    def lookup(self, url: str, cookie: Optional[str], headers: Dict[str, str]) -> Optional[FileInfo]:
+        """A cached entry, scheduling a background revalidation (with ``headers``) when it is stale."""
+        key = self.key_for(url, cookie)
+        info = self._entries.get(key)
+        if info is None:
+            return None
+        age = time.monotonic() - info.fetched_at
+        if age > self.ttl + self.stale or (info.expires_at is not None and info.expires_at <= time.time()):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        if age > self.ttl:
+            self.stale_hits += 1
+            if key not in self._inflight:
+                self.revalidations += 1
+                task = self._probe(key, url, cookie, headers)
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+        else:
+            self.hits += 1
+        return info
+
+    async def get(
+        self, url: str, cookie: Optional[str], headers: Dict[str, str]
+    ) -> Tuple[Optional[FileInfo], Optional[int]]:
+        """Cached metadata, or one upstream probe shared by concurrent callers.
+
+        Returns the metadata, or None and the upstream status (None if
+        upstream could not be reached).
+        """
+        info = self.lookup(url, cookie, headers)
+        if info is not None:
+            return info, None
+        self.misses += 1
+        key = self.key_for(url, cookie)
+        task = self._inflight.get(key) or self._probe(key, url, cookie, headers)
+        return await asyncio.shield(task)
+
+    def _probe(
+        self, key: MetaKey, url: str, cookie: Optional[str], headers: Dict[str, str]
+    ) -> "asyncio.Task[Tuple[Optional[FileInfo], Optional[int]]]":
+        task = asyncio.ensure_future(self._fetch(url, cookie, headers))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        return task
+
+    async def _fetch(
+        self, url: str, cookie: Optional[str], headers: Dict[str, str]
+    ) -> Tuple[Optional[FileInfo], Optional[int]]:
+        client = get_cdn_client()
+        status = None
+        try:
+            r = await client.head(url, headers=headers, follow_redirects=True, timeout=20)
+            status = r.status_code
+            info = self.store(url, cookie, r) if status < 400 else None
+            if info is None and status not in (401, 403, 404, 410):
+                # Some CDNs reject HEAD or omit the length: ask for one byte instead
+                async with client.stream(
+                    "GET", url, headers={**headers, "Range": "bytes=0-0"}, follow_redirects=True, timeout=20
+                ) as r:
+                    status = r.status_code
+                    info = self.store(url, cookie, r) if status < 400 else None
+        except httpx.HTTPError as e:
+            logger.warning(f"Metadata probe failed for {url}: {e}")
+            info = None
+        if info is None:
+            self.probe_failures += 1
+            # A link the CDN now rejects must not keep being answered from cache
+            if status is not None and status >= 400:
+                self._entries.pop(self.key_for(url, cookie), None)
+        return info, status
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "in_flight": len(self._inflight),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "probe_failures": self.probe_failures,
+            "not_modified": self.not_modified,
+        }
+
+
+file_metadata = MetadataCache(
+    max_entries=settings.file_meta_cache_size,
+    ttl=settings.file_meta_ttl,
+    stale=settings.file_meta_stale,
+)
+
+__all__ = ["FileInfo", "MetadataCache", "describe", "file_metadata"]
@@ -0,0 +1,82 @@
+import asyncio
+from typing import List, AsyncIterator, Tuple
+
+from .cache import link_origins
+from .config import settings
+from .limits import KeyedSemaphore, host_of
+from .models import FolderResolveRequest, FolderFileResult, ResolvedFile
+from .resolver import list_share_files, probe_share_file
+
+
+# Shared by all listings so a large folder cannot flood one CDN host with probes
+probe_host_limits = KeyedSemaphore(settings.folder_probe_host_concurrency)
+
+
+def page_bounds(req: FolderResolveRequest, total: int) -> Tuple[int, int]:
+    """[start, stop) of the requested page within ``total`` listed files."""
+    limit = min(req.limit or settings.folder_page_size, settings.folder_page_size)
+    start = min(req.offset, total)
+    return start, min(start + limit, total)
+
+
+async def resolve_folder(req: FolderResolveRequest) -> Tuple[int, int, AsyncIterator[FolderFileResult]]:
+    """List a share and return (total, page end, results for the requested page).
+
+    Listed files are probed unless the request opts out; a share resolved as
+    a single file already carries its metadata. Results are yielded as each
+    probe finishes, so their order is completion order; ``index`` is the
+    file's position in the listing. Listed files are remembered as part of
+    the share, so their links can be resolved again once they expire.
+    """
+    files, listed = await list_share_files(req)
+    total = len(files)
+    start, stop = page_bounds(req, total)
+    concurrency = min(req.concurrency or settings.folder_probe_concurrency, settings.folder_max_probe_concurrency)
+    results = _probe_page(req, files, start, stop, concurrency if req.probe and listed else 0)
+    # A share resolved as a single file was already remembered by the resolve
+    return total, stop, _remembered(req, results) if listed else results
+
+
+async def _remembered(
+    req: FolderResolveRequest, results: AsyncIterator[FolderFileResult]
+) -> AsyncIterator[FolderFileResult]:
+    async for result in results:
+        link_origins.remember(str(result.file.direct_url), str(req.url), listed=True)
+        yield result
+
+
+async def _probe_page(
+    req: FolderResolveRequest, files: List[ResolvedFile], start: int, stop: int, concurrency: int
+) -> AsyncIterator[FolderFileResult]:
+    total = len(files)
+    if not concurrency:
+        for index in range(start, stop):
+            yield FolderFileResult(index=index, total=total, file=files[index])
+        return
+
+    todo: "asyncio.Queue[int]" = asyncio.Queue()
+    for index in range(start, stop):
+        todo.put_nowait(index)
+    results: "asyncio.Queue[FolderFileResult]" = asyncio.Queue()
+
+    async def worker() -> None:
+        while True:
+            try:
+                index = todo.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            listed = files[index]
+            async with probe_host_limits.acquire(host_of(str(listed.direct_url))):
+                probed = await probe_share_file(listed, req)
+            await results.put(FolderFileResult(index=index, total=total, file=probed))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, stop - start))]
+    try:
+        for _ in range(stop - start):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+__all__ = ["resolve_folder", "page_bounds", "probe_host_limits"]
@@ -0,0 +1,219 @@
+import inspect
+from typing import Optional, Dict, Any
+
+import httpcore
+import httpx
+
+from .config import settings
+from .logger import logger
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class _WideReadConnection(httpcore.AsyncHTTPConnection):
+    """Connection whose HTTP/1.1 socket reads take up to ``read_size`` bytes.
+
+    httpcore reads in fixed 64 KiB slices (``READ_NUM_BYTES``); per-read overhead
+    dominates the /download relay at high throughput. The size is set on each
+    connection's own HTTP/1.1 instance, so other httpcore users keep the default.
+    """
+
+    def __init__(self, *args: Any, read_size: int, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._read_size = read_size
+
+    async def handle_async_request(self, request: httpcore.Request) -> httpcore.Response:
+        response = await super().handle_async_request(request)
+        # The HTTP/1.1 connection exists once the headers are in; the body is read after this
+        if isinstance(self._connection, httpcore.AsyncHTTP11Connection):
+            self._connection.READ_NUM_BYTES = self._read_size
+        return response
+
+
+class _WideReadPool(httpcore.AsyncConnectionPool):
+    """Connection pool that opens _WideReadConnection connections (relies on the pinned httpcore)."""
+
+    def __init__(self, *args: Any, read_size: int, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._read_size = read_size
+
+    def create_connection(self, origin: httpcore.Origin) -> httpcore.AsyncConnectionInterface:
+        return _WideReadConnection(
+            origin=origin,
+            ssl_context=self._ssl_context,
+            keepalive_expiry=self._keepalive_expiry,
+            http1=self._http1,
+            http2=self._http2,
+            retries=self._retries,
+            local_address=self._local_address,
+            uds=self._uds,
+            network_backend=self._network_backend,
+            socket_options=self._socket_options,
+            read_size=self._read_size,
+        )
+
+
+class _CountingTransport(httpx.AsyncHTTPTransport):
+    """Transport that records whether each request opened a new connection or reused one."""
+
+    def __init__(
+        self,
+        pool: "ClientPool",
+        limits: httpx.Limits,
+        http2: bool = False,
+        read_size: Optional[int] = None,
+    ) -> None:
+        super().__init__(http2=http2, limits=limits)
+        self._owner = pool
+        if read_size is not None:
+            self._pool = _WideReadPool(
+                ssl_context=httpx.create_ssl_context(),
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=limits.keepalive_expiry,
+                http2=http2,
+                read_size=read_size,
+            )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        opened = False
+        parent = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            nonlocal opened
+            if event_name == "connection.connect_tcp.started":
+                opened = True
+            if parent is not None:
+                result = parent(event_name, info)
+                if inspect.isawaitable(result):
+                    await result
+
+        request.extensions["trace"] = trace
+        try:
+            return await super().handle_async_request(request)
+        except Exception:
+            self._owner.errors += 1
+            raise
+        finally:
+            self._owner.requests += 1
+            if opened:
+                self._owner.connections_opened += 1
+            else:
+                self._owner.connections_reused += 1
+
+
+class ClientPool:
+    """A lazily created, process-wide httpx.AsyncClient with connection accounting.
+
+    The client is normally opened and closed by the app lifespan; if it is used
+    outside of it (scripts, workers) it is created on first use.
+    """
+
+    def __init__(self, name: str, timeout: float, http2: bool = False, read_size: Optional[int] = None) -> None:
+        self.name = name
+        self.timeout = timeout
+        self.http2 = http2 and HTTP2_AVAILABLE
+        # Max bytes per HTTP/1.1 socket read; None keeps httpcore's default
+        self.read_size = read_size
+        self._client: Optional[httpx.AsyncClient] = None
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _build(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=settings.pool_max_connections,
+            max_keepalive_connections=settings.pool_max_keepalive,
+            keepalive_expiry=settings.pool_keepalive_expiry,
+        )
+        transport = _CountingTransport(self, limits, http2=self.http2, read_size=self.read_size)
+        logger.info(
+            f"Opening '{self.name}' HTTP pool (max={limits.max_connections}, "
+            f"keepalive={limits.max_keepalive_connections}, expiry={limits.keepalive_expiry}s, http2={self.http2})"
+        )
+        return httpx.AsyncClient(
+            transport=transport,
+            follow_redirects=True,
+            timeout=self.timeout,
+        )
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None and not self._client.is_closed
+
+    def get(self) -> httpx.AsyncClient:
+        if self.started:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._client = self._build()
+        return self._client  # type: ignore[return-value]
+
+    async def start(self) -> None:
+        if not self.started:
+            self._client = self._build()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "http2": self.http2,
+            "hits": self.hits,
+            "misses": self.misses,
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+        }
+
+
+# Share pages and API calls to terabox.com
+page_pool = ClientPool("page", timeout=settings.page_timeout_seconds, http2=True)
+# HEAD probes and file streaming from the CDN
+cdn_pool = ClientPool("cdn", timeout=settings.cdn_timeout_seconds, read_size=settings.relay_read_size)
+
+
+def get_page_client() -> httpx.AsyncClient:
+    return page_pool.get()
+
+
+def get_cdn_client() -> httpx.AsyncClient:
+    return cdn_pool.get()
+
+
+async def start_pools() -> None:
+    await page_pool.start()
+    await cdn_pool.start()
+
+
+async def close_pools() -> None:
+    await page_pool.close()
+    await cdn_pool.close()
+
+
+def pool_stats() -> Dict[str, Any]:
+    return {page_pool.name: page_pool.stats(), cdn_pool.name: cdn_pool.stats()}
+
+
+__all__ = [
+    "ClientPool",
+    "page_pool",
+    "cdn_pool",
+    "get_page_client",
+    "get_cdn_client",
+    "start_pools",
+    "close_pools",
+    "pool_stats",
+]
@@ -0,0 +1,550 @@
+import asyncio
+import json
+import math
+import mmap
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Dict, Any, List, AsyncIterator
+
+import aiofiles
+import httpx
+from fastapi.responses import StreamingResponse
+
+from .config import settings
+from .disk_cache import READ_SLICE
+from .http_clients import get_cdn_client
+from .limits import Overloaded
+from .logger import logger
+from .models import JobInfo, ResolveRequest
+from .ranges import Span
+from .relay import relay_raw
+from .resolver import _filename_from_headers, resolve_terabox
+from .resume import CONTENT_RANGE_RE, EXPIRED_STATUSES, link_expired, refresh_link
+
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Seconds without a change after which an event stream sends a keep-alive comment
+HEARTBEAT_SECONDS = 15.0
+
+
+class Job:
+    """One background fetch: the request it came from, where the transfer stands, and its runtime state."""
+
+    __slots__ = (
+        "id",
+        "request",
+        "cookie",
+        "needs_cookie",
+        "state",
+        "direct_url",
+        "filename",
+        "content_type",
+        "size",
+        "validator",
+        "bytes_done",
+        "attempts",
+        "error",
+        "created_at",
+        "updated_at",
+        "task",
+        "rate",
+        "changed",
+        "_window_start",
+        "_window_bytes",
+    )
+
+    # Fields written to the job's state file
+    PERSISTED = (
+        "id",
+        "request",
+        "needs_cookie",
+        "state",
+        "direct_url",
+        "filename",
+        "content_type",
+        "size",
+        "validator",
+        "bytes_done",
+        "attempts",
+        "error",
+        "created_at",
+        "updated_at",
+    )
+
+    def __init__(self, job_id: str, request: Dict[str, Any]) -> None:
+        self.id = job_id
+        # The ResolveRequest as JSON, so the share can be resolved again after a restart. The cookie
+        # is kept in memory only: state files are plain text and outlive the job.
+        self.request = dict(request)
+        self.cookie: Optional[str] = self.request.pop("cookie", None)
+        self.needs_cookie = self.cookie is not None
+        self.state = QUEUED
+        self.direct_url: Optional[str] = None
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.size: Optional[int] = None
+        self.validator: Optional[str] = None
+        self.bytes_done = 0
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.created_at = self.updated_at = time.time()
+        self.task: Optional["asyncio.Task[None]"] = None
+        self.rate = 0.0
+        # Set (and replaced) on every change, for progress watchers
+        self.changed = asyncio.Event()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Job":
+        job = cls(data["id"], data["request"])
+        for name in cls.PERSISTED:
+            if name == "request":
+                continue
+            if name in data:
+                setattr(job, name, data[name])
+        return job
+
+    def resolve_request(self) -> ResolveRequest:
+        return ResolveRequest(**self.request, cookie=self.cookie)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.PERSISTED}
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED
+
+    def info(self) -> JobInfo:
+        return JobInfo(
+            id=self.id,
+            state=self.state,
+            url=self.request["url"],
+            filename=self.filename,
+            content_type=self.content_type,
+            size=self.size,
+            bytes_done=self.bytes_done,
+            rate_bytes_per_second=round(self.current_rate()) if self.state == RUNNING else 0,
+            attempts=self.attempts,
+            error=self.error,
+            created_at=self.created_at,
+            updated_at=self.updated_at,
+        )
+
+    def touch(self) -> None:
+        self.updated_at = time.time()
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def begin(self) -> None:
+        self.state = RUNNING
+        self.rate = 0.0
+        self._window_start, self._window_bytes = time.monotonic(), 0
+        self.touch()
+
+    def current_rate(self) -> float:
+        # Within the first second of a run, the average so far
+        return self.rate or self._window_bytes / max(time.monotonic() - self._window_start, 1e-3)
+
+    def progress(self, nbytes: int) -> None:
+        self.bytes_done += nbytes
+        self._window_bytes += nbytes
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            self.rate = self._window_bytes / (now - self._window_start)
+            self._window_start, self._window_bytes = now, 0
+        self.touch()
+
+
+class JobManager:
+    """Fetches whole files to local disk in the background, for transfers too long to hold one request open.
+
+    Submitted jobs wait in a bounded queue for one of ``workers`` workers.
+    A worker resolves the share, then writes the file to ``<id>.part`` in
+    ``directory``. Every ``checkpoint_bytes`` the part file is synced and the
+    job's state is written to ``<id>.json``. A broken transfer is reopened
+    as a range request from the last written byte, and an expired link is
+    resolved again first. If the file changed upstream (another size or
+    validator), it is fetched again from the start. A job fails after
+    ``retries`` failed attempts in a row without progress.
+
+    State files are read back at startup: finished jobs are listed again,
+    and unfinished ones are queued to resume from their last checkpoint.
+    Finished jobs and their files are deleted after ``retention`` seconds.
+    """
+
+    def __init__(
+        self, directory: str, workers: int, max_queued: int, checkpoint_bytes: int, retries: int, retention: float
+    ) -> None:
+        self.directory = Path(directory) if directory else None
+        self.workers = workers
+        self.max_queued = max_queued
+        self.checkpoint_bytes = checkpoint_bytes
+        self.retries = retries
+        self.retention = retention
+        self._jobs: Dict[str, Job] = {}
+        self._queue: "asyncio.Queue[Job]" = asyncio.Queue()
+        self._workers: List["asyncio.Task[None]"] = []
+        self.duration_ewma: Optional[float] = None
+        self.submitted = 0
+        self.restored = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.resumes = 0
+        self.restarts = 0
+        self.shed = 0
+        self.bytes_fetched = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _state_path(self, job: Job) -> Path:
+        return self.directory / f"{job.id}.json"
+
+    def _part_path(self, job: Job) -> Path:
+        return self.directory / f"{job.id}.part"
+
+    def file_path(self, job: Job) -> Path:
+        return self.directory / f"{job.id}.data"
+
+    async def start(self) -> None:
+        """Load jobs left by a previous run, queue the unfinished ones and start the workers."""
+        if not self.enabled:
+            return
+        await asyncio.to_thread(self._scan)
+        await self._prune()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def _scan(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        found: List[Job] = []
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp":
+                path.unlink(missing_ok=True)
+            elif path.suffix == ".json":
+                try:
+                    job = Job.from_dict(json.loads(path.read_text()))
+                except (OSError, ValueError, KeyError, TypeError):
+                    logger.warning(f"Ignoring unreadable job state {path}")
+                    continue
+                if job.cookie is not None:
+                    # Written before cookies stopped being persisted: rewrite it without
+                    self._save(job)
+                found.append(job)
+        for job in sorted(found, key=lambda job: job.created_at):
+            self._jobs[job.id] = job
+            if job.finished:
+                continue
+            if job.needs_cookie and job.cookie is None:
+                job.state = FAILED
+                job.error = "The job's cookie is not kept across restarts; submit it again with the cookie"
+                self._save(job)
+                continue
+            job.state = QUEUED
+            self._queue.put_nowait(job)
+            self.restored += 1
+        logger.info(f"Jobs: {len(found)} loaded from {self.directory}, {self.restored} to resume")
+
+    async def close(self) -> None:
+        """Stop the workers; running jobs save their offset and resume on the next start."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        return sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def _waiting(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.state == QUEUED)
+
+    def _retry_after(self, waiting: int) -> float:
+        duration = self.duration_ewma or 60.0
+        return float(max(1, math.ceil(duration * (waiting + 1) / self.workers)))
+
+    async def submit(self, request: ResolveRequest) -> Job:
+        await self._prune()
+        waiting = self._waiting()
+        if waiting >= self.max_queued:
+            self.shed += 1
+            raise Overloaded("Too many jobs queued", self._retry_after(waiting))
+        job = Job(uuid.uuid4().hex, request.model_dump(mode="json"))
+        await asyncio.to_thread(self._save, job)
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        self.submitted += 1
+        logger.info(f"Job {job.id} queued for {job.request['url']}")
+        return job
+
+    async def remove(self, job: Job) -> None:
+        """Cancel ``job`` if it has not finished, and delete its state and file."""
+        if not job.finished:
+            job.state = CANCELLED
+            self.cancelled += 1
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+                await asyncio.wait([job.task])
+        self._jobs.pop(job.id, None)
+        await asyncio.to_thread(self._delete_files, job)
+        job.touch()
+
+    def _delete_files(self, job: Job) -> None:
+        for path in (self._state_path(job), self._part_path(job), self.file_path(job)):
+            path.unlink(missing_ok=True)
+
+    async def _prune(self) -> None:
+        cutoff = time.time() - self.retention
+        for job in [job for job in self._jobs.values() if job.finished and job.updated_at < cutoff]:
+            self._jobs.pop(job.id, None)
+            await asyncio.to_thread(self._delete_files, job)
+
+    def _save(self, job: Job) -> None:
+        # Written under a temporary name and renamed, so a crash never leaves a torn state file
+        tmp = self.directory / f"{job.id}.{uuid.uuid4().hex}.tmp"
+        tmp.write_text(json.dumps(job.to_dict()))
+        os.replace(tmp, self._state_path(job))
+
+    def _checkpoint(self, job: Job, fd: int) -> None:
+        # The data reaches the disk before the state that claims it
+        os.fsync(fd)
+        self._save(job)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.state != QUEUED:
+                continue
+            job.task = asyncio.ensure_future(self._run(job))
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                # A removed job only ends its own task; anything else stops the worker
+                if job.state != CANCELLED or asyncio.current_task().cancelling():
+                    raise
+            finally:
+                job.task = None
+
+    async def _run(self, job: Job) -> None:
+        job.begin()
+        started = time.monotonic()
+        try:
+            while True:
+                before = job.bytes_done
+                try:
+                    await self._fetch(job)
+                    break
+                except Exception as e:
+                    # Attempts that made progress start the count again
+                    job.attempts = job.attempts + 1 if job.bytes_done == before else 1
+                    job.error = str(e) or type(e).__name__
+                    if job.attempts > self.retries:
+                        job.state = FAILED
+                        self.failed += 1
+                        logger.warning(f"Job {job.id} failed at byte {job.bytes_done}: {job.error}")
+                        break
+                    delay = min(2.0 ** job.attempts, 60.0)
+                    if isinstance(e, Overloaded):
+                        delay = max(delay, e.retry_after)
+                    logger.warning(
+                        f"Job {job.id} attempt {job.attempts} failed at byte {job.bytes_done} ({job.error}); "
+                        f"retrying in {delay:.0f}s"
+                    )
+                    await asyncio.to_thread(self._save, job)
+                    job.touch()
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if job.state != CANCELLED:
+                # Shutting down: picked up again from the last written byte on the next start
+                job.state = QUEUED
+                self._save(job)
+            raise
+        elapsed = time.monotonic() - started
+        self.duration_ewma = elapsed if self.duration_ewma is None else 0.8 * self.duration_ewma + 0.2 * elapsed
+        await asyncio.to_thread(self._save, job)
+        job.touch()
+
+    async def _resolve(self, job: Job) -> None:
+        request = job.resolve_request()
+        if job.direct_url is not None:
+            # Re-resolving means the known link expired, so the cached resolve is stale as well
+            job.direct_url = await refresh_link(str(request.url), request.cookie, request.user_agent)
+            return
+        resolved = await resolve_terabox(request)
+        job.direct_url = str(resolved.direct_url)
+        job.filename = job.filename or resolved.filename
+        job.content_type = job.content_type or resolved.content_type
+
+    async def _open(self, client: httpx.AsyncClient, job: Job) -> httpx.Response:
+        request = job.resolve_request()
+        headers = {"User-Agent": request.user_agent, "Accept-Encoding": "identity"}
+        if request.cookie:
+            headers["Cookie"] = request.cookie
+        if job.bytes_done:
+            headers["Range"] = f"bytes={job.bytes_done}-"
+        return await client.send(client.build_request("GET", job.direct_url, headers=headers), stream=True)
+
+    def _start_of(self, job: Job, resp: httpx.Response) -> int:
+        """Offset of the file at which ``resp``'s body starts; records the file's size and validator."""
+        if resp.status_code >= 400:
+            raise RuntimeError(f"upstream answered {resp.status_code}")
+        if resp.headers.get("content-encoding", "identity").lower() != "identity":
+            raise RuntimeError(f"upstream sent an encoded body ({resp.headers['content-encoding']})")
+        size = None
+        start = 0
+        if resp.status_code == 206:
+            match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+            if not match:
+                raise RuntimeError(f"upstream sent Content-Range {resp.headers.get('content-range')!r}")
+            start, size = int(match.group(1)), int(match.group(3))
+        elif resp.headers.get("content-length", "").isdigit():
+            size = int(resp.headers["content-length"])
+        validator = resp.headers.get("etag") or resp.headers.get("last-modified")
+        if job.bytes_done and (
+            start != job.bytes_done or size != job.size or (job.validator and validator and validator != job.validator)
+        ):
+            logger.warning(f"Job {job.id}: upstream file changed or range not honored; fetching again from byte 0")
+            self.restarts += 1
+            job.bytes_done = 0
+            if start != 0:
+                raise RuntimeError("upstream file changed")
+        job.size = size
+        job.validator = validator
+        job.content_type = resp.headers.get("content-type") or job.content_type
+        job.filename = job.filename or _filename_from_headers(resp.headers)
+        return start
+
+    async def _fetch(self, job: Job) -> None:
+        """Write the rest of ``job``'s file, from its last written byte, and mark it done."""
+        if job.direct_url is None or link_expired(job.direct_url):
+            await self._resolve(job)
+        client = get_cdn_client()
+        resp = await self._open(client, job)
+        try:
+            if resp.status_code in EXPIRED_STATUSES:
+                await resp.aclose()
+                await self._resolve(job)
+                resp = await self._open(client, job)
+            if resp.status_code == 416 and job.size is not None and job.bytes_done == job.size:
+                start = job.size
+            else:
+                start = self._start_of(job, resp)
+            if start:
+                self.resumes += 1
+            await self._write(job, resp, start)
+        finally:
+            await resp.aclose()
+
+    async def _write(self, job: Job, resp: httpx.Response, start: int) -> None:
+        part = self._part_path(job)
+        async with aiofiles.open(part, "r+b" if part.exists() else "wb") as f:
+            # Bytes past the last checkpoint may not have reached the disk before a crash
+            await f.truncate(start)
+            await f.seek(start)
+            unsaved = 0
+            if start != job.size:
+                async for data in relay_raw(resp, settings.relay_chunk_size, settings.relay_flush_interval):
+                    await f.write(data)
+                    job.progress(len(data))
+                    self.bytes_fetched += len(data)
+                    unsaved += len(data)
+                    if unsaved >= self.checkpoint_bytes:
+                        await f.flush()
+                        await asyncio.to_thread(self._checkpoint, job, f.fileno())
+                        unsaved = 0
+            await f.flush()
+            if job.size is not None and job.bytes_done != job.size:
+                raise RuntimeError(f"upstream ended {job.size - job.bytes_done} bytes early")
+            await asyncio.to_thread(os.fsync, f.fileno())
+        os.replace(part, self.file_path(job))
+        job.size = job.bytes_done
+        job.state = DONE
+        job.attempts = 0
+        job.error = None
+        self.completed += 1
+        logger.info(f"Job {job.id} done: {job.size} bytes")
+
+    async def watch(self, job: Job, interval: float) -> AsyncIterator[Optional[JobInfo]]:
+        """Snapshots of ``job`` as it changes, at most one per ``interval`` seconds, ending with its final state.
+
+        None is yielded after ``HEARTBEAT_SECONDS`` without a change.
+        """
+        changed = job.changed
+        yield job.info()
+        while not job.finished:
+            try:
+                await asyncio.wait_for(changed.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            # Coalesce the chunks written meanwhile into one event
+            await asyncio.sleep(interval)
+            changed = job.changed
+            yield job.info()
+
+    def stats(self) -> Dict[str, Any]:
+        states: Dict[str, int] = {}
+        for job in self._jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {
+            "enabled": self.enabled,
+            "workers": len(self._workers),
+            "states": states,
+            "submitted": self.submitted,
+            "restored": self.restored,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "shed": self.shed,
+            "resumes": self.resumes,
+            "restarts": self.restarts,
+            "bytes_fetched": self.bytes_fetched,
+            "rate_bytes_per_second": round(sum(job.current_rate() for job in self._jobs.values() if job.state == RUNNING)),
+        }
+
+
+class JobFileResponse(StreamingResponse):
+    """A byte span of a finished job's file.
+
+    The file is memory-mapped and relayed as slices of the mapping, so the
+    bytes are not copied into Python objects, and ``body_iterator`` can be
+    wrapped like any download body. This is not kernel ``sendfile``: ASGI
+    gives the app no access to the socket, and uvicorn offers no zero-copy
+    send extension, so each slice is still written by the server.
+    """
+
+    def __init__(self, path: Path, span: Span, **kwargs: Any) -> None:
+        self.path = path
+        self.start, self.end = span
+        super().__init__(self._slices(), **kwargs)
+
+    async def _slices(self) -> AsyncIterator[bytes]:
+        if self.end < self.start:
+            return
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        for offset in range(self.start, self.end + 1, READ_SLICE):
+            yield view[offset : min(offset + READ_SLICE, self.end + 1)]
+
+
+jobs = JobManager(
+    settings.job_dir,
+    settings.job_workers,
+    settings.job_max_queued,
+    settings.job_checkpoint_bytes,
+    settings.job_retries,
+    settings.job_retention,
+)
+
+__all__ = ["Job", "JobManager", "JobFileResponse", "jobs", "QUEUED", "RUNNING", "DONE", "FAILED", "CANCELLED"]
@@ -0,0 +1,253 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator, Callable, Deque
+from urllib.parse import urlsplit
+
+from .config import settings
+
+
+class Overloaded(Exception):
+    """Request shed because an upstream budget is exhausted (HTTP 503)."""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimited(Exception):
+    """Client exceeded its request rate (HTTP 429)."""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def host_of(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
+
+
+class KeyedSemaphore:
+    """One lazily created semaphore per key (typically an upstream host).
+
+    Semaphores are dropped again once nobody holds or waits on them, so the
+    number of tracked keys stays bounded by the number of active ones.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._users: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: str) -> AsyncIterator[None]:
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(self.limit)
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._semaphores[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": self.limit, "active_keys": dict(self._users)}
+
+
+class AdmissionGate:
+    """Per-key concurrency limit with a bounded wait queue and a wait deadline.
+
+    Up to ``limit`` holders per key (typically an upstream host) run at once.
+    Up to ``max_waiting`` more callers in total wait in FIFO order, each for at
+    most ``wait_timeout`` seconds. Anyone beyond that is shed at once with
+    :class:`Overloaded`, whose ``retry_after`` is estimated from recent hold
+    times. Slots are handed directly to the next waiter on release.
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int, wait_timeout: float) -> None:
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._active: Dict[str, int] = {}
+        self._waiters: Dict[str, Deque["asyncio.Future[None]"]] = {}
+        self._waiting = 0
+        self.hold_ewma: Optional[float] = None
+        self.admitted = 0
+        self.queued = 0
+        self.shed_full = 0
+        self.shed_timeout = 0
+
+    def retry_after(self, key: str) -> float:
+        hold = self.hold_ewma or 1.0
+        backlog = len(self._waiters.get(key, ())) + 1
+        return float(max(1, math.ceil(hold * backlog / self.limit)))
+
+    async def enter(self, key: str) -> Callable[[], None]:
+        """Wait for a slot; returns an idempotent release callback."""
+        if self._active.get(key, 0) < self.limit and not self._waiters.get(key):
+            self._active[key] = self._active.get(key, 0) + 1
+        else:
+            await self._wait(key)
+        self.admitted += 1
+        started = time.monotonic()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._release(key, time.monotonic() - started)
+
+        return release
+
+    async def _wait(self, key: str) -> None:
+        if self._waiting >= self.max_waiting:
+            self.shed_full += 1
+            raise Overloaded(f"Too many requests queued for {self.name}", self.retry_after(key))
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(key, deque())
+        waiters.append(future)
+        self._waiting += 1
+        self.queued += 1
+        try:
+            await asyncio.wait([future], timeout=self.wait_timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller went away: pass it on
+                self._release(key, None)
+            raise
+        finally:
+            self._waiting -= 1
+            if not future.done():
+                future.cancel()
+                waiters.remove(future)
+            if not waiters and self._waiters.get(key) is waiters:
+                del self._waiters[key]
+        if future.cancelled():
+            self.shed_timeout += 1
+            raise Overloaded(f"Timed out waiting for {self.name}", self.retry_after(key))
+
+    def _release(self, key: str, held: Optional[float]) -> None:
+        if held is not None:
+            self.hold_ewma = held if self.hold_ewma is None else 0.8 * self.hold_ewma + 0.2 * held
+        waiters = self._waiters.get(key)
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(None)  # the slot moves to this waiter
+                return
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+
+    @asynccontextmanager
+    async def slot(self, key: str) -> AsyncIterator[None]:
+        release = await self.enter(key)
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "max_waiting": self.max_waiting,
+            "active": dict(self._active),
+            "waiting": self._waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed_queue_full": self.shed_full,
+            "shed_timeout": self.shed_timeout,
+            "hold_ewma_seconds": self.hold_ewma,
+        }
+
+
+class ClientRateLimiter:
+    """Token bucket per client: ``rate`` requests per second with bursts up to ``burst``.
+
+    Only the ``max_clients`` most recently seen clients are tracked; a
+    forgotten client simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, tuple[float, float]]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def check(self, client: str, cost: float = 1) -> None:
+        """Take ``cost`` tokens for a client or raise :class:`RateLimited`."""
+        if not self.enabled:
+            return
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < cost:
+            self._buckets[client] = (tokens, now)
+            self.rejected += 1
+            raise RateLimited("Too many requests", float(max(1, math.ceil((cost - tokens) / self.rate))))
+        self._buckets[client] = (tokens - cost, now)
+        self.allowed += 1
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
+
+
+# Process-wide budgets: share page hosts for resolves, CDN hosts for downloads,
+# and a much smaller one for headless browser pages
+resolve_gate = AdmissionGate(
+    "resolve", settings.resolve_host_concurrency, settings.admission_max_waiting, settings.admission_wait_timeout
+)
+download_gate = AdmissionGate(
+    "download", settings.download_host_concurrency, settings.admission_max_waiting, settings.admission_wait_timeout
+)
+browser_gate = AdmissionGate(
+    "browser", settings.browser_max_pages, settings.browser_max_waiting, settings.admission_wait_timeout
+)
+client_limiter = ClientRateLimiter(settings.client_rate, settings.client_burst)
+
+
+def admission_stats() -> Dict[str, Any]:
+    return {
+        "clients": client_limiter.stats(),
+        "resolve": resolve_gate.stats(),
+        "download": download_gate.stats(),
+        "browser": browser_gate.stats(),
+    }
+
+
+__all__ = [
+    "KeyedSemaphore",
+    "AdmissionGate",
+    "ClientRateLimiter",
+    "Overloaded",
+    "RateLimited",
+    "host_of",
+    "resolve_gate",
+    "download_gate",
+    "browser_gate",
+    "client_limiter",
+    "admission_stats",
+]
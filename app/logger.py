@@ -1,12 +1,262 @@
-from loguru import logger
+import json
 import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, TextIO, Tuple, Deque
+
+from loguru import logger
 
-# Configure loguru: console output with a helpful format
-logger.remove()
-logger.add(
-    sys.stdout,
-    colorize=True,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
+from .config import settings
+
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "{extra[request_id_prefix]}<level>{message}</level>"
 )
 
-__all__ = ["logger"]
+# Set per HTTP request by RequestLogMiddleware and inherited by tasks it starts
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+# Seconds spent per resolve stage in the current request (filled by metrics.stage)
+request_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+
+
+def _patch(record: Dict[str, Any]) -> None:
+    rid = request_id.get()
+    record["extra"].setdefault("request_id", rid)
+    record["extra"]["request_id_prefix"] = f"[{rid}] " if rid else ""
+
+
+def _json_format(record: Dict[str, Any]) -> str:
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+    }
+    entry.update((k, v) for k, v in record["extra"].items() if v is not None and k not in ("request_id_prefix", "json"))
+    if record["exception"] is not None:
+        exc_type, exc, _ = record["exception"]
+        entry["exception"] = f"{exc_type.__name__ if exc_type else ''}: {exc}"
+    # loguru fills in the returned template, so the JSON (full of braces) goes through extra
+    record["extra"]["json"] = json.dumps(entry, default=str)
+    return "{extra[json]}\n{exception}" if record["exception"] is not None else "{extra[json]}\n"
+
+
+class QueuedSink:
+    """Log sink that hands formatted lines to a writer thread and never blocks the caller.
+
+    Lines wait in a bounded in-process queue and are written in batches.
+    When the stream cannot keep up and ``max_pending`` lines are waiting,
+    new lines are dropped and counted instead. (loguru's own ``enqueue``
+    pickles every record through a multiprocessing pipe, which costs the
+    calling thread more than a plain write.)
+    """
+
+    def __init__(self, stream: TextIO, max_pending: int) -> None:
+        self.stream = stream
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: Deque[str] = deque()
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message: str) -> None:
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._idle.clear()
+        self._pending.append(message)
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            batch = []
+            while self._pending:
+                batch.append(self._pending.popleft())
+            if batch:
+                try:
+                    self.stream.write("".join(batch))
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    self.dropped += len(batch)
+            if not self._pending:
+                self._idle.set()
+                if self._closed:
+                    return
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Wait until every queued line has been written."""
+        self._wakeup.set()
+        self._idle.wait(timeout)
+
+    def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(5.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": len(self._pending), "max_pending": self.max_pending, "dropped": self.dropped}
+
+
+_queued_sink: Optional[QueuedSink] = None
+
+
+def configure_logging(
+    level: str = settings.log_level,
+    json_output: bool = settings.log_json,
+    enqueue: bool = settings.log_enqueue,
+    sink: TextIO = sys.stdout,
+) -> None:
+    """(Re)install the single log sink.
+
+    With ``enqueue``, lines go through a QueuedSink, so a slow or blocked
+    stdout never stalls the event loop. JSON output writes one object per
+    line with the request ID and any ``extra`` fields bound to the record.
+    """
+    global _queued_sink
+    logger.remove()
+    if _queued_sink is not None:
+        _queued_sink.close()
+        _queued_sink = None
+    logger.configure(patcher=_patch)
+    target: Any = sink
+    if enqueue:
+        _queued_sink = QueuedSink(sink, settings.log_queue_size)
+        target = _queued_sink.write
+    if json_output:
+        logger.add(target, level=level, format=_json_format, colorize=False, backtrace=False, diagnose=False)
+    else:
+        logger.add(target, level=level, format=TEXT_FORMAT, colorize=sink.isatty())
+
+
+def flush_logs() -> None:
+    """Wait for queued log lines to be written (e.g. before exit or in benchmarks)."""
+    if _queued_sink is not None:
+        _queued_sink.flush()
+
+
+class SampledLogger:
+    """Rate-limits noisy per-attempt messages per key with a token bucket.
+
+    Each key may log ``rate`` messages per second (bursts up to ``rate``).
+    Dropped messages are counted, and the count is appended to the next one
+    that gets through. A rate of 0 logs everything.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self._buckets: Dict[str, Tuple[float, float, int]] = {}
+        self.suppressed = 0
+
+    def _allow(self, key: str) -> Tuple[bool, int]:
+        if self.rate <= 0:
+            return True, 0
+        now = time.monotonic()
+        tokens, updated, dropped = self._buckets.get(key, (self.rate, now, 0))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, dropped + 1)
+            self.suppressed += 1
+            return False, 0
+        self._buckets[key] = (tokens - 1, now, 0)
+        return True, dropped
+
+    def log(self, level: str, key: str, message: str) -> None:
+        allowed, dropped = self._allow(key)
+        if allowed:
+            if dropped:
+                message = f"{message} ({dropped} similar messages suppressed)"
+            logger.opt(depth=2).log(level, message)
+
+    def info(self, key: str, message: str) -> None:
+        self.log("INFO", key, message)
+
+    def debug(self, key: str, message: str) -> None:
+        self.log("DEBUG", key, message)
+
+
+noisy = SampledLogger(settings.log_noisy_rate)
+
+
+def logging_stats() -> Dict[str, Any]:
+    queued = _queued_sink.stats() if _queued_sink is not None else {}
+    return {**queued, "suppressed": noisy.suppressed}
+
+
+class RequestLogMiddleware:
+    """Assigns each HTTP request an ID (``X-Request-ID``, taken from the client if given) and logs one access line.
+
+    The access line carries method, path, status, duration and the time
+    spent per resolve stage during the request.
+    """
+
+    def __init__(self, app: Any, access_log: bool = True) -> None:
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rid = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                rid = value.decode("latin-1")[:64]
+                break
+        rid = rid or uuid.uuid4().hex[:16]
+        id_token = request_id.set(rid)
+        stages: Dict[str, float] = {}
+        stages_token = request_stages.set(stages)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = [*message["headers"], (b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if self.access_log:
+                elapsed = time.perf_counter() - started
+                logger.bind(
+                    method=scope["method"],
+                    path=scope["path"],
+                    status=status,
+                    duration_ms=round(elapsed * 1000, 2),
+                    stages_ms={k: round(v * 1000, 2) for k, v in stages.items()} or None,
+                ).info(f"{scope['method']} {scope['path']} {status} {elapsed * 1000:.1f}ms")
+            request_id.reset(id_token)
+            request_stages.reset(stages_token)
+
+
+configure_logging()
+
+__all__ = [
+    "logger",
+    "configure_logging",
+    "flush_logs",
+    "logging_stats",
+    "QueuedSink",
+    "noisy",
+    "SampledLogger",
+    "RequestLogMiddleware",
+    "request_id",
+    "request_stages",
+]
@@ -1,18 +1,86 @@
-from typing import Optional
+import asyncio
+import secrets
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, List, AsyncIterator
 from pathlib import Path
 
 import anyio
 import httpx
 from fastapi import FastAPI, HTTPException, Header, Request, Query
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask, BackgroundTasks
+
+from .models import (
+    ResolveRequest,
+    ResolvedFile,
+    ErrorResponse,
+    BatchResolveRequest,
+    FolderResolveRequest,
+    ResolvedFolder,
+    ZipDownloadRequest,
+    JobInfo,
+)
+from .resolver import resolve_terabox, strategy_runner
+from .bandwidth import bandwidth
+from .batch import resolve_batch
+from .folder import resolve_folder
+from .browser import browser_pool
+from .cache import link_origins, resolve_cache
+from .config import settings
+from .disk_cache import download_cache, CachedRead
+from .file_meta import FileInfo, file_metadata
+from .jobs import DONE, Job, JobFileResponse, jobs
+from .limits import Overloaded, RateLimited, admission_stats, client_limiter, download_gate, host_of
+from .ranges import Span, content_range, multipart_length, multipart_parts, parse_ranges, slice_body
+from .metrics import ProfilingMiddleware, download_ttfb_seconds, metered, render_metrics
+from .relay import relay_raw
+from .resume import (
+    EXPIRED_STATUSES,
+    ResumableStream,
+    link_expired,
+    refresh_link,
+    resume_plan,
+    resume_stats,
+    share_url_for,
+)
+from .segmented import SegmentedFetcher, segment_plan, segmented_stats
+from .zipstream import open_entry, stream_zip
+from .http_clients import get_cdn_client, start_pools, close_pools, pool_stats
+from .logger import RequestLogMiddleware, flush_logs, logger, logging_stats
 
-from .models import ResolveRequest, ResolvedFile, ErrorResponse
-from .resolver import resolve_terabox
-from .logger import logger
 
-app = FastAPI(title="TeraBox Downloader API", version="0.1.0")
+def _report_prewarm(task: "asyncio.Task[None]") -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error("Browser pre-warm task failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared upstream connection pools and the browser live for the whole process
+    await start_pools()
+    await download_cache.start()
+    await jobs.start()
+    prewarm: Optional["asyncio.Task[None]"] = None
+    if settings.browser_enabled and settings.browser_prewarm and browser_pool.available:
+        # Kept referenced so the task is not garbage-collected mid-launch
+        prewarm = asyncio.ensure_future(browser_pool.start())
+        prewarm.add_done_callback(_report_prewarm)
+    try:
+        yield
+    finally:
+        if prewarm is not None:
+            prewarm.cancel()
+            await asyncio.gather(prewarm, return_exceptions=True)
+        await jobs.close()
+        await browser_pool.close()
+        await close_pools()
+        flush_logs()
+
+
+app = FastAPI(title="TeraBox Downloader API", version="0.1.0", lifespan=lifespan)
 
 # Mount static files directory
 static_path = Path(__file__).parent.parent / "static"
@@ -28,6 +96,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in sampled profiling of whole requests
+if settings.profile_sample_rate > 0:
+    app.add_middleware(
+        ProfilingMiddleware, sample_rate=settings.profile_sample_rate, directory=settings.profile_dir
+    )
+
+# Outermost: request IDs cover everything logged while handling a request
+app.add_middleware(RequestLogMiddleware, access_log=settings.log_access)
+
 
 @app.get("/")
 async def homepage():
@@ -43,11 +120,51 @@ async def health():
     return {"status": "ok"}
 
 
-@app.post("/resolve", response_model=ResolvedFile, responses={400: {"model": ErrorResponse}})
-async def resolve_endpoint(payload: ResolveRequest):
+@app.get("/stats")
+async def stats():
+    return {
+        "http_pools": pool_stats(),
+        "resolve_cache": resolve_cache.stats(),
+        "resolve_strategies": strategy_runner.stats(),
+        "browser": browser_pool.stats(),
+        "segmented": segmented_stats,
+        "resume": {**resume_stats, "link_origins": len(link_origins)},
+        "bandwidth": bandwidth.stats(),
+        "download_cache": download_cache.stats(),
+        "jobs": jobs.stats(),
+        "file_metadata": file_metadata.stats(),
+        "admission": admission_stats(),
+        "logging": logging_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics: resolve stage latencies and /download TTFB, bytes and throughput."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def client_key(request: Request) -> str:
+    """Client identity for rate limiting: the peer address, or the hop our reverse proxy appended."""
+    if settings.trust_forwarded_for:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return request.client.host if request.client else ""
+
+
+@app.post(
+    "/resolve",
+    response_model=ResolvedFile,
+    responses={400: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+)
+async def resolve_endpoint(payload: ResolveRequest, request: Request):
+    client_limiter.check(client_key(request))
     try:
         result = await resolve_terabox(payload)
         return result
+    except Overloaded:
+        raise
     except ValueError as ve:
         logger.warning(f"Resolve error: {ve}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -56,11 +173,75 @@ async def resolve_endpoint(payload: ResolveRequest):
         raise HTTPException(status_code=500, detail="Failed to resolve link")
 
 
+@app.post("/resolve/batch", responses={400: {"model": ErrorResponse}, 429: {"model": ErrorResponse}})
+async def resolve_batch_endpoint(payload: BatchResolveRequest, request: Request):
+    """Resolve many share links; results stream back as NDJSON lines in completion order."""
+    if len(payload.items) > settings.batch_max_items:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {settings.batch_max_items} items")
+    # A batch costs one token per link, capped at the bucket size
+    client_limiter.check(client_key(request), cost=len(payload.items))
+    concurrency = min(payload.concurrency or settings.batch_concurrency, settings.batch_max_concurrency)
+
+    async def lines():
+        async for result in resolve_batch(payload.items, concurrency):
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def _open_folder(payload: FolderResolveRequest, request: Request):
+    client_limiter.check(client_key(request))
+    try:
+        return await resolve_folder(payload)
+    except Overloaded:
+        raise
+    except ValueError as ve:
+        logger.warning(f"Folder resolve error: {ve}")
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception:
+        logger.exception("Unexpected folder resolve error")
+        raise HTTPException(status_code=500, detail="Failed to resolve link")
+
+
+@app.post(
+    "/resolve/files",
+    response_model=ResolvedFolder,
+    responses={400: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+)
+async def resolve_files_endpoint(payload: FolderResolveRequest, request: Request):
+    """List every file in a share, one page at a time, with metadata probed concurrently."""
+    total, stop, results = await _open_folder(payload, request)
+    files = sorted([result async for result in results], key=lambda result: result.index)
+    return ResolvedFolder(
+        total=total,
+        offset=min(payload.offset, total),
+        next_offset=stop if stop < total else None,
+        files=[result.file for result in files],
+    )
+
+
+@app.post(
+    "/resolve/files/stream",
+    responses={400: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+)
+async def resolve_files_stream_endpoint(payload: FolderResolveRequest, request: Request):
+    """Like /resolve/files, but each file streams back as an NDJSON line as soon as its probe finishes."""
+    _, _, results = await _open_folder(payload, request)
+
+    async def lines():
+        async for result in results:
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @app.get(
     "/download",
     responses={
         400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
         500: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
     },
 )
 async def download_endpoint(
@@ -72,68 +253,531 @@ async def download_endpoint(
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
         description="User-Agent to use upstream",
     ),
+    accelerate: bool = Query(
+        False,
+        description="Fetch from upstream over several parallel range requests (needs upstream range support)",
+    ),
+    share_url: Optional[str] = Query(
+        None, description="Share page the link was resolved from, to resolve it again once the link expires"
+    ),
 ):
-    # Forward Range header if present to support resume
+    client_id = client_key(request)
+    client_limiter.check(client_id)
+    info = None
+    if any(name in request.headers for name in CONDITIONAL_HEADERS):
+        # Validators come from cached metadata, so a matching probe never reaches the CDN
+        info = file_metadata.lookup(url, cookie, _metadata_headers(user_agent, cookie))
+        if info is None and ("if-none-match" in request.headers or "if-modified-since" in request.headers):
+            # Not seen yet: one HEAD (shared with concurrent callers) decides before any body is opened
+            info, _ = await file_metadata.get(url, cookie, _metadata_headers(user_agent, cookie))
+        if info is not None and info.not_modified(request.headers):
+            return _not_modified(info)
+    # One slot per CDN host for the whole stream; released when the response is done
+    release = await download_gate.enter(host_of(url))
+    try:
+        response = await _proxy_download(request, url, filename, cookie, user_agent, accelerate, info, share_url)
+    except BaseException:
+        release()
+        raise
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = bandwidth.pace(response.body_iterator, client_id, host_of(url))
+    tasks = BackgroundTasks()
+    if response.background is not None:
+        tasks.add_task(response.background)
+    tasks.add_task(release)
+    response.background = tasks
+    return response
+
+
+@app.head(
+    "/download",
+    responses={404: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 502: {"model": ErrorResponse}},
+)
+async def download_head_endpoint(
+    request: Request,
+    url: str = Query(..., description="Direct file URL to proxy"),
+    filename: Optional[str] = Query(None, description="Optional filename for Content-Disposition"),
+    cookie: Optional[str] = Query(None, description="Optional Cookie header for upstream"),
+    user_agent: Optional[str] = Query(
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
+        description="User-Agent to use upstream",
+    ),
+    share_url: Optional[str] = Query(
+        None, description="Share page the link was resolved from, to resolve it again once the link expires"
+    ),
+):
+    """Headers a GET /download would send, answered from cached file metadata when possible."""
+    client_limiter.check(client_key(request))
+    info, status = await file_metadata.get(url, cookie, _metadata_headers(user_agent, cookie))
+    origin = share_url_for(url, share_url)
+    if info is None and origin and status in EXPIRED_STATUSES:
+        url = await _refreshed_link(origin, cookie, user_agent, url, status)
+        info, status = await file_metadata.get(url, cookie, _metadata_headers(user_agent, cookie))
+    if info is None:
+        if status is not None and status >= 400:
+            return Response(status_code=status)
+        return Response(status_code=502)
+    if info.not_modified(request.headers):
+        return _not_modified(info)
+
+    headers = {"Accept-Ranges": info.headers.get("accept-ranges", "bytes"), **info.validator_headers()}
+    disp_name = filename or info.filename
+    if disp_name:
+        headers["Content-Disposition"] = f"attachment; filename=\"{disp_name}\""
+    content_type = info.headers.get("content-type", "application/octet-stream")
+    status_code = 200
+    spans = None
     range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or info.if_range_matches(if_range)):
+        spans = parse_ranges(range_header, info.size)
+    if spans is None:
+        headers["Content-Length"] = str(info.size)
+    elif not spans:
+        return _range_not_satisfiable(info.size)
+    elif len(spans) == 1:
+        status_code = 206
+        headers["Content-Range"] = content_range(spans[0], info.size)
+        headers["Content-Length"] = str(spans[0][1] - spans[0][0] + 1)
+    else:
+        status_code = 206
+        boundary = secrets.token_hex(16)
+        heads, tail = multipart_parts(spans, info.size, content_type, boundary)
+        headers["Content-Length"] = str(multipart_length(heads, spans, tail))
+        content_type = f"multipart/byteranges; boundary={boundary}"
+    return Response(status_code=status_code, headers=headers, media_type=content_type)
+
+
+# Request headers that make a GET /download conditional
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since", "if-range")
 
+
+def _metadata_headers(user_agent: Optional[str], cookie: Optional[str]) -> dict:
     headers = {"User-Agent": user_agent}
-    if range_header:
-        headers["Range"] = range_header
     if cookie:
         headers["Cookie"] = cookie
+    return headers
+
 
+def _not_modified(info: FileInfo) -> Response:
+    file_metadata.not_modified += 1
+    return Response(status_code=304, headers=info.validator_headers())
+
+
+def _range_not_satisfiable(size: int) -> Response:
+    return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+
+async def _refreshed_link(
+    share_url: str, cookie: Optional[str], user_agent: Optional[str], url: str, status: Optional[int]
+) -> str:
+    """A new direct link for an expired one; the expiry status is reported if the share cannot be resolved."""
     try:
-        client = httpx.AsyncClient(follow_redirects=True, timeout=60)
+        return await refresh_link(share_url, cookie, user_agent, url)
+    except (Overloaded, HTTPException):
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Failed to initialize HTTP client")
-
-    async def streamer():
-        async with client as c:
-            async with c.stream("GET", url, headers=headers) as resp:
-                # Raise for status but allow 206 Partial Content as OK
-                if resp.status_code >= 400:
-                    text = await resp.aread()
-                    raise HTTPException(status_code=resp.status_code, detail=text.decode(errors="ignore")[:500])
-                async for chunk in resp.aiter_bytes():
-                    yield chunk
-
-    # We need to first make a HEAD/initial GET to fetch headers to set response headers properly
-    async with httpx.AsyncClient(follow_redirects=True, timeout=60) as probe:
-        try:
-            r = await probe.get(url, headers=headers, timeout=60)
-            if r.status_code >= 400:
-                raise HTTPException(status_code=r.status_code, detail=f"Upstream responded {r.status_code}")
-        except HTTPException:
-            raise
-        except Exception:
-            logger.exception("Failed to probe upstream URL")
-            raise HTTPException(status_code=500, detail="Failed to contact upstream")
-
-        content_type = r.headers.get("content-type", "application/octet-stream")
-        content_length = r.headers.get("content-length")
-        status_code = 206 if range_header and r.status_code == 206 else 200
-
-        response = StreamingResponse(streamer(), media_type=content_type, status_code=status_code)
-
-        if content_length and not range_header:
+        logger.warning(f"Re-resolving {share_url} failed: {e}")
+        raise HTTPException(status_code=status or 403, detail=f"Link expired and re-resolving the share failed: {e}")
+
+
+async def _proxy_download(
+    request: Request,
+    url: str,
+    filename: Optional[str],
+    cookie: Optional[str],
+    user_agent: Optional[str],
+    accelerate: bool,
+    info: Optional[FileInfo] = None,
+    share_url: Optional[str] = None,
+) -> StreamingResponse:
+    started = time.perf_counter()
+    origin = share_url_for(url, share_url)
+    if origin and link_expired(url):
+        # Known to be dead: resolve the share again before asking anything upstream
+        url = await _refreshed_link(origin, cookie, user_agent, url, None)
+    # Forward Range header if present to support resume
+    range_header = request.headers.get("range")
+    if range_header and info is None:
+        # Ranges are validated against the file size, usually already cached by the resolve
+        info, _ = await file_metadata.get(url, cookie, _metadata_headers(user_agent, cookie))
+    if_range = request.headers.get("if-range") if range_header else None
+    if if_range and info is not None:
+        # Decided here from cached validators: a stale validator gets the whole file
+        if not info.if_range_matches(if_range):
+            range_header = None
+        if_range = None
+
+    headers = {"User-Agent": user_agent}
+    if settings.relay_raw:
+        # Undecoded bytes are relayed, so only ask upstream for encodings the client accepts
+        headers["Accept-Encoding"] = request.headers.get("accept-encoding", "identity")
+    if cookie:
+        headers["Cookie"] = cookie
+
+    span: Optional[Span] = None
+    if range_header and info is not None:
+        spans = parse_ranges(range_header, info.size)
+        if spans is None:
+            # Not a byte range we understand: ignored, as RFC 7233 requires
+            range_header = None
+        elif not spans:
+            return _range_not_satisfiable(info.size)
+        else:
+            # Offsets refer to the unencoded file
+            headers["Accept-Encoding"] = "identity"
+            if len(spans) > 1:
+                return _multipart_download(url, filename, headers, spans, info)
+            span = spans[0]
+            range_header = f"bytes={span[0]}-{span[1]}"
+    if range_header:
+        headers["Range"] = range_header
+    if if_range:
+        # Unknown validator: let upstream decide between the range and the whole file
+        headers["If-Range"] = if_range
+
+    # Open a single streamed upstream request: its status and headers drive the
+    # response, and its body is relayed as-is (no separate probe request)
+    client = get_cdn_client()
+
+    # Files seen before are served from cached chunks, fetching only missing chunks upstream
+    # The chunk cache cannot evaluate If-Range, so such requests go upstream
+    cached = None if if_range else await download_cache.open(url, cookie, client, headers, range_header)
+    if cached is not None:
+        download_ttfb_seconds.observe(time.perf_counter() - started, source="cache")
+        return _cached_response(cached, range_header, filename)
+
+    try:
+        upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        if upstream.status_code in EXPIRED_STATUSES and origin:
+            await upstream.aclose()
+            url = await _refreshed_link(origin, cookie, user_agent, url, upstream.status_code)
+            upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except (HTTPException, Overloaded):
+        raise
+    except Exception:
+        logger.exception("Failed to contact upstream URL")
+        raise HTTPException(status_code=500, detail="Failed to contact upstream")
+    download_ttfb_seconds.observe(time.perf_counter() - started, source="upstream")
+
+    if upstream.status_code >= 400:
+        await upstream.aclose()
+        raise HTTPException(status_code=upstream.status_code, detail=f"Upstream responded {upstream.status_code}")
+    file_metadata.store(url, cookie, upstream)
+
+    # Raw mode relays the bytes as sent, so the upstream encoding and length stay valid
+    raw = settings.relay_raw
+    content_encoding = upstream.headers.get("content-encoding", "identity").lower()
+    # An upstream that ignores Range sends the whole file; the requested span is cut out of it here
+    sliced = span is not None and upstream.status_code == 200 and content_encoding == "identity"
+    # Fetch the rest of the file as parallel byte ranges when the upstream allows it
+    plan = segment_plan(upstream) if accelerate and not sliced else None
+    if accelerate and not sliced and not plan:
+        segmented_stats["fallbacks"] += 1
+    # Otherwise a single stream that is reopened at its offset if it breaks or its link expires
+    resumable = None if plan or sliced or not settings.download_resume_attempts else resume_plan(upstream)
+    if plan:
+        body = SegmentedFetcher(client, url, headers, upstream, *plan).stream()
+    elif resumable:
+        body = ResumableStream(client, url, headers, upstream, resumable, origin, cookie).stream()
+    elif raw:
+        body = relay_raw(upstream, settings.relay_chunk_size, settings.relay_flush_interval)
+    else:
+        body = upstream.aiter_bytes()
+    body = download_cache.wrap(url, cookie, upstream, body)
+    if sliced:
+        body = slice_body(body, *span)
+
+    content_type = upstream.headers.get("content-type", "application/octet-stream")
+    content_length = upstream.headers.get("content-length")
+    status_code = 206 if sliced or (range_header and upstream.status_code == 206) else 200
+
+    # The upstream response is closed once streaming ends, including on client disconnect
+    response = StreamingResponse(
+        metered(body),
+        media_type=content_type,
+        status_code=status_code,
+        background=BackgroundTask(upstream.aclose),
+    )
+
+    if content_encoding != "identity" and raw:
+        response.headers["Content-Encoding"] = upstream.headers["content-encoding"]
+    if sliced:
+        response.headers["Content-Length"] = str(span[1] - span[0] + 1)
+        response.headers["Content-Range"] = content_range(span, info.size)
+        response.headers["Accept-Ranges"] = "bytes"
+    else:
+        # For a 206 this is the length of the part
+        if content_length and (raw or content_encoding == "identity"):
             response.headers["Content-Length"] = content_length
         # Forward Accept-Ranges and Content-Range if present
-        if r.headers.get("accept-ranges"):
-            response.headers["Accept-Ranges"] = r.headers["accept-ranges"]
-        if r.headers.get("content-range"):
-            response.headers["Content-Range"] = r.headers["content-range"]
-
-        # Content-Disposition
-        disp_name = filename
-        if not disp_name:
-            # Try to infer from upstream headers
-            from .resolver import _filename_from_headers  # type: ignore
-
-            disp_name = _filename_from_headers(r.headers)  # type: ignore
-        if disp_name:
-            response.headers["Content-Disposition"] = f"attachment; filename=\"{disp_name}\""
-
-        return response
+        if upstream.headers.get("accept-ranges"):
+            response.headers["Accept-Ranges"] = upstream.headers["accept-ranges"]
+        if upstream.headers.get("content-range"):
+            response.headers["Content-Range"] = upstream.headers["content-range"]
+    for name in ("etag", "last-modified"):
+        if upstream.headers.get(name):
+            response.headers[name] = upstream.headers[name]
+
+    # Content-Disposition
+    disp_name = filename
+    if not disp_name:
+        # Try to infer from upstream headers
+        from .resolver import _filename_from_headers  # type: ignore
+
+        disp_name = _filename_from_headers(upstream.headers)  # type: ignore
+    if disp_name:
+        response.headers["Content-Disposition"] = f"attachment; filename=\"{disp_name}\""
+
+    return response
+
+
+def _multipart_download(
+    url: str, filename: Optional[str], headers: dict, spans: List[Span], info: FileInfo
+) -> StreamingResponse:
+    """A multipart/byteranges response; parts are fetched one after another, from the chunk cache or upstream."""
+    client = get_cdn_client()
+    boundary = secrets.token_hex(16)
+    heads, tail = multipart_parts(spans, info.size, info.headers.get("content-type", "application/octet-stream"), boundary)
+
+    async def body():
+        for head, span in zip(heads, spans):
+            yield head
+            async for chunk in _range_body(client, url, headers, span, info.size):
+                yield chunk
+        yield tail
+
+    response = StreamingResponse(
+        metered(body()), status_code=206, media_type=f"multipart/byteranges; boundary={boundary}"
+    )
+    response.headers["Content-Length"] = str(multipart_length(heads, spans, tail))
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers.update(info.validator_headers())
+    disp_name = filename or info.filename
+    if disp_name:
+        response.headers["Content-Disposition"] = f"attachment; filename=\"{disp_name}\""
+    return response
+
+
+async def _range_body(
+    client: httpx.AsyncClient, url: str, headers: dict, span: Span, size: int
+) -> AsyncIterator[bytes]:
+    part = f"bytes={span[0]}-{span[1]}"
+    cached = await download_cache.open(url, headers.get("Cookie"), client, headers, part)
+    if cached is not None:
+        try:
+            async for chunk in cached.body:
+                yield chunk
+        finally:
+            await cached.aclose()
+        return
+    upstream = await client.send(client.build_request("GET", url, headers={**headers, "Range": part}), stream=True)
+    try:
+        body = relay_raw(upstream, settings.relay_chunk_size, settings.relay_flush_interval)
+        if upstream.status_code == 200:
+            body = slice_body(body, *span)
+        elif upstream.status_code != 206 or upstream.headers.get("content-range") != content_range(span, size):
+            # Anything else would corrupt the part; abort the response instead
+            raise RuntimeError(f"Upstream answered {part} with {upstream.status_code}")
+        async for chunk in body:
+            yield chunk
+    finally:
+        await upstream.aclose()
+
+
+@app.post(
+    "/download/zip",
+    responses={
+        400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        500: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+)
+async def download_zip_endpoint(payload: ZipDownloadRequest, request: Request):
+    """Stream several files as one ZIP64 archive of stored entries, built on the fly."""
+    if len(payload.files) > settings.zip_max_files:
+        raise HTTPException(status_code=400, detail=f"Archive exceeds {settings.zip_max_files} files")
+    # One token per file, like a batch
+    client_id = client_key(request)
+    client_limiter.check(client_id, cost=len(payload.files))
+    headers = {"User-Agent": payload.user_agent, "Accept-Encoding": "identity"}
+    if payload.cookie:
+        headers["Cookie"] = payload.cookie
+    client = get_cdn_client()
+    # Open the first entry up front so an unreachable upstream is reported as an HTTP error.
+    # Each entry holds a download slot for its own host while it is open.
+    try:
+        first = await open_entry(client, payload.files[0].url, headers, download_gate)
+    except Overloaded:
+        raise
+    except Exception:
+        logger.exception("Failed to contact upstream URL")
+        raise HTTPException(status_code=500, detail="Failed to contact upstream")
+    first_resp, first_release = first
+    if first_resp.status_code >= 400:
+        await first_resp.aclose()
+        first_release()
+        raise HTTPException(status_code=first_resp.status_code, detail=f"Upstream responded {first_resp.status_code}")
+
+    body = stream_zip(
+        client,
+        headers,
+        payload.files,
+        first,
+        download_gate,
+        settings.zip_prefetch,
+        settings.relay_chunk_size,
+        settings.relay_flush_interval,
+    )
+    tasks = BackgroundTasks()
+    # Closes the first entry and frees its slot even if the body never starts
+    tasks.add_task(first_resp.aclose)
+    tasks.add_task(first_release)
+    response = StreamingResponse(
+        bandwidth.pace(metered(body), client_id, f"zip:{len(payload.files)}"), media_type="application/zip", background=tasks
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=\"{payload.filename}\""
+    return response
+
+
+def _require_jobs() -> None:
+    if not jobs.enabled:
+        raise HTTPException(status_code=404, detail="Background jobs are disabled (set TB_JOB_DIR)")
+
+
+def _job_or_404(job_id: str) -> Job:
+    _require_jobs()
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.post(
+    "/jobs",
+    status_code=202,
+    response_model=JobInfo,
+    responses={404: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 503: {"model": ErrorResponse}},
+)
+async def submit_job_endpoint(payload: ResolveRequest, request: Request):
+    """Resolve a share and fetch its file to server storage in the background."""
+    _require_jobs()
+    client_limiter.check(client_key(request))
+    job = await jobs.submit(payload)
+    return job.info()
+
+
+@app.get("/jobs", response_model=List[JobInfo], responses={404: {"model": ErrorResponse}})
+async def list_jobs_endpoint():
+    """Every known job, newest first."""
+    _require_jobs()
+    return [job.info() for job in jobs.list()]
+
+
+@app.get("/jobs/{job_id}", response_model=JobInfo, responses={404: {"model": ErrorResponse}})
+async def job_endpoint(job_id: str):
+    return _job_or_404(job_id).info()
+
+
+@app.delete("/jobs/{job_id}", response_model=JobInfo, responses={404: {"model": ErrorResponse}})
+async def delete_job_endpoint(job_id: str):
+    """Cancel a job that has not finished, and delete its stored file."""
+    job = _job_or_404(job_id)
+    await jobs.remove(job)
+    return job.info()
+
+
+@app.get("/jobs/{job_id}/events", responses={404: {"model": ErrorResponse}})
+async def job_events_endpoint(job_id: str):
+    """Server-Sent Events: a ``progress`` event as the job advances, then one named after its final state."""
+    job = _job_or_404(job_id)
+
+    async def events():
+        async for info in jobs.watch(job, settings.job_event_interval):
+            if info is None:
+                yield ": keep-alive\n\n"
+                continue
+            name = info.state if job.finished and info.state == job.state else "progress"
+            yield f"event: {name}\ndata: {info.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get(
+    "/jobs/{job_id}/file",
+    responses={404: {"model": ErrorResponse}, 409: {"model": ErrorResponse}, 429: {"model": ErrorResponse}},
+)
+async def job_file_endpoint(job_id: str, request: Request):
+    """The fetched file of a finished job, with single-range support."""
+    job = _job_or_404(job_id)
+    if job.state != DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job.state}")
+    client_id = client_key(request)
+    client_limiter.check(client_id)
+    # The file of a job never changes, so its id and size make a strong validator
+    etag = f'"{job.id}-{job.size}"'
+    headers = {"Accept-Ranges": "bytes", "ETag": etag}
+    if job.filename:
+        headers["Content-Disposition"] = f"attachment; filename=\"{job.filename}\""
+    span: Span = (0, job.size - 1)
+    status_code = 200
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        spans = parse_ranges(range_header, job.size)
+        if spans == []:
+            return _range_not_satisfiable(job.size)
+        # Several ranges get the whole file, which RFC 7233 allows
+        if spans is not None and len(spans) == 1:
+            span = spans[0]
+            status_code = 206
+            headers["Content-Range"] = content_range(span, job.size)
+    headers["Content-Length"] = str(span[1] - span[0] + 1)
+    response = JobFileResponse(
+        jobs.file_path(job),
+        span,
+        status_code=status_code,
+        headers=headers,
+        media_type=job.content_type or "application/octet-stream",
+    )
+    response.body_iterator = bandwidth.pace(metered(response.body_iterator), client_id, f"job:{job.id}")
+    return response
+
+
+def _cached_response(cached: CachedRead, range_header: Optional[str], filename: Optional[str]) -> StreamingResponse:
+    meta = cached.meta
+    response = StreamingResponse(
+        metered(cached.body),
+        media_type=meta.content_type or "application/octet-stream",
+        status_code=206 if range_header else 200,
+        background=BackgroundTask(cached.aclose),
+    )
+    response.headers["Content-Length"] = str(cached.end - cached.start + 1)
+    response.headers["Accept-Ranges"] = "bytes"
+    if range_header:
+        response.headers["Content-Range"] = f"bytes {cached.start}-{cached.end}/{meta.size}"
+    response.headers.update(meta.validator_headers())
+    disp_name = filename or meta.filename
+    if disp_name:
+        response.headers["Content-Disposition"] = f"attachment; filename=\"{disp_name}\""
+    return response
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    logger.warning(f"Shedding {request.method} {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(int(exc.retry_after))}
+    )
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(int(exc.retry_after))}
+    )
 
 
 @app.exception_handler(httpx.HTTPError)
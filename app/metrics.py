@@ -0,0 +1,302 @@
+import cProfile
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Iterator, AsyncIterator, Sequence
+
+from .logger import logger, request_stages
+
+
+LabelValues = Tuple[str, ...]
+
+# Latency buckets in seconds, from sub-millisecond scans to slow browser fallbacks
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Share page sizes in bytes (1 KB .. 4 MB)
+PAGE_BYTES_BUCKETS = (1e3, 4e3, 1.6e4, 3.2e4, 6.4e4, 1.28e5, 2.56e5, 5.12e5, 1e6, 2e6, 4e6)
+# Per-stream throughput buckets in bytes per second (100 KB/s .. 1 GB/s)
+THROUGHPUT_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        # Unlabelled metrics are exported as 0 before their first update
+        self._values: Dict[LabelValues, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (non-cumulative, +Inf last), sum]
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+resolve_stage_seconds = registry.register(
+    Histogram(
+        "terabox_resolve_stage_seconds",
+        "Time spent in each resolve stage (page fetch, link scans, strategies, metadata probes).",
+        ["stage"],
+    )
+)
+resolve_total = registry.register(
+    Counter("terabox_resolve_total", "Resolve requests by outcome.", ["outcome"])
+)
+resolve_page_bytes = registry.register(
+    Histogram(
+        "terabox_resolve_page_bytes",
+        "Share page bytes read per fetch, by whether the fetch stopped at an early match.",
+        ["read"],
+        buckets=PAGE_BYTES_BUCKETS,
+    )
+)
+resolve_page_first_match_seconds = registry.register(
+    Histogram(
+        "terabox_resolve_page_first_match_seconds",
+        "Time from sending a share page request to the first decisive link match in its body.",
+    )
+)
+download_ttfb_seconds = registry.register(
+    Histogram(
+        "terabox_download_ttfb_seconds",
+        "Time until response headers are available for a /download, by source (upstream or cache).",
+        ["source"],
+    )
+)
+download_bytes_total = registry.register(
+    Counter("terabox_download_bytes_total", "Bytes relayed to /download clients.")
+)
+download_active_streams = registry.register(
+    Gauge("terabox_download_active_streams", "/download responses currently streaming.")
+)
+download_streams_total = registry.register(
+    Counter("terabox_download_streams_total", "Finished /download streams by outcome.", ["outcome"])
+)
+download_stream_throughput = registry.register(
+    Histogram(
+        "terabox_download_stream_throughput_bytes_per_second",
+        "Average throughput of each finished /download stream.",
+        buckets=THROUGHPUT_BUCKETS,
+    )
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a block as one resolve stage, also adding it to the current request's stage timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name: str, elapsed: float) -> None:
+    resolve_stage_seconds.observe(elapsed, stage=name)
+    stages = request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + elapsed
+
+
+async def metered(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Relay a download body while recording bytes, active streams and stream throughput."""
+    download_active_streams.inc()
+    start = time.perf_counter()
+    sent = 0
+    outcome = "aborted"
+    try:
+        async for chunk in body:
+            sent += len(chunk)
+            download_bytes_total.inc(len(chunk))
+            yield chunk
+        outcome = "complete"
+    finally:
+        download_active_streams.dec()
+        download_streams_total.inc(outcome=outcome)
+        elapsed = time.perf_counter() - start
+        if sent and elapsed > 0:
+            download_stream_throughput.observe(sent / elapsed)
+
+
+class ProfilingMiddleware:
+    """Profiles a random sample of requests with cProfile and writes the stats to disk.
+
+    cProfile follows the event loop thread, so a profile also contains the
+    work of other requests that ran concurrently. Streaming bodies are not
+    included, only the handler up to the response start. One request is
+    profiled at a time.
+    """
+
+    def __init__(self, app: Any, sample_rate: float, directory: str) -> None:
+        self.app = app
+        self.sample_rate = sample_rate
+        self.directory = Path(directory)
+        self._active = False
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or self._active or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+        self._active = True
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                profiler.disable()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            self._active = False
+            self._dump(profiler, scope, time.perf_counter() - started)
+
+    def _dump(self, profiler: cProfile.Profile, scope: Dict[str, Any], elapsed: float) -> None:
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}{scope['path'].replace('/', '_')}.prof"
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(self.directory / name))
+        except OSError as e:
+            logger.warning(f"Could not write profile {name}: {e}")
+            return
+        logger.info(f"Profiled {scope['method']} {scope['path']} ({elapsed:.3f}s) -> {self.directory / name}")
+
+
+def render_metrics() -> str:
+    return registry.render()
+
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "ProfilingMiddleware",
+    "registry",
+    "resolve_stage_seconds",
+    "resolve_total",
+    "resolve_page_bytes",
+    "resolve_page_first_match_seconds",
+    "download_ttfb_seconds",
+    "download_bytes_total",
+    "download_active_streams",
+    "download_streams_total",
+    "download_stream_throughput",
+    "stage",
+    "record_stage",
+    "metered",
+    "render_metrics",
+]
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, HttpUrl, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 
 class ResolveRequest(BaseModel):
@@ -30,6 +30,91 @@ class ResolvedFile(BaseModel):
     headers: Dict[str, Any] = {}
 
 
+class BatchResolveRequest(BaseModel):
+    items: List[ResolveRequest] = Field(..., min_length=1, description="Share links to resolve")
+    concurrency: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Max resolves running at once for this batch (capped by the server)",
+    )
+
+
+class BatchResolveResult(BaseModel):
+    index: int = Field(..., description="Position of the item in the request")
+    url: str
+    ok: bool
+    result: Optional[ResolvedFile] = None
+    status_code: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class FolderResolveRequest(ResolveRequest):
+    offset: int = Field(0, ge=0, description="Index of the first listed file to return")
+    limit: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Max files to return (defaults to and is capped by the server's page size)",
+    )
+    probe: bool = Field(
+        default=True,
+        description="Probe each returned file's link for size, type and headers",
+    )
+    concurrency: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Max metadata probes running at once (capped by the server)",
+    )
+
+
+class ResolvedFolder(BaseModel):
+    total: int = Field(..., description="Number of files listed in the share")
+    offset: int
+    next_offset: Optional[int] = Field(None, description="Offset of the next page, if any")
+    files: List[ResolvedFile]
+
+
+class FolderFileResult(BaseModel):
+    index: int = Field(..., description="Position of the file in the share listing")
+    total: int
+    file: ResolvedFile
+
+
+class ZipItem(BaseModel):
+    url: str = Field(..., description="Direct file URL to include")
+    filename: Optional[str] = Field(
+        default=None,
+        description="Entry name in the archive (defaults to the upstream filename)",
+    )
+
+
+class ZipDownloadRequest(BaseModel):
+    files: List[ZipItem] = Field(..., min_length=1, description="Files to stream into the archive, in order")
+    filename: str = Field("download.zip", description="Archive filename for Content-Disposition")
+    cookie: Optional[str] = Field(default=None, description="Optional Cookie header for upstream")
+    user_agent: Optional[str] = Field(
+        default=(
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+            "(KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
+        ),
+        description="User-Agent to use upstream",
+    )
+
+
+class JobInfo(BaseModel):
+    id: str
+    state: str = Field(..., description="queued, running, done, failed or cancelled")
+    url: str = Field(..., description="Share URL being fetched")
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+    size: Optional[int] = Field(None, description="File size in bytes, once known")
+    bytes_done: int = Field(0, description="Bytes stored so far")
+    rate_bytes_per_second: float = Field(0, description="Recent fetch rate while running")
+    attempts: int = Field(0, description="Failed attempts since the job last made progress")
+    error: Optional[str] = Field(None, description="Last error, if any")
+    created_at: float
+    updated_at: float
+
+
 class ErrorResponse(BaseModel):
     detail: str
     info: Optional[Dict[str, Any]] = None
@@ -0,0 +1,108 @@
+import re
+from typing import List, Optional, Tuple, AsyncIterator
+
+from .config import settings
+
+
+Span = Tuple[int, int]
+
+RANGE_SPEC_RE = re.compile(r"^(\d*)-(\d*)$")
+
+
+def parse_ranges(header: str, size: int) -> Optional[List[Span]]:
+    """Inclusive byte spans of a ``Range`` header against a file of ``size`` bytes (RFC 7233).
+
+    Returns None when the header must be ignored (another unit or a syntax
+    error), and an empty list when no range is satisfiable (416). Suffix
+    (``-500``) and open-ended (``9500-``) ranges are resolved, and ends are
+    clamped to the file. Overlapping or adjacent ranges are coalesced in
+    ascending order. More than ``TB_RANGE_MAX_PARTS`` ranges are treated as
+    unsatisfiable.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    spans: List[Span] = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or match.group(1) == match.group(2) == "":
+            return None
+        first, last = match.group(1), match.group(2)
+        if first == "":
+            length = int(last)
+            if length and size:
+                spans.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            spans.append((start, min(int(last), size - 1) if last else size - 1))
+    if len(spans) > 1:
+        ordered = sorted(spans)
+        if any(b[0] <= a[1] + 1 for a, b in zip(ordered, ordered[1:])):
+            merged = [ordered[0]]
+            for start, end in ordered[1:]:
+                if start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            spans = merged
+    if len(spans) > settings.range_max_parts:
+        return []
+    return spans
+
+
+def single_range(header: Optional[str], size: int) -> Optional[Span]:
+    """Inclusive span requested by a single-range ``Range`` header (the whole file if absent).
+
+    Returns None for multi-range, malformed or unsatisfiable headers.
+    """
+    if not header:
+        return (0, size - 1) if size else None
+    spans = parse_ranges(header, size)
+    return spans[0] if spans and len(spans) == 1 else None
+
+
+def content_range(span: Span, size: int) -> str:
+    return f"bytes {span[0]}-{span[1]}/{size}"
+
+
+def multipart_parts(spans: List[Span], size: int, content_type: str, boundary: str) -> Tuple[List[bytes], bytes]:
+    """Per-part headers and the closing delimiter of a ``multipart/byteranges`` body."""
+    heads = [
+        (b"\r\n" if i else b"")
+        + f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: {content_range(span, size)}\r\n\r\n".encode()
+        for i, span in enumerate(spans)
+    ]
+    return heads, f"\r\n--{boundary}--\r\n".encode()
+
+
+def multipart_length(heads: List[bytes], spans: List[Span], tail: bytes) -> int:
+    return sum(len(head) for head in heads) + sum(end - start + 1 for start, end in spans) + len(tail)
+
+
+async def slice_body(body: AsyncIterator[bytes], start: int, end: int) -> AsyncIterator[bytes]:
+    """Bytes ``start``..``end`` (inclusive) of a full-file body, for upstreams that ignore ``Range``."""
+    pos = 0
+    async for chunk in body:
+        next_pos = pos + len(chunk)
+        if next_pos > start:
+            yield chunk[max(0, start - pos) : end + 1 - pos]
+        pos = next_pos
+        if pos > end:
+            return
+
+
+__all__ = [
+    "Span",
+    "parse_ranges",
+    "single_range",
+    "content_range",
+    "multipart_parts",
+    "multipart_length",
+    "slice_body",
+]
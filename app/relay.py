@@ -0,0 +1,70 @@
+import asyncio
+import time
+from typing import List, Optional, AsyncIterator
+
+import httpx
+
+
+async def relay_raw(resp: httpx.Response, chunk_size: int, flush_interval: float) -> AsyncIterator[bytes]:
+    """Relay an upstream body exactly as received, coalesced into chunks of up to ``chunk_size`` bytes.
+
+    Bytes are not decoded, so the upstream ``Content-Encoding`` and
+    ``Content-Length`` stay valid. Large reads pass through without copying.
+    Small reads are joined with one copy, so the server handles a few large
+    sends instead of many socket-sized ones. Buffered bytes are flushed after
+    ``flush_interval`` seconds, even while upstream stalls, so a slow
+    upstream does not delay the client.
+
+    Upstream is read only when the server asks for the next chunk, and the
+    server first waits for a slow client's socket to drain. A stream
+    therefore never buffers more than one chunk here, plus one read that is
+    left in flight when a stall forces a flush.
+    """
+    reads = resp.aiter_raw().__aiter__()
+    pending: List[bytes] = []
+    size = 0
+    since = 0.0
+    # A read still in flight after its buffered bytes were flushed; it is never cancelled mid-read
+    read: Optional["asyncio.Future[bytes]"] = None
+    try:
+        while True:
+            if pending or read is not None:
+                if read is None:
+                    read = asyncio.ensure_future(reads.__anext__())
+                timeout = max(0.0, since + flush_interval - time.monotonic()) if pending else None
+                done, _ = await asyncio.wait((read,), timeout=timeout)
+                if not done:
+                    # Upstream stalled: send what is buffered instead of holding it until the next read
+                    yield pending[0] if len(pending) == 1 else b"".join(pending)
+                    pending.clear()
+                    size = 0
+                    continue
+                finished, read = read, None
+                try:
+                    data = finished.result()
+                except StopAsyncIteration:
+                    break
+            else:
+                # Nothing buffered: plain reads, without the cost of a task
+                try:
+                    data = await reads.__anext__()
+                except StopAsyncIteration:
+                    break
+            if not pending:
+                if len(data) >= chunk_size:
+                    yield data
+                    continue
+                since = time.monotonic()
+            pending.append(data)
+            size += len(data)
+            if size >= chunk_size or time.monotonic() - since >= flush_interval:
+                yield pending[0] if len(pending) == 1 else b"".join(pending)
+                pending.clear()
+                size = 0
+        if pending:
+            yield b"".join(pending)
+    finally:
+        if read is not None:
+            read.cancel()
+
+__all__ = ["relay_raw"]
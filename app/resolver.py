@@ -1,19 +1,23 @@
 import asyncio
-import json
 import re
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, List, Tuple
 
 import httpx
-from bs4 import BeautifulSoup
-from loguru import logger
 
+from .browser import browser_pool, BLOCKED_RESOURCE_TYPES
+from .cache import link_origins, resolve_cache
+from .config import settings
+from .file_meta import file_metadata
+from .extractor import LinkMatch, PageScanner, link_extractor
+from .http_clients import get_page_client, get_cdn_client
+from .limits import Overloaded, browser_gate, resolve_gate, host_of
+from .logger import logger, noisy
+from .metrics import stage, resolve_total, resolve_page_bytes, resolve_page_first_match_seconds
 from .models import ResolveRequest, ResolvedFile
+from .strategies import Strategy, StrategyRunner
 
 
-# Updated patterns for modern TeraBox
-INITIAL_STATE_RE = re.compile(r"window\.data\s*=\s*(\{.*?\})\s*;?\s*</script>", re.DOTALL)
-JSON_STATE_RE = re.compile(r'<script\s+id="__NEXT_DATA__"\s+type="application/json">(.*?)</script>', re.DOTALL)
-DLINK_RE = re.compile(r"\b(dlink|download|get_file|d\.terabox|file\.baidu\.com|baidupcs\.com|terabox\.com/s/)\b", re.IGNORECASE)
 URL_IN_QUOTES_RE = re.compile(r'["\'](https?://[^"\'\s]+)["\']')
 FILENAME_RE = re.compile(r'filename[^;=\n]*=(([\'"])?([^;\n]*?)(?(2)\2|))', re.IGNORECASE)
 
@@ -22,6 +26,8 @@ async def _head(client: httpx.AsyncClient, url: str, headers: Dict[str, str]) ->
     try:
         r = await client.head(url, headers=headers, follow_redirects=True, timeout=20)
         r.raise_for_status()
+        # Later HEAD and conditional /download requests for this link are answered from here
+        file_metadata.store(url, headers.get("Cookie"), r)
         info = {
             "content_length": int(r.headers.get("content-length")) if r.headers.get("content-length") else None,
             "content_type": r.headers.get("content-type"),
@@ -52,7 +58,7 @@ def _filename_from_headers(headers: httpx.Headers) -> Optional[str]:
     return None
 
 
-async def _try_parse_html(req: ResolveRequest) -> Optional[str]:
+def _page_headers(req: ResolveRequest) -> Dict[str, str]:
     headers = {
         "User-Agent": req.user_agent,
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
@@ -66,241 +72,245 @@ async def _try_parse_html(req: ResolveRequest) -> Optional[str]:
         "Sec-Fetch-Site": "same-origin",
         "Cache-Control": "max-age=0"
     }
-    
+
     if req.cookie:
         headers["Cookie"] = req.cookie
-
-    async with httpx.AsyncClient(
-        follow_redirects=True, 
-        timeout=req.timeout_seconds,
-        http2=True
-    ) as client:
-        try:
-            logger.info(f"Fetching TeraBox page: {req.url}")
-            resp = await client.get(str(req.url), headers=headers)
+    return headers
+
+
+async def _fetch_page(req: ResolveRequest) -> str:
+    client = get_page_client()
+    noisy.info("page_fetch", f"Fetching TeraBox page: {req.url}")
+    with stage("page_fetch"):
+        resp = await client.get(str(req.url), headers=_page_headers(req), timeout=req.timeout_seconds)
+        resp.raise_for_status()
+        return resp.text
+
+
+async def _scan_page_stream(req: ResolveRequest) -> Tuple[str, Optional[LinkMatch]]:
+    """Stream the share page through a PageScanner, closing the connection at the first decisive match.
+
+    Returns the text read so far and the match, or the whole page and
+    ``None`` when only a full-page scan can decide.
+    """
+    client = get_page_client()
+    scanner = PageScanner()
+    match = None
+    read = 0
+    noisy.info("page_fetch", f"Fetching TeraBox page: {req.url}")
+    started = time.perf_counter()
+    with stage("page_fetch"):
+        async with client.stream(
+            "GET", str(req.url), headers=_page_headers(req), timeout=req.timeout_seconds
+        ) as resp:
             resp.raise_for_status()
-            html = resp.text
-
-            # Try to find direct download URL in various patterns
-            patterns = [
-                # Try to find direct URLs in the page
-                (r'(https?://[^\s"\']+?/file/[^\s"\']+)', 'Direct file pattern'),
-                (r'(https?://[^\s"\']+?/share/link[^\s"\']+)', 'Share link pattern'),
-                (r'"dlink"\s*:\s*"([^"]+)"', 'DLink in JSON'),
-                (r'downloadUrl\s*[=:]\s*["\']([^"\']+)["\']', 'downloadUrl in JS'),
-            ]
-
-            for pattern, desc in patterns:
-                matches = re.findall(pattern, html, re.IGNORECASE)
-                for url in matches:
-                    url = url if isinstance(url, str) else url[0] if isinstance(url, tuple) else str(url)
-                    if any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs', 'terabox.com/s/']):
-                        logger.info(f"Found URL with {desc}: {url}")
-                        return url
-
-            # Try JSON data in script tags
-            for script in re.findall(r'<script[^>]*>([\s\S]*?)</script>', html):
-                if not script.strip():
-                    continue
-                
-                # Look for direct URLs in script content
-                urls = re.findall(r'["\'](https?://[^"\'\s]+)["\']', script)
-                for url in urls:
-                    if any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs', 'terabox.com/s/']):
-                        logger.info(f"Found URL in script: {url}")
-                        return url
-                
-                # Try to parse as JSON
-                try:
-                    data = json.loads(script)
-                    # Flatten nested JSON and search for URLs
-                    flat = {}
-                    def flatten_json(nested_json, prefix=''):
-                        if isinstance(nested_json, dict):
-                            for k, v in nested_json.items():
-                                flatten_json(v, f"{prefix}{k}.")
-                        elif isinstance(nested_json, list):
-                            for i, v in enumerate(nested_json):
-                                flatten_json(v, f"{prefix}{i}.")
-                        else:
-                            flat[prefix[:-1]] = nested_json
-                    
-                    flatten_json(data)
-                    for k, v in flat.items():
-                        if not isinstance(v, str):
-                            continue
-                        if 'url' in k.lower() and 'http' in v and any(x in v.lower() for x in ['download', 'd.terabox', 'baidupcs']):
-                            logger.info(f"Found URL in JSON data at {k}: {v}")
-                            return v
-                except (json.JSONDecodeError, TypeError):
-                    continue
-
-            # Fallback: Look for iframe or embed sources
-            soup = BeautifulSoup(html, 'html.parser')
-            for tag in soup.find_all(['iframe', 'embed', 'source', 'a']):
-                url = tag.get('src') or tag.get('href')
-                if not url or not isinstance(url, str):
-                    continue
-                if url.startswith('http') and any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs']):
-                    logger.info(f"Found URL in {tag.name} tag: {url}")
-                    return url
+            async for text in resp.aiter_text():
+                match = scanner.feed(text)
+                if match:
+                    resolve_page_first_match_seconds.observe(time.perf_counter() - started)
+                    break
+            read = resp.num_bytes_downloaded
+    resolve_page_bytes.observe(read, read="early" if match else "full")
+    if match:
+        noisy.debug("page_match", f"Matched after {read} page bytes")
+    return scanner.html, match
 
-        except Exception as e:
-            logger.warning(f"Error parsing HTML: {str(e)}")
+
+async def _try_parse_html(req: ResolveRequest) -> Optional[str]:
+    try:
+        html, match = await _scan_page_stream(req)
+
+        if not match:
+            # Same order as link_extractor.extract, timed per scan
+            lowered = html.lower()
+            with stage("scan_page"):
+                match = link_extractor.scan_page(html, lowered)
+            if not match:
+                with stage("scan_scripts"):
+                    match = link_extractor.scan_scripts(html)
+            if not match:
+                with stage("scan_dom"):
+                    match = link_extractor.scan_dom(html, lowered)
+        if match:
+            noisy.info("page_found", f"Found URL with {match.source}: {match.url}")
+            return match.url
+
+    except Exception as e:
+        logger.warning(f"Error parsing HTML: {str(e)}")
 
     return None
 
 
+# Common download button selectors, raced against each other in the browser
+DOWNLOAD_SELECTORS = [
+    "button:has-text('Download')",
+    "a:has-text('Download')",
+    "button:has-text('Download Now')",
+    "a:has-text('Download Now')",
+    "button:has-text('下载')",  # Chinese for Download
+    "a:has-text('下载')",
+    "button.download-btn",
+    "a.download-btn",
+    "button[data-action='download']",
+    "a[data-action='download']",
+    "button[onclick*='download']",
+    "a[onclick*='download']",
+]
+BROWSER_URL_KEYWORDS = ['d.terabox', 'baidupcs', 'download', 'get_file']
+
+
 async def _with_playwright(req: ResolveRequest) -> Optional[str]:
-    try:
-        from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
-    except ImportError as e:
-        logger.warning(f"Playwright module not installed: {e}")
-        return None
-    except Exception as e:
-        logger.warning(f"Playwright not available: {e}")
+    if not browser_pool.available:
+        logger.warning("Playwright module not installed")
         return None
 
     logger.info("Attempting Playwright headless resolution...")
-    
-    candidate_url: Optional[str] = None
-    
     try:
-        async with async_playwright() as p:
-            # Try with Chromium first, fall back to Firefox if needed
-            browser = None
-            for browser_type in [p.chromium, p.firefox]:
-                try:
-                    browser = await browser_type.launch(
-                        headless=True,
-                        args=['--no-sandbox', '--disable-setuid-sandbox']
-                    )
+        # Browser pages have their own small budget; excess resolves are shed rather than queued for long
+        async with browser_gate.slot("browser"):
+            return await asyncio.wait_for(_browser_resolve(req), timeout=req.timeout_seconds)
+    except Overloaded:
+        raise
+    except asyncio.TimeoutError:
+        logger.warning("Playwright resolution timed out")
+    except Exception as e:
+        logger.error(f"Playwright error: {str(e)}")
+    return None
+
+
+async def _browser_resolve(req: ResolveRequest) -> Optional[str]:
+    candidate_url: Optional[str] = None
+    found = asyncio.Event()
+
+    # Intercept network requests to find download URLs; skip heavy assets entirely
+    async def handle_route(route, request):
+        nonlocal candidate_url
+        if request.resource_type in BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+            return
+        if not found.is_set() and any(x in request.url.lower() for x in BROWSER_URL_KEYWORDS):
+            candidate_url = request.url
+            found.set()
+            logger.info(f"Intercepted potential download URL: {request.url}")
+        await route.continue_()
+
+    async with browser_pool.page(req.user_agent, req.cookie) as page:
+        await page.route('**/*', handle_route)
+        found_task = asyncio.ensure_future(found.wait())
+        goto = asyncio.ensure_future(
+            page.goto(str(req.url), timeout=req.timeout_seconds * 1000, wait_until="domcontentloaded")
+        )
+        pending: Dict[asyncio.Future, str] = {}
+        try:
+            # Navigate, but stop as soon as a download URL is intercepted
+            logger.info(f"Navigating to: {req.url}")
+            await asyncio.wait([goto, found_task], return_when=asyncio.FIRST_COMPLETED)
+            if goto.done() and goto.exception() is not None:
+                logger.warning(f"Page load did not complete ({goto.exception()}), continuing with current state")
+
+            # Race all selectors; click each button as it appears until a URL is intercepted
+            for selector in DOWNLOAD_SELECTORS:
+                if found.is_set():
                     break
-                except Exception as e:
-                    logger.warning(f"Failed to launch {browser_type.name}: {e}")
-                    continue
-            
-            if not browser:
-                logger.error("Failed to launch any browser")
-                return None
-                
-            try:
-                context = await browser.new_context(
-                    user_agent=req.user_agent,
-                    viewport={'width': 1920, 'height': 1080},
-                    extra_http_headers={
-                        "Accept-Language": "en-US,en;q=0.9",
-                        "Accept-Encoding": "gzip, deflate, br",
-                        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-                        "Referer": "https://www.terabox.com/",
-                        "DNT": "1",
-                        "Connection": "keep-alive",
-                        "Upgrade-Insecure-Requests": "1",
-                        **({"Cookie": req.cookie} if req.cookie else {})
-                    },
-                    # Enable JavaScript and other browser features
-                    java_script_enabled=True,
-                    bypass_csp=True,
-                    ignore_https_errors=True,
+                task = asyncio.ensure_future(
+                    page.wait_for_selector(selector, timeout=settings.browser_selector_timeout * 1000)
                 )
-
-                # Intercept network requests to find download URLs
-                async def handle_route(route, request):
-                    url = request.url.lower()
-                    if any(x in url for x in ['d.terabox', 'baidupcs', 'download', 'get_file']):
-                        nonlocal candidate_url
-                        candidate_url = request.url
-                        logger.info(f"Intercepted potential download URL: {request.url}")
-                    await route.continue_()
-
-                # Create a new page
-                page = await context.new_page()
-                await page.route('**/*', handle_route)
-
-                # Navigate to the URL
-                logger.info(f"Navigating to: {req.url}")
-                try:
-                    await page.goto(
-                        str(req.url),
-                        timeout=req.timeout_seconds * 1000,
-                        wait_until="domcontentloaded"
-                    )
-                except PlaywrightTimeoutError:
-                    logger.warning("Page load timed out, continuing with current state")
-
-                # Common download button selectors
-                download_selectors = [
-                    "button:has-text('Download')",
-                    "a:has-text('Download')",
-                    "button:has-text('Download Now')",
-                    "a:has-text('Download Now')",
-                    "button:contains('下载')",  # Chinese for Download
-                    "a:contains('下载')",
-                    "button.download-btn",
-                    "a.download-btn",
-                    "button[data-action='download']",
-                    "a[data-action='download']",
-                    "button[onclick*='download']",
-                    "a[onclick*='download']",
-                ]
-
-                # Try to find and click download buttons
-                for selector in download_selectors:
+                pending[task] = selector
+            while pending and not found.is_set():
+                done, _ = await asyncio.wait([*pending, found_task], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is found_task:
+                        continue
+                    selector = pending.pop(task)
+                    element = None if task.exception() is not None else task.result()
+                    if element is None or found.is_set():
+                        continue
                     try:
-                        logger.info(f"Trying selector: {selector}")
-                        await page.wait_for_selector(selector, timeout=5000)
-                        element = await page.query_selector(selector)
-                        if element:
-                            logger.info(f"Clicking element: {selector}")
-                            await element.click()
-                            await page.wait_for_timeout(3000)  # Wait for any network requests
-                            if candidate_url:  # If we found a URL, we're done
-                                break
+                        logger.info(f"Clicking element: {selector}")
+                        await element.click()
+                        await asyncio.wait_for(found.wait(), timeout=settings.browser_click_wait)
+                    except asyncio.TimeoutError:
+                        pass
                     except Exception as e:
                         logger.debug(f"Selector {selector} failed: {e}")
-                        continue
 
-                # If we still don't have a URL, try to extract from page content
-                if not candidate_url:
-                    content = await page.content()
-                    urls = re.findall(r'["\'](https?://[^"\'\s]+)["\']', content)
-                    for url in urls:
-                        if any(x in url.lower() for x in ['d.terabox', 'baidupcs', 'download', 'get_file']):
-                            candidate_url = url
-                            logger.info(f"Found URL in page content: {url}")
-                            break
-
-                # Wait for any pending network requests
-                try:
-                    await page.wait_for_load_state('networkidle', timeout=5000)
-                except:
-                    pass
-
-            finally:
-                await context.close()
-                await browser.close()
-
-    except Exception as e:
-        logger.error(f"Playwright error: {str(e)}")
-        return None
+            # If we still don't have a URL, try to extract from page content
+            if not candidate_url:
+                content = await page.content()
+                for url in URL_IN_QUOTES_RE.findall(content):
+                    if any(x in url.lower() for x in BROWSER_URL_KEYWORDS):
+                        candidate_url = url
+                        logger.info(f"Found URL in page content: {url}")
+                        break
+        finally:
+            for task in [goto, found_task, *pending]:
+                task.cancel()
+                # Consume cancellation/selector errors so they are not reported as unretrieved
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
     return candidate_url
 
 
 async def resolve_terabox(req: ResolveRequest) -> ResolvedFile:
-    # 1) Try to parse HTML with enhanced parsing
-    url = await _try_parse_html(req)
-
-    # 2) Skip Playwright fallback on Render free tier
-    if not url and req.use_browser:
-        logger.info("Playwright fallback is disabled on Render free tier")
-        
-    if not url:
-        # Try one more time with different parameters
-        logger.info("Retrying with alternative parsing method...")
-        req_copy = req.copy()
-        req_copy.user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        url = await _try_parse_html(req_copy)
+    # Repeated and concurrent resolves of the same link share one upstream fetch
+    try:
+        with stage("total"):
+            result = await resolve_cache.get_or_resolve(req, _resolve_uncached)
+    except Overloaded:
+        resolve_total.inc(outcome="shed")
+        raise
+    except ValueError:
+        resolve_total.inc(outcome="not_found")
+        raise
+    except Exception:
+        resolve_total.inc(outcome="error")
+        raise
+    resolve_total.inc(outcome="ok")
+    # Lets /download resolve the share again once this link has expired
+    link_origins.remember(str(result.direct_url), str(req.url))
+    return result
+
+
+ALTERNATE_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+
+async def _parse_with_alternate_ua(req: ResolveRequest) -> Optional[str]:
+    req_copy = req.copy()
+    req_copy.user_agent = ALTERNATE_USER_AGENT
+    return await _try_parse_html(req_copy)
+
+
+# 1) Parse the HTML with the caller's UA, 2) hedge with an alternate UA,
+# 3) headless browser fallback once both HTML attempts have failed
+strategy_runner = StrategyRunner(
+    [
+        Strategy("html", _try_parse_html),
+        Strategy(
+            "html_alt_ua",
+            _parse_with_alternate_ua,
+            applies=lambda req: req.user_agent != ALTERNATE_USER_AGENT,
+        ),
+        Strategy(
+            "browser",
+            _with_playwright,
+            tier=1,
+            hedge=False,
+            applies=lambda req: req.use_browser and settings.browser_enabled,
+        ),
+    ],
+    hedge_delay=settings.resolve_hedge_delay,
+)
+
+
+async def _resolve_uncached(req: ResolveRequest) -> ResolvedFile:
+    # Bound concurrent upstream work per share host; excess resolves queue briefly or are shed
+    async with resolve_gate.slot(host_of(str(req.url))):
+        return await _resolve_upstream(req)
+
+
+async def _resolve_upstream(req: ResolveRequest) -> ResolvedFile:
+    with stage("find_url"):
+        url = await strategy_runner.run(req)
 
     if not url:
         raise ValueError(
@@ -312,7 +322,10 @@ async def resolve_terabox(req: ResolveRequest) -> ResolvedFile:
             "3. Check if the link is still valid"
         )
 
-    # 3) Probe metadata via HEAD
+    return await _probe_file(url, req)
+
+
+def _cdn_headers(req: ResolveRequest) -> Dict[str, str]:
     headers = {
         "User-Agent": req.user_agent,
         "Accept": "*/*",
@@ -320,35 +333,39 @@ async def resolve_terabox(req: ResolveRequest) -> ResolvedFile:
         "Referer": "https://www.terabox.com/",
         "Origin": "https://www.terabox.com"
     }
-    
+
     if req.cookie:
         headers["Cookie"] = req.cookie
-        
+    return headers
+
+
+async def _probe_file(url: str, req: ResolveRequest) -> ResolvedFile:
+    """Metadata for a direct link via HEAD, falling back to a 1 KiB range GET."""
+    headers = _cdn_headers(req)
     try:
-        async with httpx.AsyncClient(
-            follow_redirects=True, 
-            timeout=req.timeout_seconds,
-            http2=True
-        ) as client:
+        client = get_cdn_client()
+        with stage("head"):
             meta = await _head(client, url, headers)
-            
-            # If HEAD fails, try GET with range to avoid downloading the whole file
-            if not meta.get("content_length"):
-                logger.info("HEAD failed, trying GET with range...")
+
+        # If HEAD fails, try GET with range to avoid downloading the whole file
+        if not meta.get("content_length"):
+            noisy.info("range_get", "HEAD failed, trying GET with range...")
+            with stage("range_get"):
                 r = await client.get(
-                    url, 
+                    url,
                     headers={**headers, "Range": "bytes=0-1023"},
-                    follow_redirects=True
+                    timeout=req.timeout_seconds,
                 )
-                if r.status_code == 206:  # Partial Content
-                    meta.update({
-                        "content_length": int(r.headers.get("content-range").split("/")[1])
-                        if "content-range" in r.headers
-                        else None,
-                        "content_type": r.headers.get("content-type"),
-                        "filename": _filename_from_headers(r.headers),
-                        "headers": dict(r.headers),
-                    })
+            if r.status_code == 206:  # Partial Content
+                file_metadata.store(url, req.cookie, r)
+                meta.update({
+                    "content_length": int(r.headers.get("content-range").split("/")[1])
+                    if "content-range" in r.headers
+                    else None,
+                    "content_type": r.headers.get("content-type"),
+                    "filename": _filename_from_headers(r.headers),
+                    "headers": dict(r.headers),
+                })
 
         return ResolvedFile(
             direct_url=url,
@@ -368,3 +385,36 @@ async def resolve_terabox(req: ResolveRequest) -> ResolvedFile:
             content_type=None,
             headers={}
         )
+
+
+async def list_share_files(req: ResolveRequest) -> Tuple[List[ResolvedFile], bool]:
+    """Every file in a share, in page order, and whether they came from the page listing.
+
+    Folder shares embed their file list in the page state, with names and
+    sizes but no CDN metadata. Anything else (pages without embedded state,
+    fetch failures) falls back to a normal resolve, whose single result is
+    already probed.
+    """
+    files = []
+    async with resolve_gate.slot(host_of(str(req.url))):
+        try:
+            html = await _fetch_page(req)
+            with stage("file_list"):
+                files = link_extractor.file_list(html)
+        except Exception as e:
+            logger.warning(f"Error listing share files: {e}")
+    if files:
+        logger.info(f"Share lists {len(files)} files: {req.url}")
+        return [ResolvedFile(direct_url=f.url, filename=f.filename, content_length=f.size) for f in files], True
+    return [await resolve_terabox(req)], False
+
+
+async def probe_share_file(listed: ResolvedFile, req: ResolveRequest) -> ResolvedFile:
+    """Complete a listed file with CDN metadata; the listing fills whatever the probe could not."""
+    probed = await _probe_file(str(listed.direct_url), req)
+    return probed.model_copy(
+        update={
+            "filename": probed.filename or listed.filename,
+            "content_length": probed.content_length or listed.content_length,
+        }
+    )
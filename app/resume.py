@@ -0,0 +1,207 @@
+import re
+import time
+from typing import Optional, Dict, Tuple, AsyncIterator
+
+import httpx
+
+from .cache import dlink_expiry, link_identity, link_origins, resolve_cache
+from .config import settings
+from .logger import logger
+from .models import ResolveRequest
+from .ranges import content_range
+from .relay import relay_raw
+from .resolver import list_share_files, resolve_terabox
+
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+)", re.IGNORECASE)
+
+# Statuses a CDN answers a signed link with once it has expired
+EXPIRED_STATUSES = (401, 403, 410)
+
+# Process-wide counters reported on /stats
+resume_stats: Dict[str, int] = {
+    "refreshes": 0,
+    "refresh_failures": 0,
+    "resumes": 0,
+    "resume_failures": 0,
+    "bytes_after_resume": 0,
+}
+
+
+class ResumeFailed(Exception):
+    """The upstream could not be reopened with the same file at the current offset."""
+
+
+def share_url_for(url: str, share_url: Optional[str]) -> Optional[str]:
+    """The share page to resolve again when ``url`` expires: given by the client, or remembered from its resolve."""
+    return share_url or link_origins.get(url)
+
+
+def link_expired(url: str) -> bool:
+    expiry = dlink_expiry(url)
+    return expiry is not None and expiry <= time.time()
+
+
+async def refresh_link(
+    share_url: str, cookie: Optional[str], user_agent: Optional[str], url: Optional[str] = None
+) -> str:
+    """A fresh direct link for ``share_url``, bypassing the resolve cache.
+
+    The cached link may be the one that just expired. Streams that need the
+    same share at once still share one resolve, as concurrent cache misses do.
+    When the expired ``url`` was listed from a folder share, the share is
+    listed again and the link to the same file is picked instead.
+    """
+    req = ResolveRequest(url=share_url, cookie=cookie, user_agent=user_agent)
+    try:
+        if url is not None and link_origins.listed(url):
+            fresh = await _relisted_link(req, url)
+        else:
+            resolve_cache.invalidate(resolve_cache.key_for(req))
+            fresh = str((await resolve_terabox(req)).direct_url)
+    except Exception:
+        resume_stats["refresh_failures"] += 1
+        raise
+    resume_stats["refreshes"] += 1
+    logger.info(f"Re-resolved expired link for {share_url}")
+    return fresh
+
+
+async def _relisted_link(req: ResolveRequest, url: str) -> str:
+    identity = link_identity(url)
+    files, listed = await list_share_files(req)
+    for file in files if listed else ():
+        direct_url = str(file.direct_url)
+        if link_identity(direct_url) == identity:
+            link_origins.remember(direct_url, str(req.url), listed=True)
+            return direct_url
+    raise ValueError(f"{req.url} no longer lists the file")
+
+
+def resume_plan(resp: httpx.Response) -> Optional[Tuple[int, int, int]]:
+    """(start, end, size) of the file bytes an upstream response carries, if it can be resumed by range.
+
+    Needs an identity encoding (offsets must refer to the relayed bytes) and
+    a known total size.
+    """
+    if resp.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    if resp.status_code == 206:
+        match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2)), int(match.group(3))
+    if resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+        size = int(resp.headers["content-length"])
+        return (0, size - 1, size) if size else None
+    return None
+
+
+class ResumableStream:
+    """Relays an upstream body and reopens it at the current offset when the transfer breaks.
+
+    A dropped connection is retried against the same link. When the CDN
+    rejects the link as expired (or its signed expiry has passed) and the
+    share URL is known, the share is resolved again and the transfer
+    continues from the new link. A reopened response must be a 206 for
+    exactly the missing bytes of a file of the same size and, when both
+    sides send one, the same ETag. Otherwise the stream is aborted rather
+    than relaying different content.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        upstream: httpx.Response,
+        plan: Tuple[int, int, int],
+        share_url: Optional[str],
+        cookie: Optional[str],
+        attempts: Optional[int] = None,
+    ) -> None:
+        self.client = client
+        self.url = url
+        self.headers = {k: v for k, v in headers.items() if k.lower() not in ("range", "if-range")}
+        self.headers["Accept-Encoding"] = "identity"
+        self.upstream = upstream
+        self.offset, self.end, self.size = plan
+        self.etag = upstream.headers.get("etag")
+        self.share_url = share_url
+        self.cookie = cookie
+        self.attempts = settings.download_resume_attempts if attempts is None else attempts
+        self.resumes = 0
+
+    def _body(self, resp: httpx.Response) -> AsyncIterator[bytes]:
+        if settings.relay_raw:
+            return relay_raw(resp, settings.relay_chunk_size, settings.relay_flush_interval)
+        return resp.aiter_bytes()
+
+    async def _open(self, url: str) -> httpx.Response:
+        headers = {**self.headers, "Range": f"bytes={self.offset}-{self.end}"}
+        return await self.client.send(self.client.build_request("GET", url, headers=headers), stream=True)
+
+    async def _reopen(self) -> httpx.Response:
+        if not (self.share_url and link_expired(self.url)):
+            resp = await self._open(self.url)
+            if resp.status_code not in EXPIRED_STATUSES or not self.share_url:
+                return await self._verify(resp)
+            await resp.aclose()
+        self.url = await refresh_link(self.share_url, self.cookie, self.headers.get("User-Agent"), self.url)
+        return await self._verify(await self._open(self.url))
+
+    async def _verify(self, resp: httpx.Response) -> httpx.Response:
+        expected = content_range((self.offset, self.end), self.size)
+        etag = resp.headers.get("etag")
+        problem = None
+        if resp.status_code != 206:
+            problem = f"upstream answered {resp.status_code}"
+        elif resp.headers.get("content-range") != expected:
+            problem = f"upstream sent {resp.headers.get('content-range')!r} instead of {expected!r}"
+        elif self.etag and etag and etag != self.etag:
+            problem = f"ETag changed from {self.etag} to {etag}"
+        if problem:
+            await resp.aclose()
+            raise ResumeFailed(problem)
+        return resp
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                try:
+                    async for chunk in self._body(self.upstream):
+                        self.offset += len(chunk)
+                        if self.resumes:
+                            resume_stats["bytes_after_resume"] += len(chunk)
+                        yield chunk
+                    if self.offset > self.end:
+                        return
+                    error: Exception = ResumeFailed(f"upstream ended {self.end + 1 - self.offset} bytes early")
+                except httpx.TransportError as e:
+                    error = e
+                await self.upstream.aclose()
+                if self.resumes >= self.attempts:
+                    raise error
+                self.resumes += 1
+                resume_stats["resumes"] += 1
+                logger.warning(f"Download of {self.url} broke at byte {self.offset} ({error}); resuming")
+                try:
+                    self.upstream = await self._reopen()
+                except Exception as e:
+                    resume_stats["resume_failures"] += 1
+                    logger.warning(f"Could not resume download at byte {self.offset}: {e}")
+                    raise
+        finally:
+            await self.upstream.aclose()
+
+
+__all__ = [
+    "EXPIRED_STATUSES",
+    "ResumableStream",
+    "ResumeFailed",
+    "link_expired",
+    "refresh_link",
+    "resume_plan",
+    "resume_stats",
+    "share_url_for",
+]
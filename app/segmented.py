@@ -0,0 +1,196 @@
+import asyncio
+import re
+import time
+from typing import Optional, Dict, List, Tuple, AsyncIterator
+
+import httpx
+
+from .config import settings
+from .logger import logger
+
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)", re.IGNORECASE)
+
+# Process-wide counters reported on /stats
+segmented_stats: Dict[str, int] = {
+    "downloads": 0,
+    "fallbacks": 0,
+    "segments": 0,
+    "segment_retries": 0,
+    "bytes": 0,
+}
+
+
+def segment_plan(resp: httpx.Response) -> Optional[Tuple[int, int]]:
+    """Inclusive byte span covered by an upstream response, if it can be fetched in parallel ranges.
+
+    Requires ``Accept-Ranges: bytes``, an identity encoding (byte offsets must
+    refer to what we relay), a known length, and at least two segments of data.
+    """
+    if "bytes" not in resp.headers.get("accept-ranges", "").lower():
+        return None
+    if resp.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    if resp.status_code == 206:
+        match = CONTENT_RANGE_RE.match(resp.headers.get("content-range", ""))
+        if not match:
+            return None
+        start, end = int(match.group(1)), int(match.group(2))
+    elif resp.status_code == 200 and resp.headers.get("content-length", "").isdigit():
+        start, end = 0, int(resp.headers["content-length"]) - 1
+    else:
+        return None
+    if end - start + 1 < 2 * settings.segment_size:
+        return None
+    return start, end
+
+
+class SegmentedFetcher:
+    """Relays a byte span as parallel upstream range requests, reassembled in order.
+
+    The first segment is streamed straight from the already-open upstream
+    response so the client gets bytes immediately. Later segments are fetched
+    by up to ``connections`` concurrent range requests. Segments that finish
+    early wait in a reorder window of at most ``memory_limit`` bytes. The
+    connection count is tuned by hill-climbing on measured throughput.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        first: httpx.Response,
+        start: int,
+        end: int,
+        segment_size: Optional[int] = None,
+        initial_connections: Optional[int] = None,
+        max_connections: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+    ) -> None:
+        self.client = client
+        self.url = url
+        self.headers = {k: v for k, v in headers.items() if k.lower() != "range"}
+        self.first = first
+        self.segment_size = segment_size or settings.segment_size
+        self.max_connections = max_connections or settings.segment_max_connections
+        self.connections = min(initial_connections or settings.segment_initial_connections, self.max_connections)
+        self.window = max(1, (memory_limit or settings.segment_memory_limit) // self.segment_size)
+        self.segments: List[Tuple[int, int]] = [
+            (a, min(a + self.segment_size - 1, end)) for a in range(start, end + 1, self.segment_size)
+        ]
+        self._tasks: Dict[int, "asyncio.Task[bytes]"] = {}
+        self._closed = False
+        self._next_launch = 1
+        self._direction = 1
+        self._last_rate: Optional[float] = None
+        self._period_start = time.perf_counter()
+        self._period_bytes = 0
+        self._period_segments = 0
+
+    def _in_flight(self) -> int:
+        return sum(1 for task in self._tasks.values() if not task.done())
+
+    def _fill(self) -> None:
+        while (
+            not self._closed
+            and self._next_launch < len(self.segments)
+            and len(self._tasks) < self.window
+            and self._in_flight() < self.connections
+        ):
+            index = self._next_launch
+            self._next_launch += 1
+            task = asyncio.ensure_future(self._fetch(*self.segments[index]))
+            task.add_done_callback(lambda _: self._fill())
+            self._tasks[index] = task
+
+    async def _fetch(self, start: int, end: int) -> bytes:
+        last_error: Optional[Exception] = None
+        for attempt in range(settings.segment_retries + 1):
+            if attempt:
+                segmented_stats["segment_retries"] += 1
+            try:
+                return await self._fetch_once(start, end)
+            except (httpx.HTTPError, ValueError) as e:
+                last_error = e
+                logger.warning(f"Segment {start}-{end} failed (attempt {attempt + 1}): {e}")
+        raise last_error  # type: ignore[misc]
+
+    async def _fetch_once(self, start: int, end: int) -> bytes:
+        """One range request, streamed: anything but the exact span is rejected before its body is read."""
+        size = end - start + 1
+        headers = {**self.headers, "Range": f"bytes={start}-{end}"}
+        async with self.client.stream("GET", self.url, headers=headers) as r:
+            if r.status_code != 206:
+                raise ValueError(f"upstream answered {r.status_code} to a range request")
+            match = CONTENT_RANGE_RE.match(r.headers.get("content-range", ""))
+            if not match or (int(match.group(1)), int(match.group(2))) != (start, end):
+                raise ValueError(f"upstream sent range {r.headers.get('content-range')!r} for {start}-{end}")
+            chunks: List[bytes] = []
+            received = 0
+            async for chunk in r.aiter_raw():
+                chunks.append(chunk[: size - received])
+                received += len(chunks[-1])
+                if received == size:
+                    break
+        if received != size:
+            raise ValueError(f"short segment ({received} of {size} bytes)")
+        return b"".join(chunks)
+
+    def _observe(self, nbytes: int) -> None:
+        self._period_bytes += nbytes
+        self._period_segments += 1
+        if self._period_segments < self.connections:
+            return
+        now = time.perf_counter()
+        rate = self._period_bytes / max(now - self._period_start, 1e-6)
+        if self._last_rate is not None:
+            if rate >= self._last_rate * 1.05:
+                # Last change helped (or conditions improved): keep moving, probing upwards when holding
+                self._direction = self._direction or 1
+            elif rate < self._last_rate * 0.95:
+                # Last change hurt: step back the other way
+                self._direction = -1 if self._direction >= 0 else 1
+            else:
+                self._direction = 0
+        self.connections = max(1, min(self.max_connections, self.connections + self._direction))
+        self._last_rate = rate
+        self._period_start, self._period_bytes, self._period_segments = now, 0, 0
+
+    async def _relay_first(self) -> AsyncIterator[bytes]:
+        start, end = self.segments[0]
+        remaining = end - start + 1
+        async for chunk in self.first.aiter_bytes():
+            if len(chunk) >= remaining:
+                yield chunk[:remaining]
+                remaining = 0
+                break
+            remaining -= len(chunk)
+            yield chunk
+        await self.first.aclose()
+        if remaining:
+            raise ValueError(f"upstream ended {remaining} bytes early")
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        segmented_stats["downloads"] += 1
+        try:
+            self._fill()
+            async for chunk in self._relay_first():
+                yield chunk
+            for index in range(1, len(self.segments)):
+                self._fill()
+                data = await self._tasks[index]
+                del self._tasks[index]
+                segmented_stats["segments"] += 1
+                segmented_stats["bytes"] += len(data)
+                self._observe(len(data))
+                yield data
+        finally:
+            self._closed = True
+            for task in self._tasks.values():
+                task.cancel()
+            self._tasks.clear()
+            await self.first.aclose()
+
+
+__all__ = ["SegmentedFetcher", "segment_plan", "segmented_stats"]
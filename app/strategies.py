@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+from .limits import Overloaded
+from .logger import logger, noisy
+from .metrics import record_stage
+from .models import ResolveRequest
+
+
+StrategyFunc = Callable[[ResolveRequest], Awaitable[Optional[str]]]
+StrategyFilter = Callable[[ResolveRequest], bool]
+
+
+class Strategy:
+    """One way of turning a share page into a download URL, with its track record.
+
+    Strategies in a lower ``tier`` always start first; within a tier the one
+    with the best win rate goes first. ``hedge`` strategies may start while an
+    earlier attempt is still running; the others only start once everything
+    before them has failed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: StrategyFunc,
+        tier: int = 0,
+        hedge: bool = True,
+        applies: Optional[StrategyFilter] = None,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.tier = tier
+        self.hedge = hedge
+        self.applies = applies or (lambda req: True)
+        self.attempts = 0
+        self.wins = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.latency_ewma: Optional[float] = None
+
+    @property
+    def score(self) -> float:
+        # Laplace-smoothed win rate so new strategies are neither favoured nor starved
+        return (self.wins + 1) / (self.attempts + 2)
+
+    def record_latency(self, seconds: float) -> None:
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * seconds
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tier": self.tier,
+            "attempts": self.attempts,
+            "wins": self.wins,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "win_rate": self.wins / self.attempts if self.attempts else None,
+            "latency_ewma_seconds": self.latency_ewma,
+        }
+
+
+class StrategyRunner:
+    """Runs strategies as a hedged race and returns the first URL found.
+
+    The best-ranked strategy starts immediately. The next one starts after
+    ``hedge_delay`` seconds, or at once if every running attempt has already
+    failed. The first attempt to return a URL wins and the rest are cancelled.
+    """
+
+    def __init__(self, strategies: List[Strategy], hedge_delay: float) -> None:
+        self.strategies = strategies
+        self.hedge_delay = hedge_delay
+
+    def ordered(self, req: ResolveRequest) -> List[Strategy]:
+        usable = [s for s in self.strategies if s.applies(req)]
+        position = {id(s): i for i, s in enumerate(usable)}
+        return sorted(usable, key=lambda s: (s.tier, -s.score, position[id(s)]))
+
+    async def run(self, req: ResolveRequest) -> Optional[str]:
+        queue = self.ordered(req)
+        running: Dict["asyncio.Task[Optional[str]]", Strategy] = {}
+        started: Dict[Strategy, float] = {}
+        shed: Optional[Overloaded] = None
+
+        def start_next() -> None:
+            strategy = queue.pop(0)
+            strategy.attempts += 1
+            started[strategy] = time.perf_counter()
+            noisy.info("strategy_start", f"Starting resolve strategy '{strategy.name}'")
+            running[asyncio.ensure_future(strategy.func(req))] = strategy
+
+        try:
+            while queue or running:
+                if not running:
+                    start_next()
+                    continue
+                # Only hedge into strategies that allow it; the rest wait for failures
+                hedge = bool(queue) and queue[0].hedge
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=self.hedge_delay if hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    start_next()
+                    continue
+                for task in done:
+                    strategy = running.pop(task)
+                    elapsed = time.perf_counter() - started[strategy]
+                    strategy.record_latency(elapsed)
+                    record_stage(f"strategy_{strategy.name}", elapsed)
+                    url = None if task.exception() is not None else task.result()
+                    if isinstance(task.exception(), Overloaded):
+                        shed = task.exception()
+                    elif task.exception() is not None:
+                        logger.warning(f"Resolve strategy '{strategy.name}' raised: {task.exception()}")
+                    if url:
+                        strategy.wins += 1
+                        noisy.info("strategy_won", f"Resolve strategy '{strategy.name}' won")
+                        return url
+                    strategy.failures += 1
+            # Nothing found, but a strategy was shed for lack of capacity: report overload, not a dead link
+            if shed is not None:
+                raise shed
+            return None
+        finally:
+            for task, strategy in running.items():
+                task.cancel()
+                strategy.cancelled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hedge_delay_seconds": self.hedge_delay, "strategies": {s.name: s.stats() for s in self.strategies}}
+
+
+__all__ = ["Strategy", "StrategyRunner"]
@@ -0,0 +1,235 @@
+import asyncio
+import posixpath
+import struct
+import time
+import zlib
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, AsyncIterator
+from urllib.parse import urlsplit, unquote
+
+import httpx
+
+from .limits import AdmissionGate, Overloaded, host_of
+from .logger import logger
+from .models import ZipItem
+from .relay import relay_raw
+from .resolver import _filename_from_headers
+
+
+# Entries are stored (no compression) and carry a data descriptor, so no
+# header needs a size before the entry's bytes have been streamed
+VERSION = 45  # ZIP64
+FLAGS = 0x0808  # bit 3: data descriptor follows, bit 11: UTF-8 names
+STORED = 0
+EXTERNAL_ATTR = 0o100644 << 16
+MAX32 = 0xFFFFFFFF
+MAX16 = 0xFFFF
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_EXTRA_LOCAL = struct.Struct("<HHQQ")
+ZIP64_EXTRA_CENTRAL = struct.Struct("<HHQQQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+# An opened entry response and the callback that releases its admission slot
+Opened = Tuple[httpx.Response, Callable[[], None]]
+
+
+def _dos_time(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(max(timestamp, 315532800))  # DOS dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipWriter:
+    """Produces the bytes of a ZIP64 archive one entry at a time.
+
+    Local headers carry zero sizes and CRC; the real values follow each
+    entry's data in a ZIP64 data descriptor and are repeated in the central
+    directory, which is written by :meth:`finish`. Only the central directory
+    records are kept in memory, never entry data.
+    """
+
+    def __init__(self) -> None:
+        self.offset = 0
+        self._names: Set[str] = set()
+        self._central: List[bytes] = []
+        self._current: Optional[Tuple[bytes, int, int, int]] = None
+
+    def unique_name(self, name: str) -> str:
+        """A safe relative entry name, suffixed with ``(n)`` if already used."""
+        name = "/".join(part for part in name.replace("\\", "/").split("/") if part not in ("", ".", ".."))
+        name = name or "file"
+        stem, ext = posixpath.splitext(name)
+        candidate, n = name, 1
+        while candidate in self._names:
+            candidate = f"{stem} ({n}){ext}"
+            n += 1
+        self._names.add(candidate)
+        return candidate
+
+    def begin(self, name: str, mtime: float) -> bytes:
+        encoded = name.encode("utf-8")
+        dos_time, dos_date = _dos_time(mtime)
+        self._current = (encoded, self.offset, dos_time, dos_date)
+        extra = ZIP64_EXTRA_LOCAL.pack(0x0001, 16, 0, 0)
+        header = LOCAL_HEADER.pack(
+            0x04034B50, VERSION, FLAGS, STORED, dos_time, dos_date, 0, MAX32, MAX32, len(encoded), len(extra)
+        )
+        data = header + encoded + extra
+        self.offset += len(data)
+        return data
+
+    def end(self, crc: int, size: int) -> bytes:
+        encoded, header_offset, dos_time, dos_date = self._current
+        self._current = None
+        extra = ZIP64_EXTRA_CENTRAL.pack(0x0001, 24, size, size, header_offset)
+        self._central.append(
+            CENTRAL_HEADER.pack(
+                0x02014B50, VERSION | (3 << 8), VERSION, FLAGS, STORED, dos_time, dos_date, crc,
+                MAX32, MAX32, len(encoded), len(extra), 0, 0, 0, EXTERNAL_ATTR, MAX32,
+            )
+            + encoded
+            + extra
+        )
+        self.offset += size
+        data = DATA_DESCRIPTOR.pack(0x08074B50, crc, size, size)
+        self.offset += len(data)
+        return data
+
+    def finish(self) -> bytes:
+        directory = b"".join(self._central)
+        count, start, end = len(self._central), self.offset, self.offset + len(directory)
+        trailer = (
+            ZIP64_END.pack(0x06064B50, 44, VERSION, VERSION, 0, 0, count, count, len(directory), start)
+            + ZIP64_LOCATOR.pack(0x07064B50, 0, end, 1)
+            + END.pack(
+                0x06054B50, 0, 0, min(count, MAX16), min(count, MAX16),
+                min(len(directory), MAX32), min(start, MAX32), 0,
+            )
+        )
+        self.offset = end + len(trailer)
+        return directory + trailer
+
+
+def entry_name(item: ZipItem, resp: httpx.Response, index: int) -> str:
+    name = item.filename or _filename_from_headers(resp.headers)
+    if not name:
+        name = unquote(posixpath.basename(urlsplit(item.url).path))
+    return name or f"file-{index + 1}"
+
+
+def _mtime(resp: httpx.Response) -> float:
+    try:
+        return parsedate_to_datetime(resp.headers["last-modified"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+async def open_entry(client: httpx.AsyncClient, url: str, headers: Dict[str, str], gate: AdmissionGate) -> Opened:
+    """Open an entry's response after taking a ``gate`` slot for its host, held until released."""
+    release = await gate.enter(host_of(url))
+    try:
+        return await client.send(client.build_request("GET", url, headers=headers), stream=True), release
+    except BaseException:
+        release()
+        raise
+
+
+async def _close(opened: Opened) -> None:
+    resp, release = opened
+    try:
+        await resp.aclose()
+    finally:
+        release()
+
+
+def _discard(opening: "asyncio.Future[Opened]") -> None:
+    """Close a prefetched response that will not be streamed, now or once it arrives."""
+
+    def close(future: "asyncio.Future[Opened]") -> None:
+        if not future.cancelled() and future.exception() is None:
+            asyncio.ensure_future(_close(future.result()))
+
+    if not opening.done():
+        opening.cancel()
+    opening.add_done_callback(close)
+
+
+async def stream_zip(
+    client: httpx.AsyncClient,
+    headers: Dict[str, str],
+    items: List[ZipItem],
+    first: Opened,
+    gate: AdmissionGate,
+    prefetch: int,
+    chunk_size: int,
+    flush_interval: float,
+) -> AsyncIterator[bytes]:
+    """Stream ``items`` as one ZIP64 archive of stored entries.
+
+    ``first`` is the already opened entry for ``items[0]``. While one
+    entry streams, requests for up to ``prefetch`` following entries are
+    already open, so their connection setup and time to first byte overlap
+    the current transfer; their bodies wait in socket buffers until read.
+    Every open entry holds a ``gate`` slot for its own host, taken as it is
+    opened and released once it is closed. Entries whose upstream request
+    fails, or that cannot get a slot, are left out and listed in a trailing
+    ``ERRORS.txt`` entry.
+    """
+    writer = ZipWriter()
+    ready: "asyncio.Future[Opened]" = asyncio.get_running_loop().create_future()
+    ready.set_result(first)
+    opening: Deque["asyncio.Future[Opened]"] = deque([ready])
+    scheduled = 1
+    errors: List[str] = []
+    try:
+        for index, item in enumerate(items):
+            while scheduled < len(items) and scheduled <= index + prefetch:
+                opening.append(asyncio.ensure_future(open_entry(client, items[scheduled].url, headers, gate)))
+                scheduled += 1
+            try:
+                try:
+                    opened = await opening.popleft()
+                except Overloaded:
+                    # The prefetch gave up waiting while earlier entries held the host's slots: wait again now
+                    opened = await open_entry(client, item.url, headers, gate)
+            except (httpx.HTTPError, Overloaded) as e:
+                logger.warning(f"ZIP entry {index} failed: {item.url}: {e}")
+                errors.append(f"{item.url}: {e.__class__.__name__}")
+                continue
+            resp = opened[0]
+            try:
+                if resp.status_code >= 400:
+                    logger.warning(f"ZIP entry {index} failed: {item.url}: upstream responded {resp.status_code}")
+                    errors.append(f"{item.url}: upstream responded {resp.status_code}")
+                    continue
+                yield writer.begin(writer.unique_name(entry_name(item, resp, index)), _mtime(resp))
+                # Only identity bodies can be relayed raw; anything else is decoded into the entry
+                if resp.headers.get("content-encoding", "identity").lower() == "identity":
+                    body = relay_raw(resp, chunk_size, flush_interval)
+                else:
+                    body = resp.aiter_bytes()
+                crc = size = 0
+                async for chunk in body:
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    yield chunk
+                yield writer.end(crc, size)
+            finally:
+                await _close(opened)
+        if errors:
+            report = ("\n".join(errors) + "\n").encode()
+            yield writer.begin(writer.unique_name("ERRORS.txt"), time.time())
+            yield report
+            yield writer.end(zlib.crc32(report), len(report))
+        yield writer.finish()
+    finally:
+        for pending in opening:
+            _discard(pending)
+
+
+__all__ = ["ZipWriter", "Opened", "entry_name", "open_entry", "stream_zip"]
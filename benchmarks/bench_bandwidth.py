@@ -0,0 +1,106 @@
+"""Fairness and utilization of the /download bandwidth scheduler.
+
+Runs streams of synthetic bytes through app.bandwidth.BandwidthScheduler
+in-process (no network), each drained as fast as possible, under a global
+limit. The scenario has four clients:
+
+    a   1 stream
+    b   4 streams (per-client fairness gives b the same share as a)
+    c   1 stream whose reader only takes --slow-mbps (its unused share goes to the others)
+    d   1 stream that only runs from 1/3 to 2/3 of the run (its share is
+        reallocated when it starts and finishes)
+
+It reports each client's throughput and the total as a fraction of the limit.
+--client-limit-mbps additionally caps every client.
+
+    python benchmarks/bench_bandwidth.py [--limit-mbps 400] [--slow-mbps 32] [--client-limit-mbps 0]
+        [--seconds 3] [--chunk-kb 256] [--per-stream] [--json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Any, AsyncIterator
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.bandwidth import BandwidthScheduler  # noqa: E402
+
+
+async def source(chunk: bytes, until: float) -> AsyncIterator[bytes]:
+    while time.monotonic() < until:
+        yield chunk
+
+
+async def drain(
+    scheduler: BandwidthScheduler,
+    client: str,
+    chunk: bytes,
+    start: float,
+    stop: float,
+    reader_rate: float,
+    totals: Dict[str, int],
+) -> None:
+    await asyncio.sleep(max(0.0, start - time.monotonic()))
+    async for data in scheduler.pace(source(chunk, stop), client):
+        totals[client] += len(data)
+        # A slow reader takes len(data) / reader_rate to accept a chunk; others only yield like a socket write
+        await asyncio.sleep(len(data) / reader_rate if reader_rate else 0)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    limit = args.limit_mbps * 1e6 / 8
+    client_limit = args.client_limit_mbps * 1e6 / 8
+    slow = args.slow_mbps * 1e6 / 8
+    scheduler = BandwidthScheduler(limit, client_limit, burst=args.chunk_kb * 1024 * 4, per_client=not args.per_stream)
+    chunk = b"\0" * (args.chunk_kb * 1024)
+    begin = time.monotonic()
+    end = begin + args.seconds
+    third = args.seconds / 3
+    streams = [("a", begin, end, 0.0)] + [("b", begin, end, 0.0)] * 4
+    streams += [("c", begin, end, slow), ("d", begin + third, begin + 2 * third, 0.0)]
+    totals = {name: 0 for name, _, _, _ in streams}
+    await asyncio.gather(
+        *(drain(scheduler, name, chunk, start, stop, rate, totals) for name, start, stop, rate in streams)
+    )
+    elapsed = time.monotonic() - begin
+    total = sum(totals.values())
+    return {
+        "limit_bytes_per_second": limit,
+        "client_limit_bytes_per_second": client_limit,
+        "seconds": elapsed,
+        "clients": {name: {"bytes": n, "mb_per_s": n / elapsed / 1e6} for name, n in totals.items()},
+        "total_mb_per_s": total / elapsed / 1e6,
+        "utilization": total / elapsed / limit,
+        "grants": scheduler.grants,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--limit-mbps", type=float, default=400.0, help="Global limit in megabits per second")
+    parser.add_argument("--slow-mbps", type=float, default=32.0, help="Reading speed of client c in megabits per second")
+    parser.add_argument("--client-limit-mbps", type=float, default=0.0, help="Per-client limit in megabits per second")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--chunk-kb", type=int, default=256, help="Bytes per relayed chunk")
+    parser.add_argument("--per-stream", action="store_true", help="Share per stream instead of per client")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    for name, row in report["clients"].items():
+        print(f"client {name}  {row['mb_per_s']:>8.2f} MB/s")
+    print(
+        f"total     {report['total_mb_per_s']:>8.2f} MB/s of {report['limit_bytes_per_second'] / 1e6:.2f} MB/s "
+        f"({report['utilization']:.1%} utilization, {report['grants']} grants)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Micro-benchmark for share page link extraction.
+
+Runs app.extractor.LinkExtractor over the saved pages in benchmarks/corpus,
+checks each result against corpus/expected.json, and reports the CPU time per
+extraction. The original multi-pass extractor is kept here as a reference so
+both speed and result parity can be compared. Each page is also fed to the
+streaming PageScanner in --chunk-kb chunks, to report how much of the page a
+resolve reads before it can stop (``streamed``; the whole page when no early
+match is possible).
+
+    python benchmarks/bench_extractor.py [--iterations 200] [--chunk-kb 16] [--json]
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any, Callable, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from app.extractor import PageScanner, link_extractor  # noqa: E402
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+
+
+def legacy_extract(html: str) -> Optional[str]:
+    """The pre-extractor implementation of _try_parse_html's scan, minus logging."""
+    patterns = [
+        (r'(https?://[^\s"\']+?/file/[^\s"\']+)', 'Direct file pattern'),
+        (r'(https?://[^\s"\']+?/share/link[^\s"\']+)', 'Share link pattern'),
+        (r'"dlink"\s*:\s*"([^"]+)"', 'DLink in JSON'),
+        (r'downloadUrl\s*[=:]\s*["\']([^"\']+)["\']', 'downloadUrl in JS'),
+    ]
+    for pattern, desc in patterns:
+        for url in re.findall(pattern, html, re.IGNORECASE):
+            if any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs', 'terabox.com/s/']):
+                return url
+
+    for script in re.findall(r'<script[^>]*>([\s\S]*?)</script>', html):
+        if not script.strip():
+            continue
+        for url in re.findall(r'["\'](https?://[^"\'\s]+)["\']', script):
+            if any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs', 'terabox.com/s/']):
+                return url
+        try:
+            data = json.loads(script)
+            flat = {}
+
+            def flatten_json(nested_json, prefix=''):
+                if isinstance(nested_json, dict):
+                    for k, v in nested_json.items():
+                        flatten_json(v, f"{prefix}{k}.")
+                elif isinstance(nested_json, list):
+                    for i, v in enumerate(nested_json):
+                        flatten_json(v, f"{prefix}{i}.")
+                else:
+                    flat[prefix[:-1]] = nested_json
+
+            flatten_json(data)
+            for k, v in flat.items():
+                if not isinstance(v, str):
+                    continue
+                if 'url' in k.lower() and 'http' in v and any(x in v.lower() for x in ['download', 'd.terabox', 'baidupcs']):
+                    return v
+        except (json.JSONDecodeError, TypeError):
+            continue
+
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup.find_all(['iframe', 'embed', 'source', 'a']):
+        url = tag.get('src') or tag.get('href')
+        if not url or not isinstance(url, str):
+            continue
+        if url.startswith('http') and any(x in url.lower() for x in ['download', 'd.terabox', 'baidupcs']):
+            return url
+    return None
+
+
+def current_extract(html: str) -> Optional[str]:
+    match = link_extractor.extract(html)
+    return match.url if match else None
+
+
+def streamed_chars(html: str, chunk: int) -> Tuple[int, Optional[str]]:
+    """Characters fed to a PageScanner before it decides, and its early match."""
+    scanner = PageScanner()
+    for start in range(0, len(html), chunk):
+        match = scanner.feed(html[start : start + chunk])
+        if match:
+            return scanner.chars, match.url
+    return scanner.chars, None
+
+
+def time_per_call(func: Callable[[str], Any], html: str, iterations: int) -> float:
+    func(html)  # warm up regex and parser caches
+    start = time.process_time()
+    for _ in range(iterations):
+        func(html)
+    return (time.process_time() - start) / iterations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--chunk-kb", type=int, default=16, help="Chunk size for the streaming scan")
+    parser.add_argument("--no-legacy", action="store_true", help="Skip timing the reference implementation")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    expected: Dict[str, Optional[str]] = json.loads((CORPUS / "expected.json").read_text())
+    results = []
+    failures = 0
+    for name, want in expected.items():
+        html = (CORPUS / name).read_text(encoding="utf-8")
+        got = current_extract(html)
+        streamed, early = streamed_chars(html, args.chunk_kb * 1024)
+        row: Dict[str, Any] = {
+            "page": name,
+            "bytes": len(html.encode()),
+            "streamed_chars": streamed,
+            # An early match must be the link the full scan finds
+            "ok": got == want and early in (None, want),
+            "extractor_us": time_per_call(current_extract, html, args.iterations) * 1e6,
+        }
+        if not args.no_legacy:
+            row["legacy_ok"] = legacy_extract(html) == want
+            row["legacy_us"] = time_per_call(legacy_extract, html, args.iterations) * 1e6
+            row["speedup"] = row["legacy_us"] / row["extractor_us"] if row["extractor_us"] else None
+        if not row["ok"]:
+            failures += 1
+            row["got"] = got
+            row["want"] = want
+        results.append(row)
+
+    if args.json:
+        print(json.dumps({"iterations": args.iterations, "results": results}, indent=2))
+    else:
+        for row in results:
+            line = (
+                f"{row['page']:<26} {row['bytes']:>8} B  streamed {row['streamed_chars']:>8}  "
+                f"{row['extractor_us']:>10.1f} us"
+            )
+            if "legacy_us" in row:
+                line += f"  legacy {row['legacy_us']:>10.1f} us  x{row['speedup']:.1f}"
+            if not row["ok"]:
+                line += f"  MISMATCH got={row['got']!r}"
+            elif row.get("legacy_ok") is False:
+                line += "  (not found by legacy)"
+            print(line)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Logging overhead per /resolve request.
+
+Starts benchmarks/fakes.py as a subprocess, then drives /resolve in-process
+(httpx ASGI transport, one request at a time, distinct share ids so every
+request resolves upstream). Each mode writes the app's log to a file:
+
+    off             no sink at all (the floor)
+    text            text format, written on the event loop
+    json            JSON lines, written on the event loop
+    json_enqueue    JSON lines handed to the writer thread (the TB_LOG_JSON default)
+    json_unsampled  as json_enqueue, without rate-limiting per-attempt messages
+
+It reports event-loop CPU microseconds per request, the overhead over
+``off``, and log lines per request.
+
+    python benchmarks/bench_logging.py [--requests 300] [--rounds 3] [--shape window_data] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Any
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+# All requests come from one address, so per-client rate limiting is off unless asked for
+os.environ.setdefault("TB_CLIENT_RATE", "0")
+
+from app.config import settings  # noqa: E402
+from app.http_clients import start_pools, close_pools  # noqa: E402
+from app.logger import configure_logging, flush_logs, logger, noisy  # noqa: E402
+from app.main import app  # noqa: E402
+
+MODES = {
+    # name: (json output, enqueue, noisy message rate); None = no sink
+    "off": None,
+    "text": (False, False, settings.log_noisy_rate),
+    "json": (True, False, settings.log_noisy_rate),
+    "json_enqueue": (True, True, settings.log_noisy_rate),
+    "json_unsampled": (True, True, 0.0),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+async def run_mode(
+    client: httpx.AsyncClient, share: str, mode: str, first_id: int, requests: int, log_path: Path
+) -> Dict[str, Any]:
+    config = MODES[mode]
+    with open(log_path, "w") as sink:
+        if config is None:
+            logger.remove()
+        else:
+            json_output, enqueue, rate = config
+            noisy.rate = rate
+            configure_logging(level="INFO", json_output=json_output, enqueue=enqueue, sink=sink)
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        for i in range(first_id, first_id + requests):
+            r = await client.post("/resolve", json={"url": f"{share}-{i}", "use_browser": False})
+            if r.status_code != 200:
+                raise RuntimeError(f"/resolve returned {r.status_code}: {r.text}")
+        cpu, wall = time.thread_time() - cpu, time.perf_counter() - wall
+        # The writer thread's time is not event-loop time; wait for it before counting lines
+        flush_logs()
+        logger.remove()
+    lines = sum(1 for _ in open(log_path))
+    return {
+        "mode": mode,
+        "cpu_us_per_request": cpu / requests * 1e6,
+        "wall_ms_per_request": wall / requests * 1e3,
+        "log_lines_per_request": lines / requests,
+    }
+
+
+async def bench(share: str, requests: int, rounds: int) -> Dict[str, Dict[str, Any]]:
+    await start_pools()
+    best: Dict[str, Dict[str, Any]] = {}
+    next_id = 0
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 1))
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                # Warm up pools, the extractor and the strategy ranking
+                await run_mode(client, share, "off", next_id, 20, Path(tmp) / "warmup.log")
+                next_id += 20
+                for _ in range(rounds):
+                    for mode in MODES:
+                        row = await run_mode(client, share, mode, next_id, requests, Path(tmp) / f"{mode}.log")
+                        next_id += requests
+                        if mode not in best or row["cpu_us_per_request"] < best[mode]["cpu_us_per_request"]:
+                            best[mode] = row
+    finally:
+        await close_pools()
+        configure_logging()
+    floor = best["off"]["cpu_us_per_request"]
+    for row in best.values():
+        row["overhead_us_per_request"] = row["cpu_us_per_request"] - floor
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300, help="Resolves per mode and round")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per mode; the lowest CPU time is reported")
+    parser.add_argument("--shape", default="window_data", help="Recorded page shape (corpus file name)")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    fake_port = free_port()
+    fake = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks" / "fakes.py"), "--port", str(fake_port)],
+        env=os.environ.copy(),
+    )
+    try:
+        wait_for_port(fake_port)
+        results = asyncio.run(bench(f"http://127.0.0.1:{fake_port}/s/{args.shape}", args.requests, args.rounds))
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    if args.json:
+        print(json.dumps({"requests": args.requests, "shape": args.shape, "results": results}, indent=2))
+    else:
+        for row in results.values():
+            print(
+                f"{row['mode']:<15} {row['cpu_us_per_request']:>9.0f} us CPU/req  "
+                f"{row['overhead_us_per_request']:>+8.0f} us vs off  "
+                f"{row['wall_ms_per_request']:>7.2f} ms/req  {row['log_lines_per_request']:>5.1f} lines/req"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""Throughput benchmark for the /download byte relay.
+
+Serves a synthetic file from a local upstream in a separate process, then
+drives the real /download endpoint in-process through a minimal ASGI server
+stub. The stub writes every body chunk to a socket with backpressure, and a
+separate thread drains it like a fast client. Three modes are compared:
+
+    original  decoded relay (aiter_bytes) with httpcore's default 64 KiB reads
+    decoded   decoded relay with TB_RELAY_READ_SIZE reads
+    raw       raw relay (TB_RELAY_RAW) with TB_RELAY_READ_SIZE reads
+
+It reports MB/s, event-loop CPU seconds per GB, and the number of body sends.
+
+    python benchmarks/bench_relay.py [--size-mb 256] [--rounds 3] [--read-kb 256] [--chunk-kb 512] [--json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any
+
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.config import settings  # noqa: E402
+from app.http_clients import cdn_pool, start_pools, close_pools  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+def serve_upstream(port: int, size: int) -> None:
+    """Minimal keep-alive HTTP/1.1 server answering every request with ``size`` bytes."""
+    payload = memoryview(b"\x5a" * (4 * 1024 * 1024))
+    head = (
+        "HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+        f"Content-Length: {size}\r\nAccept-Ranges: bytes\r\n\r\n"
+    ).encode()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                writer.write(head)
+                left = size
+                while left:
+                    n = min(left, len(payload))
+                    writer.write(payload[:n])
+                    await writer.drain()
+                    left -= n
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def main() -> None:
+        server = await asyncio.start_server(handle, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def drain(sock: socket.socket) -> None:
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+        pass
+
+
+async def download_once(url: str) -> Dict[str, Any]:
+    """Run one GET /download through the ASGI app, writing the body to a socket drained by a thread."""
+    done = asyncio.Event()
+    received = {"bytes": 0, "sends": 0, "status": None}
+    server_sock, client_sock = socket.socketpair()
+    drainer = threading.Thread(target=drain, args=(client_sock,), daemon=True)
+    drainer.start()
+    _, writer = await asyncio.open_connection(sock=server_sock)
+
+    async def receive() -> Dict[str, Any]:
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        if message["type"] == "http.response.start":
+            received["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            received["bytes"] += len(body)
+            received["sends"] += 1
+            # Like uvicorn: write to the transport and wait while the client is slow
+            writer.write(body)
+            await writer.drain()
+            if not message.get("more_body"):
+                done.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/download",
+        "raw_path": b"/download",
+        "query_string": f"url={url}".encode(),
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    try:
+        await app(scope, receive, send)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+        drainer.join()
+        client_sock.close()
+    return received
+
+
+MODES = {
+    # name: (relay_raw, use TB_RELAY_READ_SIZE)
+    "original": (False, False),
+    "decoded": (False, True),
+    "raw": (True, True),
+}
+
+
+async def run_mode(url: str, mode: str, rounds: int, size: int, read_size: int) -> Dict[str, Any]:
+    raw, large_reads = MODES[mode]
+    settings.relay_raw = raw
+    # The CDN pool's read size applies to connections it opens, so reopen it per mode
+    await cdn_pool.close()
+    cdn_pool.read_size = read_size if large_reads else None
+    await cdn_pool.start()
+    await download_once(url)  # warm up the pooled connection
+    best: Dict[str, Any] = {}
+    for _ in range(rounds):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        result = await download_once(url)
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        if result["status"] != 200 or result["bytes"] != size:
+            raise RuntimeError(f"bad transfer: {result}")
+        row = {
+            "mode": mode,
+            "mb_per_s": size / wall / 1e6,
+            "cpu_s_per_gb": cpu / (size / 1e9),
+            "sends": result["sends"],
+        }
+        if not best or row["cpu_s_per_gb"] < best["cpu_s_per_gb"]:
+            best = row
+    return best
+
+
+async def bench(url: str, rounds: int, size: int, read_size: int) -> Dict[str, Any]:
+    await start_pools()
+    try:
+        return {mode: await run_mode(url, mode, rounds, size, read_size) for mode in MODES}
+    finally:
+        await close_pools()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="Size of the synthetic file")
+    parser.add_argument("--rounds", type=int, default=3, help="Transfers per mode; the best one is reported")
+    parser.add_argument("--read-kb", type=int, default=settings.relay_read_size // 1024, help="TB_RELAY_READ_SIZE")
+    parser.add_argument("--chunk-kb", type=int, default=settings.relay_chunk_size // 1024, help="TB_RELAY_CHUNK_SIZE")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    settings.relay_chunk_size = args.chunk_kb * 1024
+    port = free_port()
+    upstream = multiprocessing.Process(target=serve_upstream, args=(port, size), daemon=True)
+    upstream.start()
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        results = asyncio.run(bench(f"http://127.0.0.1:{port}/file", args.rounds, size, args.read_kb * 1024))
+    finally:
+        upstream.terminate()
+
+    if args.json:
+        report = {
+            "size_bytes": size,
+            "read_bytes": args.read_kb * 1024,
+            "chunk_bytes": settings.relay_chunk_size,
+            "results": results,
+        }
+        print(json.dumps(report, indent=2))
+    else:
+        for row in results.values():
+            print(
+                f"{row['mode']:<8} {row['mb_per_s']:>9.1f} MB/s  "
+                f"{row['cpu_s_per_gb']:>7.3f} CPU s/GB  {row['sends']:>7} sends"
+            )
+        speedup = results["original"]["cpu_s_per_gb"] / results["raw"]["cpu_s_per_gb"]
+        print(f"raw relay: x{speedup:.2f} less CPU per byte than the original relay")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
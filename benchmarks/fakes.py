@@ -0,0 +1,145 @@
+"""Local stand-ins for TeraBox share pages and the download CDN.
+
+    GET  /s/<shape>-<id>          a recorded share page from benchmarks/corpus (e.g. window_data,
+                                  next_data, heavy_share_page) whose download link points at this CDN
+    GET  /file/download/<id>      a deterministic file of --file-size bytes with Range/ETag support
+    HEAD /file/download/<id>
+
+Latency (--latency-ms, before response headers) and a per-stream bandwidth cap
+(--rate-mbps) can be injected to model a slow share host or CDN.
+
+    python benchmarks/fakes.py --port 9100 [--latency-ms 50] [--rate-mbps 20] [--file-size 67108864]
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from pathlib import Path
+from typing import Optional, Tuple, AsyncIterator
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+BLOCK = bytes(range(256)) * 4096  # 1 MiB repeating pattern; byte at offset n is n % 256
+
+
+class FakeConfig:
+    latency = 0.0  # seconds before response headers
+    rate = 0.0  # bytes per second per CDN stream, 0 = unlimited
+    file_size = 64 * 1024 * 1024
+
+
+config = FakeConfig()
+
+
+def load_templates() -> dict:
+    """Recorded pages by shape, with the link text to swap for a fake CDN link."""
+    expected = json.loads((CORPUS / "expected.json").read_text())
+    templates = {}
+    for name, url in expected.items():
+        if not url:
+            continue
+        html = (CORPUS / name).read_text(encoding="utf-8")
+        escaped = url.replace("/", "\\/")
+        if url in html:
+            templates[name[:-5]] = (html, url, False)
+        elif escaped in html:
+            templates[name[:-5]] = (html, escaped, True)
+    return templates
+
+
+TEMPLATES = load_templates()
+
+
+async def share_page(request: Request) -> Response:
+    slug = request.path_params["slug"]
+    shape = slug.rsplit("-", 1)[0]
+    if shape not in TEMPLATES:
+        return Response(status_code=404)
+    await asyncio.sleep(config.latency)
+    cdn = str(request.base_url).rstrip("/")
+    dlink = f"{cdn}/file/download/{slug}?sign=fake&expires=8h&time={int(time.time())}"
+    html, recorded, escaped = TEMPLATES[shape]
+    if escaped:
+        dlink = dlink.replace("/", "\\/")
+    return Response(html.replace(recorded, dlink), media_type="text/html")
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    match = RANGE_RE.match(header or "")
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        return max(0, size - int(match.group(2))), size - 1
+    return int(match.group(1)), min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+
+
+async def file_body(start: int, end: int) -> AsyncIterator[bytes]:
+    pos, began = start, time.perf_counter()
+    step = 256 * 1024
+    while pos <= end:
+        offset = pos % 256
+        n = min(step, end - pos + 1)
+        yield BLOCK[offset : offset + n]
+        pos += n
+        if config.rate:
+            # Pace the stream to the configured per-stream rate
+            ahead = (pos - start) / config.rate - (time.perf_counter() - began)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+
+async def cdn_file(request: Request) -> Response:
+    await asyncio.sleep(config.latency)
+    size = config.file_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"fake-{size}"',
+        "Content-Disposition": f'attachment; filename="{request.path_params["file_id"]}.bin"',
+    }
+    status, start, end = 200, 0, size - 1
+    span = parse_range(request.headers.get("range"), size)
+    if request.headers.get("range"):
+        if span is None or span[0] > span[1]:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        status, (start, end) = 206, span
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type="application/octet-stream")
+    return StreamingResponse(
+        file_body(start, end), status_code=status, headers=headers, media_type="application/octet-stream"
+    )
+
+
+app = Starlette(
+    routes=[
+        Route("/s/{slug}", share_page),
+        Route("/file/download/{file_id}", cdn_file, methods=["GET", "HEAD"]),
+    ]
+)
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay before every response")
+    parser.add_argument("--rate-mbps", type=float, default=0.0, help="Per-stream CDN bandwidth cap (0 = none)")
+    parser.add_argument("--file-size", type=int, default=64 * 1024 * 1024, help="Size of every CDN file in bytes")
+    args = parser.parse_args()
+    config.latency = args.latency_ms / 1000
+    config.rate = args.rate_mbps * 1e6 / 8
+    config.file_size = args.file_size
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Offline load test for /resolve, /resolve/batch and /download.
+
+Starts benchmarks/fakes.py (share pages + CDN) and the API with uvicorn as
+subprocesses, drives each scenario at a fixed concurrency, and reports latency
+percentiles, requests per second, MB/s and the API's peak RSS.
+
+    python benchmarks/loadtest.py [--scenarios resolve,batch,download] [--concurrency 16]
+        [--requests 200] [--downloads 16] [--file-size-mb 32] [--latency-ms 20]
+        [--rate-mbps 0] [--shape window_data] [--repeat] [--json] [--output run.json]
+
+Environment variables named TB_* are passed through to the API, so settings
+can be compared between runs (e.g. TB_RELAY_RAW=false).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+BATCH_ID_OFFSET = 1_000_000
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Peak resident set size of a live process (Linux only)."""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, latencies: List[float], errors: int, elapsed: float, **extra: Any) -> Dict[str, Any]:
+    done = len(latencies)
+    row: Dict[str, Any] = {
+        "scenario": name,
+        "requests": done + errors,
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": done / elapsed if elapsed else None,
+    }
+    for pct in (50, 95, 99):
+        value = percentile(latencies, pct)
+        row[f"p{pct}_ms"] = value * 1000 if value is not None else None
+    row.update(extra)
+    return row
+
+
+async def run_pool(total: int, concurrency: int, task: Callable[[int], Awaitable[None]]) -> float:
+    """Run ``task(i)`` for i in range(total) with at most ``concurrency`` in flight; returns wall seconds."""
+    counter = iter(range(total))
+
+    async def worker() -> None:
+        for i in counter:
+            await task(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+async def resolve_scenario(client: httpx.AsyncClient, args: argparse.Namespace, share: Callable[[int], str]) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            r = await client.post("/resolve", json={"url": share(i)})
+            ok = r.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+
+    elapsed = await run_pool(args.requests, args.concurrency, one)
+    return summarize("resolve", latencies, errors, elapsed)
+
+
+async def batch_scenario(client: httpx.AsyncClient, args: argparse.Namespace, share: Callable[[int], str]) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+    items_ok = 0
+    batches = max(1, args.requests // args.batch_size)
+
+    async def one(i: int) -> None:
+        nonlocal errors, items_ok
+        # Offset ids so batches do not hit links cached by the resolve scenario
+        items = [{"url": share(BATCH_ID_OFFSET + i * args.batch_size + j)} for j in range(args.batch_size)]
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", "/resolve/batch", json={"items": items}) as r:
+                lines = [json.loads(line) async for line in r.aiter_lines() if line]
+            ok = r.status_code == 200 and len(lines) == len(items)
+            items_ok += sum(1 for line in lines if line["ok"])
+        except (httpx.HTTPError, ValueError):
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+
+    elapsed = await run_pool(batches, min(args.concurrency, batches), one)
+    return summarize(
+        "batch",
+        latencies,
+        errors,
+        elapsed,
+        batch_size=args.batch_size,
+        items_ok=items_ok,
+        items_per_s=items_ok / elapsed if elapsed else None,
+    )
+
+
+async def download_scenario(client: httpx.AsyncClient, args: argparse.Namespace, cdn: Callable[[int], str]) -> Dict:
+    latencies: List[float] = []
+    ttfbs: List[float] = []
+    errors = 0
+    total_bytes = 0
+    expected = args.file_size_mb * 1024 * 1024
+
+    async def one(i: int) -> None:
+        nonlocal errors, total_bytes
+        start = time.perf_counter()
+        received = 0
+        try:
+            async with client.stream("GET", "/download", params={"url": cdn(i)}) as r:
+                ttfb = time.perf_counter() - start
+                async for chunk in r.aiter_raw():
+                    received += len(chunk)
+            ok = r.status_code == 200 and received == expected
+        except httpx.HTTPError:
+            ok = False
+        total_bytes += received
+        if ok:
+            latencies.append(time.perf_counter() - start)
+            ttfbs.append(ttfb)
+        else:
+            errors += 1
+
+    elapsed = await run_pool(args.downloads, args.concurrency, one)
+    ttfb_p = {f"ttfb_p{pct}_ms": (percentile(ttfbs, pct) or 0) * 1000 for pct in (50, 95, 99)}
+    return summarize(
+        "download",
+        latencies,
+        errors,
+        elapsed,
+        bytes=total_bytes,
+        mb_per_s=total_bytes / elapsed / 1e6 if elapsed else None,
+        **ttfb_p,
+    )
+
+
+SCENARIOS = {"resolve": resolve_scenario, "batch": batch_scenario, "download": download_scenario}
+
+
+async def drive(args: argparse.Namespace, api: str, fake: str, api_pid: int) -> Dict[str, Any]:
+    def share(i: int) -> str:
+        # Distinct share ids defeat the resolve cache unless --repeat is given
+        return f"{fake}/s/{args.shape}-{0 if args.repeat else i}"
+
+    def cdn(i: int) -> str:
+        return f"{fake}/file/download/{args.shape}-{i}?sign=fake&expires=8h&time={int(time.time())}"
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    results = []
+    async with httpx.AsyncClient(base_url=api, timeout=300, limits=limits) as client:
+        for name in args.scenarios:
+            target = cdn if name == "download" else share
+            row = await SCENARIOS[name](client, args, target)
+            row["api_peak_rss_mb"] = peak_rss_mb(api_pid)
+            results.append(row)
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "downloads": args.downloads,
+            "file_size_mb": args.file_size_mb,
+            "latency_ms": args.latency_ms,
+            "rate_mbps": args.rate_mbps,
+            "shape": args.shape,
+            "repeat": args.repeat,
+            "env": {k: v for k, v in os.environ.items() if k.startswith("TB_")},
+        },
+        "results": results,
+        "api_peak_rss_mb": peak_rss_mb(api_pid),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default="resolve,batch,download", help="Comma-separated scenarios to run")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Resolves per resolve/batch scenario")
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--downloads", type=int, default=16)
+    parser.add_argument("--file-size-mb", type=int, default=32)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Injected fake upstream latency")
+    parser.add_argument("--rate-mbps", type=float, default=0.0, help="Per-stream fake CDN bandwidth cap")
+    parser.add_argument("--shape", default="window_data", help="Recorded page shape (corpus file name)")
+    parser.add_argument("--repeat", action="store_true", help="Resolve the same share link every time")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    fake_port, api_port = free_port(), free_port()
+    fake = subprocess.Popen(
+        [
+            sys.executable, str(ROOT / "benchmarks" / "fakes.py"),
+            "--port", str(fake_port),
+            "--latency-ms", str(args.latency_ms),
+            "--rate-mbps", str(args.rate_mbps),
+            "--file-size", str(args.file_size_mb * 1024 * 1024),
+        ],
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(api_port), "--log-level", "warning"],
+        cwd=str(ROOT),
+        env={
+            **os.environ,
+            "TB_BROWSER_ENABLED": os.environ.get("TB_BROWSER_ENABLED", "false"),
+            # All load comes from one address, so per-client rate limiting is off unless asked for
+            "TB_CLIENT_RATE": os.environ.get("TB_CLIENT_RATE", "0"),
+        },
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(fake_port)
+        wait_for_port(api_port)
+        report = asyncio.run(drive(args, f"http://127.0.0.1:{api_port}", f"http://127.0.0.1:{fake_port}", api.pid))
+    finally:
+        api.terminate()
+        fake.terminate()
+        api.wait()
+        fake.wait()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for row in report["results"]:
+            line = (
+                f"{row['scenario']:<9} {row['requests']:>6} req  {row['errors']:>4} err  "
+                f"{row['rps'] or 0:>8.1f} req/s  p50 {row['p50_ms'] or 0:>8.1f} ms  "
+                f"p95 {row['p95_ms'] or 0:>8.1f} ms  p99 {row['p99_ms'] or 0:>8.1f} ms"
+            )
+            if "mb_per_s" in row:
+                line += f"  {row['mb_per_s'] or 0:>8.1f} MB/s  ttfb p50 {row['ttfb_p50_ms']:.1f} ms"
+            if "items_per_s" in row:
+                line += f"  {row['items_per_s'] or 0:>8.1f} items/s"
+            print(line)
+        print(f"API peak RSS: {report['api_peak_rss_mb'] or 0:.1f} MB")
+    return 1 if any(row["errors"] for row in report["results"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())